@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Round trips requests with 1 KB, 1 MB and 50 MB bodies through a local
+# socketpair (encode, send, receive, decode) with JSON line framing and with
+# binary framing.
+#
+# usage: bench_framing.py [repeat]
+
+import datetime
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guppyproxy.proxy import (ProxyConnection, SockBuffer, HTTPRequest, encode_req,
+                              decode_req, FRAMING_JSON, FRAMING_BINARY)
+
+
+def conn_pair(framing):
+    a, b = socket.socketpair()
+    conns = []
+    for s in (a, b):
+        conn = ProxyConnection()
+        conn.sbuf = SockBuffer(s)
+        conn.closed = False
+        conn.framing = framing
+        conns.append(conn)
+    return conns
+
+
+def round_trip(framing, req, repeat):
+    sender, receiver = conn_pair(framing)
+    cmd = {"Command": "Submit", "Request": encode_req(req), "Storage": 0}
+
+    def send_all():
+        for _ in range(repeat):
+            cmd["Request"] = encode_req(req)
+            sender.submit_command(cmd)
+
+    start = time.perf_counter()
+    t = threading.Thread(target=send_all, daemon=True)
+    t.start()
+    for _ in range(repeat):
+        msg = receiver.read_message()
+        got = decode_req(msg["Request"])
+        assert len(got.body) == len(req.body)
+    elapsed = time.perf_counter() - start
+    t.join()
+    sender.close()
+    receiver.close()
+    return elapsed / repeat
+
+
+def main():
+    repeat = 5
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+    for name, size in (("1 KB", 1024), ("1 MB", 1024 * 1024), ("50 MB", 50 * 1024 * 1024)):
+        req = HTTPRequest(method="POST", path="/upload", dest_host="example.com",
+                          headers={"Content-Type": ["application/octet-stream"]},
+                          body=os.urandom(size))
+        req.time_start = datetime.datetime(2018, 1, 1)
+        req.time_end = datetime.datetime(2018, 1, 1, 0, 0, 1)
+        n = repeat
+        if size < 1024 * 1024:
+            n = repeat * 1000
+        js = round_trip(FRAMING_JSON, req, n)
+        bn = round_trip(FRAMING_BINARY, req, n)
+        print("%-6s  json %10.3fms  binary %10.3fms  (%.1fx)" % (
+            name, js * 1000, bn * 1000, js / bn))
+
+
+if __name__ == '__main__':
+    main()
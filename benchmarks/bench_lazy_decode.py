@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Measures the per-row cost of decoding StorageQuery results eagerly and
+# lazily, for a headers-only listing (what the history table reads) and for a
+# full fetch that reads every body.
+#
+# usage: bench_lazy_decode.py [n_rows]
+
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guppyproxy.proxy import decode_req
+
+
+def make_result(i, body_size):
+    body = base64.b64encode(os.urandom(body_size)).decode()
+    headers = {
+        "Host": ["example%d.com" % (i % 50)],
+        "User-Agent": ["Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/60.0"],
+        "Accept": ["text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"],
+        "Cookie": ["session=%032x; theme=dark" % i],
+        "Content-Length": [str(body_size)],
+    }
+    return {
+        "DbId": str(i), "Method": "GET", "Path": "/api/v1/items/%d?page=2" % i,
+        "ProtoMajor": 1, "ProtoMinor": 1, "Headers": headers, "Body": body,
+        "DestHost": "example%d.com" % (i % 50), "DestPort": 443, "UseTLS": True,
+        "StartTime": 1500000000000000000 + i, "EndTime": 1500000000500000000 + i,
+        "Tags": [],
+        "Response": {
+            "StatusCode": 200, "Reason": "OK", "ProtoMajor": 1, "ProtoMinor": 1,
+            "Headers": {"Content-Type": ["text/html"], "Content-Length": [str(body_size)],
+                        "Set-Cookie": ["a=b; Path=/"]},
+            "Body": body,
+        },
+    }
+
+
+def listing_row(req):
+    return (req.method, req.dest_host, req.url.path, req.response.status_code, req.time_start)
+
+
+def full_fetch(req):
+    return (listing_row(req), len(req.body), len(req.response.body),
+            list(req.headers.pairs()))
+
+
+def bench(results, lazy, use):
+    start = time.perf_counter()
+    for r in results:
+        use(decode_req(r, lazy=lazy))
+    return (time.perf_counter() - start) / len(results)
+
+
+def main():
+    n = 20000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for body_size in (0, 4096):
+        # round trip through json so every row is a fresh dict like off the wire
+        results = json.loads(json.dumps([make_result(i, body_size) for i in range(n)]))
+        for name, use in (("listing", listing_row), ("full fetch", full_fetch)):
+            eager = bench(results, False, use)
+            lazy = bench(results, True, use)
+            print("%5d byte bodies, %-10s  eager %7.2fus/row  lazy %7.2fus/row" % (
+                body_size, name, eager * 1e6, lazy * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Opens the history table on a stand-in storage holding millions of requests
+# (generated on the fly from their offsets) and measures the time until the
+# newest rows are painted, then scrolls through the table and reports the
+# memory held by the pages it kept.
+#
+# usage: bench_paged_history.py [n_requests] [page_latency_ms]
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PyQt5.QtWidgets import QApplication
+from guppyproxy.proxy import ProxyClient
+from guppyproxy.reqlist import ReqTableWidget, PagedReqListModel
+from standin import StandinBackend, _ok
+
+
+def make_result(i, n):
+    # request i counted from the oldest, so the newest has the largest id
+    return {
+        "DbId": str(i), "Method": "GET", "Path": "/api/v1/items/%d" % i,
+        "ProtoMajor": 1, "ProtoMinor": 1,
+        "Headers": {"Host": ["example%d.com" % (i % 50)]}, "Body": "",
+        "DestHost": "example%d.com" % (i % 50), "DestPort": 443, "UseTLS": True,
+        "StartTime": 1500000000000000000 + i, "EndTime": 1500000000500000000 + i,
+        "Tags": [],
+        "Response": {"StatusCode": 200, "Reason": "OK", "ProtoMajor": 1, "ProtoMinor": 1,
+                     "Headers": {}, "Body": ""},
+    }
+
+
+def backend(n, latency):
+    b = StandinBackend()
+    b.add_handler("ListStorage", lambda cmd: _ok(Storages=[{"Id": 1, "Description": "sqlite|"}]))
+    b.add_handler("StorageCount", lambda cmd: _ok(Count=n))
+
+    def query(cmd):
+        time.sleep(latency)
+        offset = cmd.get("Offset", 0)
+        limit = cmd.get("MaxResults", 0) or n
+        end = min(n, offset + limit)
+        results = [make_result(n - 1 - i, n) for i in range(offset, end)]
+        return _ok(Results=results, NextOffset=end)
+
+    b.add_handler("StorageQuery", query)
+    return b
+
+
+def wait_for(app, cond, timeout=30):
+    start = time.perf_counter()
+    while not cond():
+        app.processEvents()
+        app.sendPostedEvents()
+        time.sleep(0.001)
+        if time.perf_counter() - start > timeout:
+            raise Exception("timed out")
+
+
+def main():
+    n = 5000000
+    latency = 0.005
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        latency = float(sys.argv[2]) / 1000
+    app = QApplication(sys.argv)
+    b = backend(n, latency)
+    with ProxyClient(conn_addr=b.addr, binary_framing=False) as client:
+        client.proxy_storage = 1
+        widg = ReqTableWidget(client)
+        widg.resize(1200, 800)
+        widg.show()
+        app.processEvents()
+
+        start = time.perf_counter()
+        widg.set_filter([])
+        wait_for(app, lambda: isinstance(widg.tableModel, PagedReqListModel)
+                 and widg.tableModel.req_by_ind(0) is not None)
+        widg.tableView.viewport().repaint()
+        first = time.perf_counter() - start
+        print("%d requests, %.0fms page latency" % (n, latency * 1000))
+        print("  newest rows painted after %.0fms, newest id %s" % (
+            first * 1000, widg.tableModel.req_by_ind(0).db_id))
+
+        model = widg.tableModel
+        bar = widg.tableView.verticalScrollBar()
+        steps = 200
+
+        def scroll():
+            for i in range(steps):
+                bar.setValue(bar.maximum() * i // steps)
+                widg.tableView.viewport().repaint()
+                row = bar.value()  # the view scrolls a row at a time
+                wait_for(app, lambda: model.req_by_ind(row) is not None)
+
+        start = time.perf_counter()
+        scroll()
+        elapsed = time.perf_counter() - start
+        print("  %d jumps across the table: %.1fms per jump" % (steps, elapsed / steps * 1000))
+
+        # the stand-in runs in this process so memory is measured on a
+        # separate pass, tracing slows it down a lot
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        scroll()
+        used = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        print("  %d pages kept, holding %.1f MB" % (
+            len(model.pages), used / 1024 / 1024))
+        widg.close()
+    b.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Runs 10k concurrent check_request calls against a local stand-in backend on
+# one connection, first with the lock-per-round-trip mode and then pipelined.
+#
+# usage: bench_pipelining.py [n_calls] [n_threads]
+
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guppyproxy.proxy import ProxyConnection
+from standin import StandinBackend
+
+
+def run(conn, n_calls, n_threads):
+    def call(_):
+        start = time.perf_counter()
+        conn.check_request([[["host", "is", "example.com"]]], storage_id=1, db_id="1")
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(n_threads) as pool:
+        latencies = sorted(pool.map(call, range(n_calls)))
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies
+
+
+def report(name, elapsed, latencies):
+    n = len(latencies)
+    print("%-22s %7.2fs  %8.0f calls/s  p50 %6.2fms  p99 %6.2fms" % (
+        name, elapsed, n / elapsed,
+        latencies[n // 2] * 1000, latencies[int(n * 0.99)] * 1000))
+
+
+def main():
+    n_calls = 10000
+    n_threads = 200
+    if len(sys.argv) > 1:
+        n_calls = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_threads = int(sys.argv[2])
+
+    for name, echo_ids, pipelined in (("locked", False, False),
+                                      ("pipelined (in order)", False, True),
+                                      ("pipelined (tagged)", True, True)):
+        backend = StandinBackend(echo_ids=echo_ids)
+        kind, addr = backend.addr.split(":", 1)
+        with ProxyConnection(kind=kind, addr=addr) as conn:
+            if pipelined:
+                conn.start_pipelining()
+            report(name, *run(conn, n_calls, n_threads))
+        backend.close()
+
+
+if __name__ == '__main__':
+    main()
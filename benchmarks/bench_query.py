@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Compares checking requests against a filter locally with QueryMatcher and
+# with a checkrequest round trip to a stand-in backend, the way new requests
+# from watch_storage used to be checked.
+#
+# usage: bench_query.py [n_requests]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guppyproxy.proxy import ProxyClient, HTTPRequest, HTTPResponse
+from guppyproxy.query import QueryMatcher
+from standin import StandinBackend
+
+QUERY = [
+    [["inv", "path", "containsregexp", r"(\.png$|\.jpg$|\.jpeg$|\.gif$|\.ico$|\.bmp$|\.svg$)"]],
+    [["inv", "path", "containsregexp", r"(\.js$|\.css$|\.woff$)"]],
+    [["host", "contains", "example"], ["host", "is", "test.local"]],
+    [["inv", "statuscode", "is", "404"]],
+    [["reqheader", "is", "User-Agent", "contains", "Mozilla"]],
+]
+
+EXTS = ["", ".png", ".js", "/", ".css", ".html"]
+
+
+def make_req(i):
+    req = HTTPRequest(method="GET", path="/static/item%d%s?v=%d" % (i, EXTS[i % len(EXTS)], i),
+                      dest_host="example%d.com" % (i % 20), dest_port=443, use_tls=True,
+                      headers={"User-Agent": ["Mozilla/5.0 (X11; Linux x86_64)"],
+                               "Accept": ["*/*"]},
+                      headers_only=True, db_id=str(i))
+    req.response = HTTPResponse(status_code=404 if i % 9 == 0 else 200, headers_only=True)
+    return req
+
+
+def main():
+    n = 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    reqs = [make_req(i) for i in range(n)]
+
+    backend = StandinBackend()
+    client = ProxyClient(conn_addr=backend.addr, binary_framing=False)
+    client.__enter__()
+    try:
+        matcher = QueryMatcher(client, QUERY)
+        start = time.perf_counter()
+        matched = sum(1 for req in reqs if matcher.matches(req))
+        local = (time.perf_counter() - start) / n
+        print("local:      %8.2fus per request (%d/%d matched, %d sent to the backend)" % (
+            local * 1e6, matched, n, matcher.remote_checks))
+
+        n_remote = min(n, 5000)
+        start = time.perf_counter()
+        for req in reqs[:n_remote]:
+            client.msg_conn.check_request(QUERY, req=req)
+        remote = (time.perf_counter() - start) / n_remote
+        print("round trip: %8.2fus per request (%.0fx)" % (remote * 1e6, remote / local))
+    finally:
+        client.close()
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
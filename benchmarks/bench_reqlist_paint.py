@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Measures the time to build the rows of the history table from a list of
+# loaded requests, which is done off the GUI thread, and the time from handing
+# the rows to the table model until the table has painted its first screen.
+# Cells are formatted as the view asks for them.
+#
+# usage: bench_reqlist_paint.py [n_rows]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PyQt5.QtWidgets import QApplication, QTableView, QHeaderView, QAbstractItemView
+from guppyproxy.proxy import decode_req
+from guppyproxy.reqlist import ReqListModel
+from guppyproxy.rowstore import RowStore
+
+
+class Client:
+    storage_by_id = {}
+    storage_by_prefix = {}
+
+    def get_reqid(self, req):
+        return req.db_id
+
+
+_headers = [{
+    "Host": ["example%d.com" % i],
+    "User-Agent": ["Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/60.0"],
+    "Content-Length": ["0"],
+} for i in range(50)]
+
+_response = {
+    "StatusCode": 200, "Reason": "OK", "ProtoMajor": 1, "ProtoMinor": 1,
+    "Headers": {"Content-Type": ["text/html"], "Content-Length": ["0"]},
+    "Body": "",
+}
+
+
+def make_req(i):
+    return decode_req({
+        "DbId": str(i), "Method": "GET", "Path": "/api/v1/items/%d?page=2" % i,
+        "ProtoMajor": 1, "ProtoMinor": 1, "Headers": _headers[i % 50], "Body": "",
+        "DestHost": "example%d.com" % (i % 50), "DestPort": 443, "UseTLS": True,
+        "StartTime": 1500000000000000000 + i, "EndTime": 1500000000500000000 + i,
+        "Tags": [], "Response": _response,
+    }, headers_only=True, lazy=True)
+
+
+def first_paint(store, app):
+    view = QTableView()
+    view.resize(1200, 800)
+    view.verticalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+    view.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+    view.verticalHeader().hide()
+    view.setSelectionBehavior(QAbstractItemView.SelectRows)
+    view.horizontalHeader().setStretchLastSection(True)
+    view.show()
+    app.processEvents()
+
+    start = time.perf_counter()
+    model = ReqListModel(Client())
+    view.setModel(model)
+    model.set_store(store)
+    app.processEvents()
+    view.viewport().repaint()
+    elapsed = time.perf_counter() - start
+    view.close()
+    return elapsed
+
+
+def main():
+    n = 1000000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    app = QApplication(sys.argv)
+    reqs = [make_req(i) for i in range(n)]
+    start = time.perf_counter()
+    store = RowStore()
+    store.extend(reqs)
+    build = time.perf_counter() - start
+    print("%d rows, built in %.0fms, time to first paint: %.0fms" % (
+        n, build * 1000, first_paint(store, app) * 1000))
+
+
+if __name__ == "__main__":
+    main()
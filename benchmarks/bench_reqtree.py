@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Compares opening the site map tab for a large history between rebuilding a
+# QStandardItemModel from every request in the list, which is what opening
+# the tab used to do, and the path trie kept up to date by the list. The
+# trie is built off the GUI thread together with the list's rows, so opening
+# the tab is only the first paint. Also times adding a batch of new requests
+# to the trie while the tree is showing.
+#
+# usage: bench_reqtree.py [n_rows]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from PyQt5.QtWidgets import QApplication, QTreeView
+from PyQt5.QtGui import QStandardItem, QStandardItemModel
+from guppyproxy.reqlist import ReqListModel
+from guppyproxy.reqtree import ReqTreeView, build_tree
+from guppyproxy.rowstore import RowStore
+from bench_rowstore import make_req
+from bench_reqlist_paint import Client
+
+
+def rebuild_items(reqs):
+    # the tree as it was built before, one item for every node, all expanded
+    model = QStandardItemModel()
+    nodes = {}
+    for req in reqs:
+        if not req.response or req.response.status_code == 404:
+            continue
+        parts = [req.dest_host] + ["/" + p for p in req.url.geturl(False).split("/")[1:]]
+        parent = model.invisibleRootItem()
+        key = ()
+        for part in parts:
+            key += (part,)
+            item = nodes.get(key)
+            if item is None:
+                item = QStandardItem(part)
+                nodes[key] = item
+                parent.appendRow(item)
+            parent = item
+    view = QTreeView()
+    view.setModel(model)
+    view.expandAll()
+    return view, model
+
+
+def paint(view, app):
+    view.resize(1200, 800)
+    view.show()
+    app.processEvents()
+    view.repaint()
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    n = 500000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    app = QApplication(sys.argv)
+    store = RowStore()
+    store.extend(make_req(i) for i in range(n))
+    print("%d requests" % n)
+
+    model = ReqListModel(Client())
+    model.set_store(store)
+    reqs, stubs_ms = timed(model.get_requests)
+    (view, items), build_ms = timed(rebuild_items, reqs)
+    _, paint_ms = timed(paint, view, app)
+    print("rebuild on open: %8.0fms (request stubs %.0fms, items %.0fms, paint %.0fms)" % (
+        stubs_ms + build_ms + paint_ms, stubs_ms, build_ms, paint_ms))
+    del reqs, view, items
+
+    root, trie_ms = timed(build_tree, store)
+    tree = ReqTreeView()
+    model.tree = tree.tree
+    _, set_ms = timed(model.set_store, store, root)
+    _, paint_ms = timed(paint, tree.tree_view, app)
+    print("trie:            %8.0fms to open (set %.0fms, paint %.0fms), built off the GUI thread in %.0fms" % (
+        set_ms + paint_ms, set_ms, paint_ms, trie_ms))
+
+    tree_model = tree.tree_model
+    for row in range(tree_model.rowCount()):
+        tree.tree_view.expand(tree_model.index(row, 0))
+    new = [make_req(i) for i in range(n, n + 1000)]
+    _, add_ms = timed(model.add_requests, new)
+    app.processEvents()
+    print("add 1000 requests with the hosts expanded: %.0fms" % add_ms)
+
+
+if __name__ == "__main__":
+    main()
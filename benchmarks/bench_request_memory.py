@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Measures the memory held per request by a list of decoded headers-only
+# requests (what the history table keeps) using tracemalloc, both for eagerly
+# and lazily decoded requests, and after the listing columns have been read.
+#
+# usage: bench_request_memory.py [n_rows]
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guppyproxy.proxy import decode_req
+
+
+def make_result(i):
+    headers = {
+        "Host": ["example%d.com" % (i % 50)],
+        "User-Agent": ["Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/60.0"],
+        "Accept": ["text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"],
+        "Content-Length": ["0"],
+    }
+    return {
+        "DbId": str(i), "Method": "GET", "Path": "/api/v1/items/%d?page=2" % i,
+        "ProtoMajor": 1, "ProtoMinor": 1, "Headers": headers, "Body": "",
+        "DestHost": "example%d.com" % (i % 50), "DestPort": 443, "UseTLS": True,
+        "StartTime": 1500000000000000000 + i, "EndTime": 1500000000500000000 + i,
+        "Tags": [],
+        "Response": {
+            "StatusCode": 200, "Reason": "OK", "ProtoMajor": 1, "ProtoMinor": 1,
+            "Headers": {"Content-Type": ["text/html"], "Content-Length": ["0"]},
+            "Body": "",
+        },
+    }
+
+
+def read_columns(req):
+    return (req.method, req.dest_host, req.url.path, req.sorted_tags(),
+            req.response.status_code, req.time_start_ns, req.content_length)
+
+
+def measure(results, lazy, touch):
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    reqs = [decode_req(r, headers_only=True, lazy=lazy) for r in results]
+    if touch:
+        for req in reqs:
+            read_columns(req)
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del reqs
+    return used / len(results)
+
+
+def main():
+    n = 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    results = [make_result(i) for i in range(n)]
+    print("%d headers-only requests, bytes held per request:" % n)
+    for lazy in (False, True):
+        for touch in (False, True):
+            print("  %-6s %-16s %8.0f" % ("lazy" if lazy else "eager",
+                                          "columns read" if touch else "decoded only",
+                                          measure(results, lazy, touch)))
+
+
+if __name__ == "__main__":
+    main()
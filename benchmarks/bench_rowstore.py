@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Compares the memory held by the history list for a large number of
+# headers-only requests, and the time to load, sort and filter it, between
+# the columnar row store and the layout the list used before it, where every
+# row held its request object and a sort key. Memory is measured on a
+# separate pass since tracing slows everything down.
+#
+# usage: bench_rowstore.py [n_rows]
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from operator import itemgetter
+from PyQt5.QtCore import QCoreApplication, Qt
+from guppyproxy.proxy import decode_req
+from guppyproxy.reqlist import ReqListModel, _ReqRow
+from guppyproxy.rowstore import numpy
+from bench_reqlist_paint import Client
+
+_statuses = [(200, "OK"), (200, "OK"), (302, "Found"), (404, "Not Found"), (500, "Internal Server Error")]
+
+_responses = [{
+    "StatusCode": code, "Reason": reason, "ProtoMajor": 1, "ProtoMinor": 1,
+    "Headers": {"Content-Type": ["text/html"], "Content-Length": [str(code * 10)]},
+    "Body": "",
+} for code, reason in _statuses]
+
+_headers = [{
+    "Host": ["example%d.com" % i],
+    "User-Agent": ["Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/60.0"],
+} for i in range(50)]
+
+
+def make_req(i):
+    return decode_req({
+        "DbId": str(i), "Method": "GET", "Path": "/api/v1/items/%d?page=%d" % (i * 7919 % 100003, i % 5),
+        "ProtoMajor": 1, "ProtoMinor": 1, "Headers": _headers[i % 50], "Body": "",
+        "DestHost": "example%d.com" % (i % 50), "DestPort": 443, "UseTLS": True,
+        "StartTime": 1500000000000000000 + i * 1000, "EndTime": 1500000000000000000 + i * 1000 + i % 977,
+        "Tags": [], "Response": _responses[i % len(_responses)],
+    }, headers_only=True, lazy=True)
+
+
+def id_key(reqid):
+    return ("", int(reqid), reqid)
+
+
+class RowLayout:
+    # one object per row holding the request, kept sorted with a list of keys
+    # and a dict from id to key
+
+    def __init__(self, reqs):
+        rows = [_ReqRow(req, req.db_id) for req in reqs]
+        self.set_sorted([((req.time_start_ns, id_key(row.reqid)), row)
+                         for req, row in zip(reqs, rows)], True)
+
+    def set_sorted(self, pairs, reverse):
+        pairs.sort(key=itemgetter(0), reverse=reverse)
+        self.keys = [key for key, _ in pairs]
+        self.rows = [row for _, row in pairs]
+        self.key_by_id = {row.reqid: key for key, row in pairs}
+
+    def sort(self, primary, reverse):
+        self.set_sorted([((primary(row.req), key[1]), row)
+                         for key, row in zip(self.keys, self.rows)], reverse)
+
+
+def status(req):
+    return req.response.status_code if req.response else -1
+
+
+def path(req):
+    return req.url.path
+
+
+def load_rows(n):
+    return RowLayout([make_req(i) for i in range(n)])
+
+
+def load_columns(n):
+    model = ReqListModel(Client())
+    model.set_requests(make_req(i) for i in range(n))
+    return model
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def held(load, n):
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    kept = load(n)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del kept
+    return used / 1024 / 1024
+
+
+def main():
+    n = 1000000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    app = QCoreApplication(sys.argv)
+    print("%d rows, numpy %s" % (n, "installed" if numpy is not None else "not installed"))
+    print("%-8s %10s %10s %14s %12s %14s" % ("", "held", "load", "sort status", "sort path", "status >= 500"))
+
+    layout, load_ms = timed(load_rows, n)
+    _, status_ms = timed(layout.sort, status, False)
+    _, path_ms = timed(layout.sort, path, False)
+    _, filter_ms = timed(lambda: [row for row in layout.rows if status(row.req) >= 500])
+    del layout
+    print("%-8s %8.1fMB %8.0fms %12.0fms %10.0fms %12.0fms" % (
+        "rows", held(load_rows, n), load_ms, status_ms, path_ms, filter_ms))
+
+    model, load_ms = timed(load_columns, n)
+    _, status_ms = timed(model.sort, model.header_order.index(model.HD_SCODE), Qt.AscendingOrder)
+    _, path_ms = timed(model.sort, model.header_order.index(model.HD_PATH), Qt.AscendingOrder)
+    _, filter_ms = timed(model.store.where, "status", ">=", 500)
+    del model
+    print("%-8s %8.1fMB %8.0fms %12.0fms %10.0fms %12.0fms" % (
+        "columns", held(load_columns, n), load_ms, status_ms, path_ms, filter_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Pushes Submit commands with a 100 MB body through a local socketpair with
+# JSON line framing and with binary framing and reports the write throughput
+# and the peak memory allocated while encoding and sending. The old send path
+# that joined the whole message before writing it is measured for comparison.
+# The receiving end only drains the socket so the numbers are for the send
+# path alone.
+#
+# usage: bench_send.py [repeat] [size_mb]
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guppyproxy.proxy import (ProxyConnection, SockBuffer, HTTPRequest, encode_req,
+                              encode_binary_frame, _json_default, FRAMING_JSON, FRAMING_BINARY)
+
+
+def drain(s):
+    buf = bytearray(4 * 1024 * 1024)
+    while s.recv_into(buf) > 0:
+        pass
+
+
+def joined_send(conn, cmd):
+    # how messages were written before the send path was vectored
+    if conn.framing == FRAMING_BINARY:
+        data = b''.join(encode_binary_frame(cmd))
+    else:
+        data = json.dumps(cmd, default=_json_default).encode() + b"\n"
+    conn.sbuf.s.sendall(data)
+
+
+def run(framing, req, repeat, joined):
+    a, b = socket.socketpair()
+    conn = ProxyConnection()
+    conn.sbuf = SockBuffer(a)
+    conn.closed = False
+    conn.framing = framing
+    t = threading.Thread(target=drain, args=(b,), daemon=True)
+    t.start()
+
+    cmd = {"Command": "Submit", "Request": encode_req(req), "Storage": 0}
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        if joined:
+            joined_send(conn, cmd)
+        else:
+            conn.submit_command(cmd)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    a.shutdown(socket.SHUT_WR)
+    t.join()
+    a.close()
+    b.close()
+    return elapsed / repeat, peak
+
+
+def main():
+    repeat = 3
+    size_mb = 100
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        size_mb = int(sys.argv[2])
+    size = size_mb * 1024 * 1024
+    req = HTTPRequest(method="POST", path="/upload", dest_host="example.com",
+                      headers={"Content-Type": ["application/octet-stream"]},
+                      body=os.urandom(size))
+    print("%d MB submit, %d runs" % (size_mb, repeat))
+    for framing in (FRAMING_JSON, FRAMING_BINARY):
+        for joined in (True, False):
+            elapsed, peak = run(framing, req, repeat, joined)
+            print("%-9s  %-7s  %8.1fms  %8.1f MB/s  peak alloc %7.1f MB" % (
+                framing, "joined" if joined else "vectored", elapsed * 1000,
+                size / elapsed / 1024 / 1024, peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
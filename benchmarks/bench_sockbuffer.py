@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Times reading one huge reply line (like a big StorageQuery result) through a
+# local socketpair with the old 256 byte recv loop and with SockBuffer.
+#
+# usage: bench_sockbuffer.py [size_mb]
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from guppyproxy.proxy import SockBuffer, SocketClosed
+
+
+class LegacySockBuffer:
+    # The framer SockBuffer replaced, kept here for comparison
+
+    def __init__(self, sock):
+        self.buf = []
+        self.s = sock
+
+    def readline(self):
+        while True:
+            try:
+                data = self.s.recv(256)
+            except OSError:
+                raise SocketClosed()
+            if not data:
+                raise SocketClosed()
+            self.buf.append(data)
+            if b'\n' in data:
+                break
+        allbytes = b''.join(self.buf)
+        head, tail = allbytes.split(b'\n', 1)
+        self.buf = [tail]
+        return head.decode()
+
+
+def make_reply(size):
+    chunk = b'{"DbId": "1234", "Body": "' + b'A' * 4000 + b'"}, '
+    n = size // len(chunk) + 1
+    return b'{"Success": true, "Results": [' + chunk * n + b']}\n'
+
+
+def time_read(bufclass, reply):
+    a, b = socket.socketpair()
+
+    def writer():
+        a.sendall(reply)
+        a.close()
+
+    t = threading.Thread(target=writer)
+    start = time.perf_counter()
+    t.start()
+    ln = bufclass(b).readline()
+    elapsed = time.perf_counter() - start
+    t.join()
+    b.close()
+    assert len(ln) == len(reply) - 1
+    return elapsed
+
+
+def main():
+    size_mb = 500
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    reply = make_reply(size_mb * 1024 * 1024)
+    print("reading a %d MB reply line" % (len(reply) // (1024 * 1024)))
+    for name, bufclass in (("before (recv(256) loop)", LegacySockBuffer),
+                           ("after (SockBuffer)", SockBuffer)):
+        elapsed = time_read(bufclass, reply)
+        mbps = len(reply) / elapsed / (1024 * 1024)
+        print("%-26s %8.2fs  %8.1f MB/s" % (name, elapsed, mbps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# A minimal stand-in for the puppy backend used by the benchmarks. It speaks
+# the line based message protocol over a unix socket and answers a handful of
+# commands from canned handlers.
+
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from guppyproxy.proxy import SockBuffer, SocketClosed, CORRELATION_KEY
+
+
+def _ok(**kwargs):
+    ret = {"Success": True}
+    ret.update(kwargs)
+    return ret
+
+
+class StandinBackend:
+
+    def __init__(self, echo_ids=False, delays=None):
+        # echo_ids: echo correlation ids back like a multiplexing backend
+        # delays: {command name: seconds} to simulate slow commands
+        self.echo_ids = echo_ids
+        self.delays = delays or {}
+        self.handlers = {
+            "Ping": lambda cmd: _ok(Ping="Pong"),
+            "ListStorage": lambda cmd: _ok(Storages=[]),
+            "checkrequest": lambda cmd: _ok(Result=True),
+        }
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "standin.sock")
+        self.lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.lsock.bind(self.path)
+        self.lsock.listen(64)
+        self.conns = []
+        t = threading.Thread(target=self._accept_loop, daemon=True)
+        t.start()
+
+    @property
+    def addr(self):
+        return "unix:" + self.path
+
+    def add_handler(self, command, handler):
+        self.handlers[command] = handler
+
+    def _accept_loop(self):
+        while True:
+            try:
+                s, _ = self.lsock.accept()
+            except OSError:
+                return
+            self.conns.append(s)
+            t = threading.Thread(target=self._serve, args=(s,), daemon=True)
+            t.start()
+
+    def _serve(self, s):
+        sbuf = SockBuffer(s)
+        while True:
+            try:
+                cmd = json.loads(sbuf.readline_bytes())
+            except SocketClosed:
+                return
+            name = cmd.get("Command")
+            if name in self.delays:
+                time.sleep(self.delays[name])
+            handler = self.handlers.get(name)
+            if handler is None:
+                reply = {"Success": False, "Reason": "unknown command: %s" % name}
+            else:
+                reply = handler(cmd)
+            if self.echo_ids and CORRELATION_KEY in cmd:
+                reply[CORRELATION_KEY] = cmd[CORRELATION_KEY]
+            try:
+                s.sendall(json.dumps(reply).encode() + b"\n")
+            except OSError:
+                return
+
+    def close(self):
+        self.lsock.close()
+        for s in self.conns:
+            try:
+                s.close()
+            except OSError:
+                pass
+        try:
+            os.unlink(self.path)
+            os.rmdir(self.tmpdir)
+        except OSError:
+            pass
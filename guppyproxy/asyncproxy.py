@@ -0,0 +1,673 @@
+import asyncio
+import inspect
+import json
+import threading
+import traceback
+
+from collections import OrderedDict
+from itertools import count
+
+from guppyproxy.proxy import (MessageError, ProxyException, SocketClosed, InvalidQuery, ActiveStorage,
+                              CORRELATION_KEY, _json_default, merge_by_time, _req_time_key,
+                              encode_req, encode_rsp, encode_ws, decode_req, decode_rsp,
+                              decode_ws, encode_json_line, _unmangled_reply, _serialize_storage)
+from guppyproxy.query import CompiledQuery
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+
+# asyncio's default line limit is 64KB, replies with full bodies are much larger
+STREAM_LIMIT = 1024 * 1024 * 1024
+
+
+async def _maybe_await(v):
+    if inspect.isawaitable(v):
+        return await v
+    return v
+
+
+class AsyncProxyConnection:
+    # An asyncio version of proxy.ProxyConnection. Commands are always
+    # pipelined: each one is tagged with a correlation id and a reader task
+    # resolves the future of the waiting call. Replies without an id go to the
+    # oldest pending call for backends that answer in order.
+
+    next_id = 1
+
+    def __init__(self):
+        self.connid = AsyncProxyConnection.next_id
+        AsyncProxyConnection.next_id += 1
+        self.reader = None
+        self.writer = None
+        self.debug = False
+        self.closed = True
+        self.kind = None
+        self.addr = None
+
+        self.pending = OrderedDict()  # correlation id -> future, in send order
+        self.corr_ids = count(1)
+        self.read_task = None
+        self.stream_queue = None  # unsolicited messages once streaming
+        self.streaming = False
+        self.intercept_skipped = 0  # messages outside of the macro's intercept_query
+        self.intercept_errors = 0  # messages the macro raised on, let through unchanged
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self, kind, addr):
+        if kind.lower() == "tcp":
+            tcpaddr, port = addr.rsplit(":", 1)
+            self.reader, self.writer = await asyncio.open_connection(tcpaddr, int(port),
+                                                                     limit=STREAM_LIMIT)
+        elif kind.lower() == "unix":
+            self.reader, self.writer = await asyncio.open_unix_connection(addr,
+                                                                          limit=STREAM_LIMIT)
+        else:
+            raise MessageError("unknown connection type: {}".format(kind))
+        self.kind = kind.lower()
+        self.addr = addr
+        self.closed = False
+        self.read_task = asyncio.ensure_future(self._read_replies())
+
+    @property
+    def n_pending(self):
+        return len(self.pending)
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        if hasattr(self.writer, "wait_closed"):
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        if self.read_task is not None:
+            await asyncio.gather(self.read_task, return_exceptions=True)
+
+    async def _read_json(self):
+        try:
+            ln = await self.reader.readline()
+        except (OSError, ValueError):
+            raise SocketClosed()
+        if not ln:
+            raise SocketClosed()
+        if self.debug:
+            print("<({}) {}".format(self.connid, ln.decode().rstrip()))
+        return json.loads(ln)
+
+    def _check_reply(self, j):
+        if ("Success" in j) and (j["Success"] is False):
+            if "Reason" in j:
+                raise MessageError(j["Reason"])
+            raise MessageError("unknown error")
+        return j
+
+    async def _read_replies(self):
+        try:
+            while True:
+                try:
+                    j = await self._read_json()
+                except (SocketClosed, ValueError):
+                    break
+                corrid = j.pop(CORRELATION_KEY, None)
+                if corrid in self.pending:
+                    fut = self.pending.pop(corrid)
+                elif len(self.pending) > 0:
+                    _, fut = self.pending.popitem(last=False)
+                elif self.stream_queue is not None:
+                    await self.stream_queue.put(j)
+                    continue
+                else:
+                    continue
+                if fut.done():
+                    continue
+                try:
+                    fut.set_result(self._check_reply(j))
+                except MessageError as e:
+                    fut.set_exception(e)
+        finally:
+            self.closed = True
+            futs = list(self.pending.values())
+            self.pending.clear()
+            for fut in futs:
+                if not fut.done():
+                    fut.set_exception(SocketClosed())
+            if self.stream_queue is not None:
+                await self.stream_queue.put(None)
+
+    def submit_command(self, cmd):
+        if self.debug:
+            ln = json.dumps(cmd, default=_json_default)
+            print(">({}) {}".format(self.connid, ln))
+        self.writer.writelines(encode_json_line(cmd))
+
+    async def reqrsp_cmd(self, cmd):
+        if self.closed:
+            raise MessageError("connection is closed")
+        if self.streaming:
+            raise MessageError("cannot be called while connection is streaming")
+        fut = asyncio.get_event_loop().create_future()
+        corrid = next(self.corr_ids)
+        cmd = dict(cmd)
+        cmd[CORRELATION_KEY] = corrid
+        self.pending[corrid] = fut
+        self.submit_command(cmd)
+        try:
+            await self.writer.drain()
+        except OSError:
+            self.pending.pop(corrid, None)
+            raise SocketClosed()
+        return await fut
+
+    ###########
+    # Commands
+
+    async def ping(self):
+        result = await self.reqrsp_cmd({"Command": "Ping"})
+        return result["Ping"]
+
+    async def submit(self, req, storage=0):
+        cmd = {
+            "Command": "Submit",
+            "Request": encode_req(req),
+            "Storage": 0,
+        }
+        if storage is not None:
+            cmd["Storage"] = storage
+        result = await self.reqrsp_cmd(cmd)
+        if "SubmittedRequest" not in result:
+            raise MessageError("no request returned")
+        newreq = decode_req(result["SubmittedRequest"], storage=storage)
+        req.response = newreq.response
+        req.unmangled = newreq.unmangled
+        req.time_start_ns = newreq.time_start_ns
+        req.time_end_ns = newreq.time_end_ns
+        req.db_id = newreq.db_id
+        req.storage_id = storage
+
+    async def save_new(self, req, storage):
+        cmd = {
+            "Command": "SaveNew",
+            "Request": encode_req(req),
+            "Storage": storage,
+        }
+        result = await self.reqrsp_cmd(cmd)
+        req.db_id = result["DbId"]
+        req.storage_id = storage
+        return result["DbId"]
+
+    async def query_storage(self, q, storage, max_results=0, headers_only=False):
+        cmd = {
+            "Command": "StorageQuery",
+            "Query": q,
+            "HeadersOnly": headers_only,
+            "MaxResults": max_results,
+            "Storage": storage,
+        }
+        result = await self.reqrsp_cmd(cmd)
+        reqs = []
+        unmangled = set()
+        for reqd in result["Results"]:
+            req = decode_req(reqd, headers_only=headers_only, storage=storage)
+            reqs.append(req)
+            if req.unmangled is not None:
+                unmangled.add(req.unmangled.db_id)
+        return [r for r in reqs if r.db_id not in unmangled]
+
+    async def req_by_id(self, reqid, storage, headers_only=False):
+        results = await self.query_storage([[["dbid", "is", reqid]]], storage,
+                                           headers_only=headers_only, max_results=1)
+        if len(results) == 0:
+            raise MessageError("request with id {} does not exist".format(reqid))
+        return results[0]
+
+    async def check_request(self, query, req=None, storage_id=-1, db_id=""):
+        cmd = {
+            "Command": "checkrequest",
+            "Query": query,
+        }
+        if req:
+            cmd["Request"] = encode_req(req)
+        if db_id != "":
+            cmd["DbId"] = db_id
+            cmd["StorageId"] = storage_id
+        result = await self.reqrsp_cmd(cmd)
+        return result["Result"]
+
+    async def validate_query(self, query):
+        try:
+            await self.reqrsp_cmd({"Command": "ValidateQuery", "Query": query})
+        except MessageError as e:
+            raise InvalidQuery(str(e))
+
+    async def add_tag(self, reqid, tag, storage):
+        await self.reqrsp_cmd({"Command": "AddTag", "ReqId": reqid, "Tag": tag, "Storage": storage})
+
+    async def remove_tag(self, reqid, tag, storage):
+        await self.reqrsp_cmd({"Command": "RemoveTag", "ReqId": reqid, "Tag": tag, "Storage": storage})
+
+    async def clear_tag(self, reqid, storage):
+        await self.reqrsp_cmd({"Command": "ClearTag", "ReqId": reqid, "Storage": storage})
+
+    async def add_sqlite_storage(self, path, desc):
+        result = await self.reqrsp_cmd({"Command": "AddSQLiteStorage", "Path": path, "Description": desc})
+        return result["StorageId"]
+
+    async def add_in_memory_storage(self, desc):
+        result = await self.reqrsp_cmd({"Command": "AddInMemoryStorage", "Description": desc})
+        return result["StorageId"]
+
+    async def close_storage(self, storage_id):
+        await self.reqrsp_cmd({"Command": "CloseStorage", "StorageId": storage_id})
+
+    async def set_proxy_storage(self, storage_id):
+        await self.reqrsp_cmd({"Command": "SetProxyStorage", "StorageId": storage_id})
+
+    async def list_storage(self):
+        result = await self.reqrsp_cmd({"Command": "ListStorage"})
+        return [(ss["Id"], ss["Description"]) for ss in result["Storages"]]
+
+    async def _start_stream(self, cmd, maxsize=1000):
+        self.stream_queue = asyncio.Queue(maxsize=maxsize)
+        try:
+            await self.reqrsp_cmd(cmd)
+        except Exception:
+            self.stream_queue = None
+            raise
+        self.streaming = True
+
+    async def watch_storage(self, storage_id=-1, headers_only=True):
+        # Async generator that yields requests, responses and wsmessages as they
+        # are stored by the proxy. Use a dedicated connection for this.
+        cmd = {
+            "Command": "WatchStorage",
+            "StorageId": storage_id,
+            "HeadersOnly": headers_only,
+        }
+        await self._start_stream(cmd)
+        while True:
+            msg = await self.stream_queue.get()
+            if msg is None:
+                return
+            if msg["Request"]:
+                msg["Request"] = decode_req(msg["Request"],
+                                            storage=msg["StorageId"],
+                                            headers_only=headers_only)
+            if msg["Response"]:
+                msg["Response"] = decode_rsp(msg["Response"],
+                                             storage=msg["StorageId"],
+                                             headers_only=headers_only)
+            if msg["WSMessage"]:
+                msg["WSMessage"] = decode_ws(msg["WSMessage"],
+                                             storage=msg["StorageId"])
+            yield msg
+
+    async def intercept(self, macro):
+        # Run an intercepting macro until the connection closes. The mangle
+        # functions on the macro may be plain functions or coroutines. Each
+        # message is handled in its own task so a slow mangle doesn't hold up
+        # other messages.
+        cmd = {
+            "Command": "Intercept",
+            "InterceptRequests": macro.intercept_requests,
+            "InterceptResponses": macro.intercept_responses,
+            "InterceptWS": macro.intercept_ws,
+        }
+        query = getattr(macro, "intercept_query", None)
+        scope = None
+        if query:
+            # older backends ignore the query, see proxy.InterceptWorkers
+            cmd["Query"] = query
+            scope = CompiledQuery(query)
+        await self._start_stream(cmd)
+
+        tasks = set()
+        while True:
+            msg = await self.stream_queue.get()
+            if msg is None:
+                break
+            if scope is not None and not _in_scope(scope, msg):
+                if not self.closed:
+                    self.submit_command(_unmangled_reply(msg))
+                self.intercept_skipped += 1
+                continue
+            task = asyncio.ensure_future(self._mangle_and_respond(macro, msg))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _mangle_and_respond(self, macro, msg):
+        try:
+            retCmd = await self._mangle(macro, msg)
+        except Exception:
+            # don't leave the backend waiting on a message the macro failed on
+            traceback.print_exc()
+            retCmd = _unmangled_reply(msg)
+            self.intercept_errors += 1
+        if not self.closed:
+            self.submit_command(retCmd)
+            try:
+                await self.writer.drain()
+            except OSError:
+                pass
+
+    async def _mangle(self, macro, msg):
+        if msg["Type"] == "httprequest":
+            req = decode_req(msg["Request"])
+            newReq = await _maybe_await(macro.mangle_request(req))
+            if newReq is None:
+                retCmd = {"Id": msg["Id"], "Dropped": True}
+            else:
+                newReq.unmangled = None
+                newReq.response = None
+                newReq.ws_messages = []
+                retCmd = {"Id": msg["Id"], "Dropped": False, "Request": encode_req(newReq)}
+        elif msg["Type"] == "httpresponse":
+            req = decode_req(msg["Request"])
+            rsp = decode_rsp(msg["Response"])
+            newRsp = await _maybe_await(macro.mangle_response(req, rsp))
+            if newRsp is None:
+                retCmd = {"Id": msg["Id"], "Dropped": True}
+            else:
+                newRsp.unmangled = None
+                retCmd = {"Id": msg["Id"], "Dropped": False, "Response": encode_rsp(newRsp)}
+        elif msg["Type"] == "wstoserver" or msg["Type"] == "wstoclient":
+            req = decode_req(msg["Request"])
+            rsp = decode_rsp(msg["Response"])
+            wsm = decode_ws(msg["WSMessage"])
+            newWsm = await _maybe_await(macro.mangle_websocket(req, rsp, wsm))
+            if newWsm is None:
+                retCmd = {"Id": msg["Id"], "Dropped": True}
+            else:
+                newWsm.unmangled = None
+                retCmd = {"Id": msg["Id"], "Dropped": False, "WSMessage": encode_ws(newWsm)}
+        else:
+            raise Exception("Unknown message type: " + msg["Type"])
+        return retCmd
+
+
+def _in_scope(scope, msg):
+    req = decode_req(msg["Request"], lazy=True)
+    if msg.get("Response"):
+        req.response = decode_rsp(msg["Response"], lazy=True)
+    return scope.check(req) is not False
+
+
+class AsyncProxyClient:
+    # An asyncio version of proxy.ProxyClient for scripts and headless tools.
+    # Commands are spread over up to max_conns pipelined connections so
+    # thousands of concurrent operations can run on one thread.
+    #
+    #   async with AsyncProxyClient("unix:/path/to/sock") as client:
+    #       await client.submit(req)
+    #
+    # Like ProxyClient, requests are only saved once a storage has been given
+    # with set_proxy_storage or inmem_storage.
+
+    def __init__(self, addr, max_conns=4, debug=False):
+        self.ltype, self.laddr = addr.split(":", 1)
+        self.max_conns = max_conns
+        self.debug = debug
+        self.conns = []  # pipelined conns shared by commands
+        self.stream_conns = set()  # dedicated conns for watch/intercept
+        self.storage_by_id = {}
+        self.storage_by_prefix = {}
+        self.proxy_storage = None
+        self.inmem_storage = None
+        self.conn_lock = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def connect(self):
+        self.conn_lock = asyncio.Lock()
+        await self._get_storage()
+
+    async def close(self):
+        conns = self.conns + list(self.stream_conns)
+        self.conns = []
+        self.stream_conns = set()
+        for conn in conns:
+            await conn.close()
+
+    async def new_conn(self):
+        conn = AsyncProxyConnection()
+        conn.debug = self.debug
+        await conn.connect(self.ltype, self.laddr)
+        return conn
+
+    async def _conn(self):
+        # the open connection with the fewest commands in flight, opening a new
+        # one if they are all busy
+        async with self.conn_lock:
+            self.conns = [c for c in self.conns if not c.closed]
+            idle = [c for c in self.conns if c.n_pending == 0]
+            if len(idle) > 0:
+                return idle[0]
+            if len(self.conns) < self.max_conns:
+                conn = await self.new_conn()
+                self.conns.append(conn)
+                return conn
+            return min(self.conns, key=lambda c: c.n_pending)
+
+    # functions involving storage
+
+    async def _get_storage(self):
+        self.storage_by_id = {}
+        self.storage_by_prefix = {}
+        conn = await self._conn()
+        for storage_id, desc in await conn.list_storage():
+            stype, prefix = desc.split("|")
+            self._add_storage(ActiveStorage(stype, storage_id, prefix), prefix)
+
+    def _add_storage(self, storage, prefix):
+        self.storage_by_prefix[prefix] = storage
+        self.storage_by_id[storage.storage_id] = storage
+
+    def storage_iter(self):
+        for _, s in self.storage_by_id.items():
+            yield s
+
+    def _stg_or_def(self, storage):
+        if storage is None:
+            return self.proxy_storage
+        return storage
+
+    def _save_storage(self, storage, inmem):
+        # the storage a request is saved to, which has to have been set
+        if inmem:
+            storage = self.inmem_storage
+        else:
+            storage = self._stg_or_def(storage)
+        if storage is None:
+            raise ProxyException("no storage to save the request to")
+        return storage
+
+    async def add_sqlite_storage(self, path, prefix):
+        conn = await self._conn()
+        sid = await conn.add_sqlite_storage(path, _serialize_storage("sqlite", prefix))
+        s = ActiveStorage(type="sqlite", storage_id=sid, prefix=prefix)
+        self._add_storage(s, prefix)
+        return s
+
+    async def add_in_memory_storage(self, prefix):
+        conn = await self._conn()
+        sid = await conn.add_in_memory_storage(_serialize_storage("inmem", prefix))
+        s = ActiveStorage(type="inmem", storage_id=sid, prefix=prefix)
+        self._add_storage(s, prefix)
+        return s
+
+    async def close_storage(self, storage_id):
+        s = self.storage_by_id[storage_id]
+        await (await self._conn()).close_storage(s.storage_id)
+        del self.storage_by_id[s.storage_id]
+        del self.storage_by_prefix[s.prefix]
+        if self.proxy_storage == storage_id:
+            self.proxy_storage = None
+        if self.inmem_storage == storage_id:
+            self.inmem_storage = None
+
+    async def set_proxy_storage(self, storage_id):
+        s = self.storage_by_id[storage_id]
+        await (await self._conn()).set_proxy_storage(s.storage_id)
+        self.proxy_storage = storage_id
+
+    def set_storage_prefix(self, storage_id, prefix):
+        if prefix in self.storage_by_prefix:
+            raise ProxyException("prefix already exists")
+        s = self.storage_by_id[storage_id]
+        del self.storage_by_prefix[s.prefix]
+        news = ActiveStorage(type=s.type, prefix=prefix, storage_id=s.storage_id)
+        self._add_storage(news, prefix)
+
+    def get_reqid(self, req):
+        prefix = ""
+        if req.storage_id in self.storage_by_id:
+            prefix = self.storage_by_id[req.storage_id].prefix
+        return "{}{}".format(prefix, req.db_id)
+
+    def parse_reqid(self, reqid):
+        if reqid[0].isalpha():
+            prefix = reqid[0]
+            realid = reqid[1:]
+        else:
+            prefix = ""
+            realid = reqid
+        return self.storage_by_prefix[prefix], realid
+
+    # commands
+
+    async def ping(self):
+        return await (await self._conn()).ping()
+
+    async def submit(self, req, save=False, inmem=False, storage=None):
+        if save or inmem:
+            storage = self._save_storage(storage, inmem)
+        conn = await self._conn()
+        await conn.submit(req, storage=storage)
+
+    async def save_new(self, req, inmem=False, storage=None):
+        storage = self._save_storage(storage, inmem)
+        conn = await self._conn()
+        return await conn.save_new(req, storage=storage)
+
+    async def query_storage(self, q, max_results=0, headers_only=False, storage=None):
+        if storage is not None:
+            storage_ids = [storage]
+        else:
+            storage_ids = [s.storage_id for s in self.storage_iter()]
+
+        async def query_one(storage_id):
+            conn = await self._conn()
+            results = await conn.query_storage(q, storage_id, max_results=max_results,
+                                               headers_only=headers_only)
+            results.sort(key=_req_time_key, reverse=True)
+            return results
+
+        per_storage = await asyncio.gather(*[query_one(sid) for sid in storage_ids])
+        return list(merge_by_time(per_storage, max_results=max_results))
+
+    async def req_by_id(self, reqid, storage_id=None, headers_only=False):
+        if storage_id is None:
+            storage, db_id = self.parse_reqid(reqid)
+            storage_id = storage.storage_id
+        else:
+            db_id = reqid
+        conn = await self._conn()
+        return await conn.req_by_id(db_id, storage_id, headers_only=headers_only)
+
+    async def check_request(self, query, req=None, reqid=""):
+        conn = await self._conn()
+        if req is not None:
+            return await conn.check_request(query, req=req)
+        storage, db_id = self.parse_reqid(reqid)
+        return await conn.check_request(query, storage_id=storage.storage_id, db_id=db_id)
+
+    async def add_tag(self, reqid, tag, storage=None):
+        await (await self._conn()).add_tag(reqid, tag, self._stg_or_def(storage))
+
+    async def remove_tag(self, reqid, tag, storage=None):
+        await (await self._conn()).remove_tag(reqid, tag, self._stg_or_def(storage))
+
+    async def clear_tag(self, reqid, storage=None):
+        await (await self._conn()).clear_tag(reqid, self._stg_or_def(storage))
+
+    async def watch_storage(self, storage_id=-1, headers_only=True):
+        conn = await self.new_conn()
+        self.stream_conns.add(conn)
+        try:
+            async for msg in conn.watch_storage(storage_id=storage_id, headers_only=headers_only):
+                yield msg
+        finally:
+            self.stream_conns.discard(conn)
+            await conn.close()
+
+    async def intercept(self, macro):
+        # Runs the macro on a new connection until the backend closes it or the
+        # client is closed
+        conn = await self.new_conn()
+        self.stream_conns.add(conn)
+        try:
+            await conn.intercept(macro)
+        finally:
+            self.stream_conns.discard(conn)
+            await conn.close()
+
+
+class AsyncBridge(QObject):
+    # Runs an asyncio loop on a background thread so Qt code can hand it
+    # coroutines (for example AsyncProxyClient calls) and get the results back
+    # through a callback that runs on the GUI thread.
+
+    _resultReady = pyqtSignal(object, object)
+
+    def __init__(self):
+        QObject.__init__(self)
+        self.loop = asyncio.new_event_loop()
+        self._resultReady.connect(self._deliver)
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro, callback=None, errback=None):
+        # Schedule a coroutine on the loop. callback(result) or errback(exception)
+        # is called on the thread that owns the bridge. Returns a
+        # concurrent.futures.Future for callers that would rather block on it.
+        fut = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        def done(f):
+            if f.cancelled():
+                return
+            e = f.exception()
+            if e is not None:
+                if errback is not None:
+                    self._resultReady.emit(errback, e)
+            elif callback is not None:
+                self._resultReady.emit(callback, f.result())
+
+        fut.add_done_callback(done)
+        return fut
+
+    def call(self, coro, timeout=None):
+        # Run a coroutine and block until it finishes
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    @pyqtSlot(object, object)
+    def _deliver(self, func, value):
+        func(value)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
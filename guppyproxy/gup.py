@@ -65,7 +65,8 @@ def main():
 
     cert_dir = os.path.join(data_dir, "certs")
 
-    with ProxyClient(binary=binloc, conn_addr=msg_addr, debug=args.debug) as client:
+    log_path = os.path.join(data_dir, "puppy.log")
+    with ProxyClient(binary=binloc, conn_addr=msg_addr, debug=args.debug, log_path=log_path) as client:
         try:
             load_certificates(client, cert_dir)
         except MessageError as e:
@@ -141,6 +141,11 @@ class FileInterceptMacro(InterceptMacro, QObject):
         else:
             self.intercept_ws = False
 
+        if self.source and hasattr(self.source, 'intercept_query'):
+            self.intercept_query = self.source.intercept_query
+        else:
+            self.intercept_query = []
+
     def prompt_args(self):
         if not hasattr(self.source, "get_args"):
             self.used_args = {}
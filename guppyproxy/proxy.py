@@ -3,14 +3,22 @@
 import base64
 import copy
 import datetime
+import heapq
 import json
 import math
+import os
+import queue
 import re
 import socket
+import struct
 import threading
+import time
+import traceback
 
-from collections import namedtuple
-from itertools import count
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import count, islice
 from urllib.parse import urlparse, ParseResult, parse_qs, urlencode
 from subprocess import Popen, PIPE
 from http import cookies as hcookies
@@ -34,12 +42,27 @@ class SocketClosed(Exception):
 
 
 class SockBuffer:
-    # I can't believe I have to implement this
+    # Line framer for the message socket. Data is received directly into a
+    # reusable bytearray and lines are sliced out of it, so a huge reply is
+    # never rejoined from small chunks.
+
+    MIN_RECV = 64 * 1024
+    MAX_RECV = 4 * 1024 * 1024
+    SHRINK_SIZE = 16 * 1024 * 1024
+    SEND_BATCH = 4 * 1024 * 1024  # bytes gathered into one write
+    MAX_IOV = 512  # segments per sendmsg call, well under IOV_MAX
 
     def __init__(self, sock):
-        self.buf = []  # a list of chunks of strings
+        self.buf = bytearray(SockBuffer.MIN_RECV)
+        self.start = 0  # offset of the first unread byte
+        self.end = 0  # offset of the end of the received data
+        self.scanned = 0  # everything between start and scanned has no newline
+        self.recv_size = SockBuffer.MIN_RECV
         self.s = sock
         self.closed = False
+        self.bytes_sent = 0
+        self.send_calls = 0
+        self.send_secs = 0.0  # time spent blocked in writes
 
     def close(self):
         try:
@@ -51,36 +74,132 @@ class SockBuffer:
         finally:
             self.closed = True
 
-    def _check_newline(self):
-        for chunk in self.buf:
-            if '\n' in chunk:
-                return True
-        return False
-
-    def readline(self):
-        # Receive until we get a newline, raise SocketClosed if socket is closed
-        while True:
+    def _make_room(self):
+        # Make sure there is space for recv_size more bytes after self.end
+        if self.start > 0:
+            # move the unread data to the front of the buffer
+            unread = self.end - self.start
+            self.buf[:unread] = self.buf[self.start:self.end]
+            self.scanned -= self.start
+            self.end = unread
+            self.start = 0
+        needed = self.end + self.recv_size
+        if needed > len(self.buf):
+            newsize = max(len(self.buf) * 2, needed)
+            self.buf.extend(bytes(newsize - len(self.buf)))
+
+    def _fill(self):
+        # Receive more data into the buffer, raise SocketClosed if socket is closed
+        if self.end + self.recv_size > len(self.buf):
+            self._make_room()
+        with memoryview(self.buf) as mv:
             try:
-                data = self.s.recv(256)
+                n = self.s.recv_into(mv[self.end:self.end + self.recv_size])
             except OSError:
                 raise SocketClosed()
-            if not data:
-                raise SocketClosed()
-            self.buf.append(data)
-            if b'\n' in data:
+        if n == 0:
+            raise SocketClosed()
+        self.end += n
+        if n == self.recv_size and self.recv_size < SockBuffer.MAX_RECV:
+            # the sender is keeping up, read bigger chunks
+            self.recv_size *= 2
+        return n
+
+    def _consumed(self, offset):
+        self.start = offset
+        self.scanned = offset
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+            self.scanned = 0
+            if len(self.buf) > SockBuffer.SHRINK_SIZE:
+                # don't hold on to the memory used by a huge message
+                self.buf = bytearray(SockBuffer.MIN_RECV)
+                self.recv_size = SockBuffer.MIN_RECV
+
+    def readline_bytes(self):
+        # Receive until we get a newline and return the line without the newline
+        while True:
+            ind = self.buf.find(b'\n', self.scanned, self.end)
+            if ind >= 0:
                 break
+            self.scanned = self.end
+            self._fill()
+        with memoryview(self.buf) as mv:
+            line = bytes(mv[self.start:ind])
+        self._consumed(ind + 1)
+        return line
+
+    def readline(self):
+        return self.readline_bytes().decode()
 
-        # Combine chunks
-        allbytes = b''.join(self.buf)
-        head, tail = allbytes.split(b'\n', 1)
-        self.buf = [tail]
-        return head.decode()
+    def read_exact(self, n):
+        # Receive exactly n bytes
+        while self.end - self.start < n:
+            self._fill()
+        with memoryview(self.buf) as mv:
+            data = bytes(mv[self.start:self.start + n])
+        self._consumed(self.start + n)
+        return data
 
     def send(self, data):
+        self.send_parts((data,))
+
+    def send_parts(self, parts):
+        # Write a message made of several segments without joining them first.
+        # parts may be a generator, it is consumed one batch at a time so large
+        # bodies can be produced while they are being written
+        start = time.perf_counter()
+        batch = []
+        size = 0
         try:
-            self.s.send(data)
+            for p in parts:
+                if len(p) == 0:
+                    continue
+                batch.append(p)
+                size += len(p)
+                if size >= SockBuffer.SEND_BATCH or len(batch) >= SockBuffer.MAX_IOV:
+                    self._send_batch(batch)
+                    batch = []
+                    size = 0
+            if batch:
+                self._send_batch(batch)
         except OSError:
             raise SocketClosed()
+        finally:
+            self.send_secs += time.perf_counter() - start
+
+    def _send_batch(self, batch):
+        if not hasattr(self.s, "sendmsg"):
+            for p in batch:
+                self.s.sendall(p)
+                self.bytes_sent += len(p)
+                self.send_calls += 1
+            return
+        views = [memoryview(p) for p in batch]
+        i = 0
+        while i < len(views):
+            # sendmsg may write only part of the batch, drop what was written
+            # and try again with the rest
+            n = self.s.sendmsg(views[i:i + SockBuffer.MAX_IOV])
+            self.bytes_sent += n
+            self.send_calls += 1
+            while i < len(views) and n >= len(views[i]):
+                n -= len(views[i])
+                i += 1
+            if n > 0:
+                views[i] = views[i][n:]
+
+    def write_stats(self):
+        return _write_stats(self.bytes_sent, self.send_calls, self.send_secs)
+
+
+WriteStats = namedtuple("WriteStats", ["bytes_sent", "send_calls", "send_secs", "bytes_per_sec"])
+
+
+def _write_stats(bytes_sent, send_calls, send_secs):
+    rate = bytes_sent / send_secs if send_secs > 0 else 0.0
+    return WriteStats(bytes_sent, send_calls, send_secs, rate)
 
 
 class ProxyThread(QThread):
@@ -115,58 +234,84 @@ def clean_thread(tid):
     return clean
 
 class Headers:
+    # Case insensitive multidict of headers. Pairs are kept grouped under their
+    # lower case name in the order the names were first added, so lookups are a
+    # single dict access. Copies share their storage until one of them is
+    # modified, and the dict() form used when encoding messages is cached until
+    # the next modification.
+
+    __slots__ = ("_index", "_shared", "_dict_cache")
+
     def __init__(self, headers=None):
-        self.headers = {}
+        self._index = {}  # lower case name -> [(name, value), ...]
+        self._shared = False  # _index is also used by another Headers
+        self._dict_cache = None
         if headers is not None:
             if isinstance(headers, Headers):
-                for _, pairs in headers.headers.items():
-                    for k, v in pairs:
-                        self.add(k, v)
+                headers._shared = True
+                self._shared = True
+                self._index = headers._index
+                self._dict_cache = headers._dict_cache
             else:
                 for k, vs in headers.items():
                     for v in vs:
                         self.add(k, v)
 
+    def _will_modify(self):
+        if self._shared:
+            self._index = {lk: list(kvs) for lk, kvs in self._index.items()}
+            self._shared = False
+        self._dict_cache = None
+
     def __contains__(self, hd):
-        for k, _ in self.headers.items():
-            if k.lower() == hd.lower():
-                return True
-        return False
+        return hd.lower() in self._index
+
+    def copy(self):
+        return Headers(self)
 
     def add(self, k, v):
+        self._will_modify()
+        lk = k.lower()
         try:
-            lst = self.headers[k.lower()]
-            lst.append((k, v))
+            self._index[lk].append((k, v))
         except KeyError:
-            self.headers[k.lower()] = [(k, v)]
+            self._index[lk] = [(k, v)]
 
     def set(self, k, v):
-        self.headers[k.lower()] = [(k, v)]
+        self._will_modify()
+        self._index[k.lower()] = [(k, v)]
 
     def get(self, k):
-        return self.headers[k.lower()][0][1]
+        return self._index[k.lower()][0][1]
 
     def delete(self, k):
-        try:
-            del self.headers[k.lower()]
-        except KeyError:
-            pass
+        lk = k.lower()
+        if lk in self._index:
+            self._will_modify()
+            del self._index[lk]
 
     def pairs(self, key=None):
-        for _, kvs in self.headers.items():
-            for k, v in kvs:
-                if key is None or k.lower() == key.lower():
+        if key is None:
+            for kvs in self._index.values():
+                for k, v in kvs:
                     yield (k, v)
+        else:
+            for k, v in self._index.get(key.lower(), ()):
+                yield (k, v)
 
     def dict(self):
-        retdict = {}
-        for _, kvs in self.headers.items():
-            for k, v in kvs:
-                if k in retdict:
-                    retdict[k].append(v)
-                else:
-                    retdict[k] = [v]
-        return retdict
+        # {name: [values]}, the format used in messages. The returned dict is
+        # cached so it must not be modified.
+        if self._dict_cache is None:
+            retdict = {}
+            for kvs in self._index.values():
+                for k, v in kvs:
+                    if k in retdict:
+                        retdict[k].append(v)
+                    else:
+                        retdict[k] = [v]
+            self._dict_cache = retdict
+        return self._dict_cache
 
 
 class RequestContext:
@@ -281,6 +426,9 @@ class InterceptMacro:
         self.intercept_requests = False
         self.intercept_responses = False
         self.intercept_ws = False
+        # only messages whose request matches this query are intercepted, in
+        # the same format as the scope. Empty means every message
+        self.intercept_query = []
 
     def __repr__(self):
         return "<InterceptingMacro (%s)>" % self.name
@@ -295,14 +443,43 @@ class InterceptMacro:
         return message
 
 
+# Placeholder for a field of a lazily decoded message that hasn't been decoded
+# from the raw message yet
+_UNLOADED = object()
+
+
+def _raw_content_length(headers):
+    # Content-Length from undecoded headers so the list can show lengths
+    # without decoding every header
+    if not headers:
+        return None
+    for k, vs in headers.items():
+        if vs and k.lower() == "content-length":
+            return int(vs[0])
+    return None
+
+
 class HTTPRequest:
+    # Requests are kept in large numbers by the request list, so they use slots
+    # and avoid allocating anything they don't need. The URL is only parsed
+    # when it is used, times are stored as nanoseconds since the epoch and
+    # empty tags and websocket messages are stored as None until they are used.
+    __slots__ = ("_raw", "method", "_path", "_url", "proto_major", "proto_minor",
+                 "_headers", "headers_only", "_body", "dest_host", "dest_port",
+                 "use_tls", "time_start_ns", "time_end_ns", "_response",
+                 "_unmangled", "_ws_messages", "db_id", "storage_id", "_tags")
+
     def __init__(self, method="GET", path="/", proto_major=1, proto_minor=1,
                  headers=None, body=bytes(), dest_host="", dest_port=80,
                  use_tls=False, time_start=None, time_end=None, db_id="",
                  tags=None, headers_only=False, storage_id=0):
+        # raw message that lazy fields are decoded from
+        self._raw = None
+
         # http info
         self.method = method
-        self.url = URL(path)
+        self._path = path
+        self._url = None
         self.proto_major = proto_major
         self.proto_minor = proto_minor
 
@@ -317,22 +494,124 @@ class HTTPRequest:
         self.dest_host = dest_host
         self.dest_port = dest_port
         self.use_tls = use_tls
-        self.time_start = time_start
-        self.time_end = time_end
+        self.time_start_ns = time_to_nsecs(time_start)
+        self.time_end_ns = time_to_nsecs(time_end)
 
         self.response = None
         self.unmangled = None
-        self.ws_messages = []
+        self._ws_messages = None
 
         self.db_id = db_id
         self.storage_id = storage_id
-        if tags is not None:
-            self.tags = set(tags)
-        else:
-            self.tags = set()
+        self._tags = set(tags) if tags else None
+
+    @property
+    def url(self):
+        if self._url is None:
+            self._url = URL(self._path)
+        return self._url
+
+    @url.setter
+    def url(self, url):
+        self._url = url
+
+    def path_str(self):
+        # the full path without parsing it if it hasn't been used as a URL
+        if self._url is None:
+            return self._path
+        return self._url.geturl()
+
+    @property
+    def time_start(self):
+        if self.time_start_ns is None:
+            return None
+        return time_from_nsecs(self.time_start_ns)
+
+    @time_start.setter
+    def time_start(self, t):
+        self.time_start_ns = time_to_nsecs(t)
+
+    @property
+    def time_end(self):
+        if self.time_end_ns is None:
+            return None
+        return time_from_nsecs(self.time_end_ns)
+
+    @time_end.setter
+    def time_end(self, t):
+        self.time_end_ns = time_to_nsecs(t)
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = set()
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
+
+    def sorted_tags(self):
+        if not self._tags:
+            return []
+        return sorted(self._tags)
+
+    # Lazily decoded fields. When a request is decoded with lazy=True these
+    # start out as _UNLOADED and are decoded from self._raw on first access.
+
+    @property
+    def headers(self):
+        if self._headers is _UNLOADED:
+            self._headers = Headers(self._raw["Headers"])
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
+    @property
+    def response(self):
+        if self._response is _UNLOADED:
+            self._response = None
+            if "Response" in self._raw:
+                self._response = decode_rsp(self._raw["Response"], headers_only=self.headers_only,
+                                            storage=self.storage_id, lazy=True)
+        return self._response
+
+    @response.setter
+    def response(self, rsp):
+        self._response = rsp
+
+    @property
+    def unmangled(self):
+        if self._unmangled is _UNLOADED:
+            self._unmangled = None
+            if "Unmangled" in self._raw:
+                self._unmangled = decode_req(self._raw["Unmangled"], headers_only=self.headers_only,
+                                             storage=self.storage_id, lazy=True)
+        return self._unmangled
+
+    @unmangled.setter
+    def unmangled(self, req):
+        self._unmangled = req
+
+    @property
+    def ws_messages(self):
+        if self._ws_messages is None:
+            self._ws_messages = []
+        elif self._ws_messages is _UNLOADED:
+            self._ws_messages = [decode_ws(wsm, storage=self.storage_id)
+                                 for wsm in self._raw.get("WSMessages") or []]
+        return self._ws_messages
+
+    @ws_messages.setter
+    def ws_messages(self, msgs):
+        self._ws_messages = msgs
 
     @property
     def body(self):
+        if self._body is _UNLOADED:
+            self.body = _decode_body(self._raw["Body"])
         return self._body
 
     @body.setter
@@ -348,13 +627,17 @@ class HTTPRequest:
 
     @property
     def content_length(self):
-        if 'content-length' in self.headers:
+        if self._headers is _UNLOADED:
+            n = _raw_content_length(self._raw["Headers"])
+            if n is not None:
+                return n
+        elif 'content-length' in self.headers:
             return int(self.headers.get('content-length'))
         return len(self.body)
 
     def status_line(self):
         sline = "{method} {path} HTTP/{proto_major}.{proto_minor}".format(
-            method=self.method, path=self.url.geturl(), proto_major=self.proto_major,
+            method=self.method, path=self.path_str(), proto_major=self.proto_major,
             proto_minor=self.proto_minor).encode()
         return sline
 
@@ -480,7 +763,7 @@ class HTTPRequest:
     def copy(self):
         return HTTPRequest(
             method=self.method,
-            path=self.url.geturl(),
+            path=self.path_str(),
             proto_major=self.proto_major,
             proto_minor=self.proto_minor,
             headers=self.headers,
@@ -488,24 +771,26 @@ class HTTPRequest:
             dest_host=self.dest_host,
             dest_port=self.dest_port,
             use_tls=self.use_tls,
-            tags=copy.deepcopy(self.tags),
+            tags=self._tags,
             headers_only=self.headers_only,
         )
 
 
 class HTTPResponse:
+    __slots__ = ("_raw", "status_code", "reason", "proto_major", "proto_minor",
+                 "_headers", "headers_only", "_body", "_unmangled", "db_id", "storage")
+
     def __init__(self, status_code=200, reason="OK", proto_major=1, proto_minor=1,
                  headers=None, body=bytes(), db_id="", headers_only=False, storage_id=0):
+        # raw message that lazy fields are decoded from
+        self._raw = None
+
         self.status_code = status_code
         self.reason = reason
         self.proto_major = proto_major
         self.proto_minor = proto_minor
 
-        self.headers = Headers()
-        if headers is not None:
-            for k, vs in headers.items():
-                for v in vs:
-                    self.headers.add(k, v)
+        self.headers = Headers(headers)
 
         self.headers_only = headers_only
         self._body = bytes()
@@ -516,8 +801,35 @@ class HTTPResponse:
         self.db_id = db_id
         self.storage = storage_id
 
+    # Lazily decoded fields, see HTTPRequest
+
+    @property
+    def headers(self):
+        if self._headers is _UNLOADED:
+            self._headers = Headers(self._raw["Headers"])
+        return self._headers
+
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+
+    @property
+    def unmangled(self):
+        if self._unmangled is _UNLOADED:
+            self._unmangled = None
+            if "Unmangled" in self._raw:
+                self._unmangled = decode_rsp(self._raw["Unmangled"], headers_only=self.headers_only,
+                                             storage=self.storage, lazy=True)
+        return self._unmangled
+
+    @unmangled.setter
+    def unmangled(self, rsp):
+        self._unmangled = rsp
+
     @property
     def body(self):
+        if self._body is _UNLOADED:
+            self.body = _decode_body(self._raw["Body"])
         return self._body
 
     @body.setter
@@ -533,7 +845,11 @@ class HTTPResponse:
 
     @property
     def content_length(self):
-        if 'content-length' in self.headers:
+        if self._headers is _UNLOADED:
+            n = _raw_content_length(self._raw["Headers"])
+            if n is not None:
+                return n
+        elif 'content-length' in self.headers:
             return int(self.headers.get('content-length'))
         return len(self.body)
 
@@ -596,24 +912,35 @@ class HTTPResponse:
             reason=self.reason,
             proto_major=self.proto_major,
             proto_minor=self.proto_minor,
-            headers=self.headers.headers,
+            headers=self.headers,
             body=self.body,
             headers_only=self.headers_only,
         )
 
 
 class WSMessage:
+    __slots__ = ("is_binary", "message", "to_server", "timestamp_ns", "unmangled",
+                 "db_id", "storage")
+
     def __init__(self, is_binary=True, message=bytes(), to_server=True,
                  timestamp=None, db_id="", storage_id=0):
         self.is_binary = is_binary
         self.message = message
         self.to_server = to_server
-        self.timestamp = timestamp or datetime.datetime(1970, 1, 1)
+        self.timestamp_ns = time_to_nsecs(timestamp) or 0
 
         self.unmangled = None
         self.db_id = db_id
         self.storage = storage_id
 
+    @property
+    def timestamp(self):
+        return time_from_nsecs(self.timestamp_ns)
+
+    @timestamp.setter
+    def timestamp(self, t):
+        self.timestamp_ns = time_to_nsecs(t) or 0
+
     def copy(self):
         return WSMessage(
             is_binary=self.is_binary,
@@ -627,6 +954,140 @@ ListenerResult = namedtuple("ListenerResult", ["lid", "addr"])
 GenPemCertsResult = namedtuple("GenPemCertsResult", ["key_pem", "cert_pem"])
 SavedQuery = namedtuple("SavedQuery", ["name", "query"])
 SavedStorage = namedtuple("SavedStorage", ["storage_id", "description"])
+# next_offset is None after the last page. paged is False if the backend
+# ignored the offset and returned its results without paging them
+StoragePage = namedtuple("StoragePage", ["requests", "next_offset", "paged"])
+
+
+def iter_pages(get_page, page_size=200, max_results=0, paged=None):
+    # Yields the requests of the pages returned by get_page(offset, limit),
+    # leaving out unmangled versions. This assumes the backend returns the
+    # newest requests first so a mangled request comes before its original.
+    # paged is False if the backend is known to ignore offsets, everything is
+    # then asked for in one reply straight away.
+    unmangled = set()
+    offset = 0
+    n_results = 0
+    while True:
+        limit = page_size
+        if max_results > 0:
+            limit = min(page_size, max_results - n_results)
+        if paged is False:
+            limit = max_results
+        page = get_page(offset, limit)
+        if not page.paged and len(page.requests) >= limit and limit != max_results:
+            # the backend can't page, so get everything in one reply instead
+            page = get_page(0, max_results)
+        n_results += len(page.requests)
+
+        for req in page.requests:
+            if req.unmangled is not None:
+                unmangled.add(req.unmangled.db_id)
+        for req in page.requests:
+            if req.db_id not in unmangled:
+                yield req
+
+        if not page.paged or page.next_offset is None:
+            return
+        if max_results > 0 and n_results >= max_results:
+            return
+        offset = page.next_offset
+
+
+# Key added to commands on a pipelined connection so the reply can be matched
+# to the call that is waiting for it
+CORRELATION_KEY = "CorrelationId"
+
+# Message framings. With json, every message is a line of JSON and message
+# bodies are base64 strings. With binary, a message is a length-prefixed JSON
+# header followed by the raw bytes of each body:
+#   u32 header length, u32 blob count, u64 length of each blob, header, blobs
+# and each body in the header is replaced with {"$blob": <index of blob>}.
+# References are only looked for in the fields that hold bodies.
+FRAMING_JSON = "json"
+FRAMING_BINARY = "binary-v1"
+_frame_prefix = struct.Struct(">II")
+_blob_len = struct.Struct(">Q")
+_blob_fields = ("Body", "Message")
+
+
+def _json_default(o):
+    # bytes (message bodies) are sent as base64 in JSON framing
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return base64.b64encode(o).decode()
+    raise TypeError("{} is not JSON serializable".format(type(o)))
+
+
+_blob_ref_re = re.compile(r'\{"\$blob": (\d+)\}')
+_B64_CHUNK = 3 * 256 * 1024  # a multiple of 3 so the chunks can be encoded separately
+
+
+def _b64_chunks(data):
+    with memoryview(data) as mv:
+        for i in range(0, len(mv), _B64_CHUNK):
+            yield base64.b64encode(mv[i:i + _B64_CHUNK])
+
+
+def encode_json_line(msg):
+    # Yields the segments of a JSON line. Bodies are base64 encoded a chunk at
+    # a time as the segments are written instead of building the whole line
+    blobs = []
+
+    def blob_ref(o):
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            blobs.append(o)
+            return {"$blob": len(blobs) - 1}
+        raise TypeError("{} is not JSON serializable".format(type(o)))
+
+    # a blob reference can't appear inside a JSON string since its quotes
+    # would be escaped, so it is safe to split the header on them
+    header = json.dumps(msg, default=blob_ref)
+    pos = 0
+    for m in _blob_ref_re.finditer(header):
+        yield header[pos:m.start()].encode() + b'"'
+        yield from _b64_chunks(blobs[int(m.group(1))])
+        yield b'"'
+        pos = m.end()
+    yield header[pos:].encode() + b"\n"
+
+
+def encode_binary_frame(msg):
+    blobs = []
+
+    def blob_ref(o):
+        if isinstance(o, (bytes, bytearray, memoryview)):
+            blobs.append(o)
+            return {"$blob": len(blobs) - 1}
+        raise TypeError("{} is not JSON serializable".format(type(o)))
+
+    header = json.dumps(msg, default=blob_ref).encode()
+    parts = [_frame_prefix.pack(len(header), len(blobs))]
+    parts += [_blob_len.pack(len(b)) for b in blobs]
+    parts.append(header)
+    parts += blobs
+    return parts
+
+
+def read_binary_frame(sbuf):
+    header_len, n_blobs = _frame_prefix.unpack(sbuf.read_exact(_frame_prefix.size))
+    blob_lens = [_blob_len.unpack(sbuf.read_exact(_blob_len.size))[0] for _ in range(n_blobs)]
+    header = sbuf.read_exact(header_len)
+    blobs = [sbuf.read_exact(n) for n in blob_lens]
+
+    def resolve_blobs(d):
+        # replaces references in the body fields of d. Any other object with a
+        # "$blob" key, like a header with that name, is left alone.
+        for field in _blob_fields:
+            ref = d.get(field)
+            if type(ref) is dict and len(ref) == 1:
+                i = ref.get("$blob")
+                if type(i) is int and 0 <= i < n_blobs:
+                    d[field] = blobs[i]
+        return d
+
+    if n_blobs == 0:
+        return header, json.loads(header)
+    return header, json.loads(header, object_hook=resolve_blobs)
 
 
 def messagingFunction(func):
@@ -635,11 +1096,24 @@ def messagingFunction(func):
             raise MessageError("cannot be called while other message is interactive")
         if self.closed:
             raise MessageError("connection is closed")
+        if self.pipelined:
+            # replies are matched up by the reader thread, no need to hold the
+            # connection for the whole round trip
+            return func(self, *args, **kwargs)
         with self.message_lock:
             return func(self, *args, **kwargs)
     return f
 
 
+def streamingFunction(func):
+    # For commands that take over the connection after they are sent
+    def f(self, *args, **kwargs):
+        if self.pipelined:
+            raise MessageError("cannot stream messages over a pipelined connection")
+        return func(self, *args, **kwargs)
+    return f
+
+
 class ProxyConnection:
     next_id = 1
 
@@ -656,6 +1130,18 @@ class ProxyConnection:
         self.kind = None
         self.addr = None
         self.int_thread = None
+        self.int_workers = None
+
+        # pipelined mode
+        self.pipelined = False
+        self.write_lock = threading.Lock()
+        self.pending_lock = threading.Lock()
+        self.pending = OrderedDict()  # correlation id -> Future, in send order
+        self.corr_ids = count(1)
+        self.reader_thread = None
+        self.reader_done = False
+
+        self.framing = FRAMING_JSON
 
         if kind.lower() == "tcp":
             tcpaddr, port = addr.rsplit(":", 1)
@@ -701,33 +1187,172 @@ class ProxyConnection:
                 pass
         self.closed = True
 
-    def read_message(self):
+    def _read_json(self):
+        if self.framing == FRAMING_BINARY:
+            header, j = read_binary_frame(self.sbuf)
+            if self.debug:
+                print("<({}) {}".format(self.connid, header.decode()))
+            return j
         ln = self.sbuf.readline()
         if self.debug:
             print("<({}) {}".format(self.connid, ln))
-        j = json.loads(ln)
+        return json.loads(ln)
+
+    def _check_reply(self, j):
         if ("Success" in j) and (j["Success"] is False):
             if "Reason" in j:
                 raise MessageError(j["Reason"])
             raise MessageError("unknown error")
         return j
 
+    def read_message(self):
+        return self._check_reply(self._read_json())
+
     def submit_command(self, cmd):
-        ln = json.dumps(cmd).encode() + b"\n"
+        if self.framing == FRAMING_BINARY:
+            parts = encode_binary_frame(cmd)
+            if self.debug:
+                header_len, n_blobs = _frame_prefix.unpack(parts[0])
+                print(">({}) {}".format(self.connid, parts[n_blobs + 1].decode()))
+            self.sbuf.send_parts(parts)
+            return
         if self.debug:
-            print(">({}) {}".format(self.connid, ln.decode()[:-1]))
-        self.sbuf.send(ln)
+            ln = json.dumps(cmd, default=_json_default)
+            print(">({}) {}".format(self.connid, ln))
+        self.sbuf.send_parts(encode_json_line(cmd))
+
+    def write_stats(self):
+        return self.sbuf.write_stats()
 
     def reqrsp_cmd(self, cmd):
+        if self.pipelined:
+            return self.reqrsp_cmd_future(cmd).result()
         self.submit_command(cmd)
         ret = self.read_message()
         if ret is None:
             raise Exception()
         return ret
 
+    def reqrsp_cmds(self, cmds, window=500):
+        # Send many commands and return their replies in order. Up to `window`
+        # commands are sent before waiting on a reply so a batch costs a few
+        # round trips rather than one per command.
+        replies = []
+        if self.pipelined:
+            in_flight = deque()
+            for cmd in cmds:
+                if len(in_flight) >= window:
+                    replies.append(in_flight.popleft().result())
+                in_flight.append(self.reqrsp_cmd_future(cmd))
+            replies += [fut.result() for fut in in_flight]
+            return replies
+        cmds = list(cmds)
+        for i in range(0, len(cmds), window):
+            chunk = cmds[i:i + window]
+            for cmd in chunk:
+                self.submit_command(cmd)
+            err = None
+            for _ in chunk:
+                # read every reply even after an error so the next command
+                # doesn't get a stale reply
+                try:
+                    replies.append(self.read_message())
+                except MessageError as e:
+                    err = err or e
+            if err is not None:
+                raise err
+        return replies
+
+    # Pipelined mode
+
+    def start_pipelining(self):
+        # Let many commands be in flight at once. Every command is tagged with a
+        # correlation id and a single reader thread hands each reply to the
+        # future of the call waiting on it. Backends that don't echo the id
+        # answer in order, so untagged replies go to the oldest pending call.
+        with self.message_lock:
+            if self.pipelined:
+                return
+            self.pipelined = True
+            self.reader_thread = threading.Thread(target=self._read_replies, daemon=True)
+            self.reader_thread.start()
+
+    def reqrsp_cmd_future(self, cmd):
+        # Send a command on a pipelined connection and return a Future for the reply
+        if not self.pipelined:
+            raise MessageError("connection is not pipelined")
+        fut = Future()
+        corrid = next(self.corr_ids)
+        cmd = dict(cmd)
+        cmd[CORRELATION_KEY] = corrid
+        with self.write_lock:
+            # registering and sending under one lock keeps pending in send order
+            with self.pending_lock:
+                if self.reader_done:
+                    raise SocketClosed()
+                self.pending[corrid] = fut
+            try:
+                self.submit_command(cmd)
+            except SocketClosed:
+                with self.pending_lock:
+                    self.pending.pop(corrid, None)
+                raise
+        return fut
+
+    def _read_replies(self):
+        err = None
+        try:
+            while True:
+                j = self._read_json()
+                corrid = j.pop(CORRELATION_KEY, None)
+                with self.pending_lock:
+                    if corrid in self.pending:
+                        fut = self.pending.pop(corrid)
+                    elif len(self.pending) > 0:
+                        _, fut = self.pending.popitem(last=False)
+                    else:
+                        continue
+                try:
+                    fut.set_result(self._check_reply(j))
+                except MessageError as e:
+                    fut.set_exception(e)
+        except SocketClosed:
+            pass
+        except Exception as e:
+            # after a reply that can't be read nothing else on the connection
+            # can be matched up, so give up on it
+            err = MessageError("could not read reply: {}".format(e))
+            self.close()
+
+        # the connection is gone, fail everything that is still waiting
+        with self.pending_lock:
+            self.reader_done = True
+            futs = list(self.pending.values())
+            self.pending.clear()
+        for fut in futs:
+            fut.set_exception(err or SocketClosed())
+
     ###########
     # Commands
 
+    @messagingFunction
+    def negotiate_framing(self):
+        # Ask the backend to switch to binary framing. Backends that don't know
+        # the command reply with an error and we stay on JSON lines.
+        if self.pipelined:
+            raise MessageError("framing must be negotiated before pipelining")
+        cmd = {
+            "Command": "Capabilities",
+            "Framing": [FRAMING_BINARY, FRAMING_JSON],
+        }
+        try:
+            result = self.reqrsp_cmd(cmd)
+        except MessageError:
+            return self.framing
+        if result.get("Framing") == FRAMING_BINARY:
+            self.framing = FRAMING_BINARY
+        return self.framing
+
     @messagingFunction
     def ping(self):
         cmd = {"Command": "Ping"}
@@ -749,8 +1374,8 @@ class ProxyConnection:
         newreq = decode_req(result["SubmittedRequest"], storage=storage)
         req.response = newreq.response
         req.unmangled = newreq.unmangled
-        req.time_start = newreq.time_start
-        req.time_end = newreq.time_end
+        req.time_start_ns = newreq.time_start_ns
+        req.time_end_ns = newreq.time_end_ns
         req.db_id = newreq.db_id
 
         req.storage_id = storage
@@ -779,8 +1404,7 @@ class ProxyConnection:
         reqs = []
         unmangled = set()
         for reqd in result["Results"]:
-            req = decode_req(reqd, headers_only=headers_only, storage=storage)
-            req.storage_id = storage
+            req = decode_req(reqd, headers_only=headers_only, storage=storage, lazy=True)
             reqs.append(req)
             if req.unmangled is not None:
                 unmangled.add(req.unmangled.db_id)
@@ -790,6 +1414,51 @@ class ProxyConnection:
     def query_storage(self, q, storage, max_results=0, headers_only=False):
         return self._query_storage(q, storage, headers_only=headers_only, max_results=max_results)
 
+    @messagingFunction
+    def query_storage_page(self, q, storage, offset=0, limit=0, headers_only=False):
+        # Get up to `limit` results starting at `offset`. Unmangled versions are
+        # not removed, that is up to the caller.
+        cmd = {
+            "Command": "StorageQuery",
+            "Query": q,
+            "HeadersOnly": headers_only,
+            "MaxResults": limit,
+            "Offset": offset,
+            "Storage": storage,
+        }
+        result = self.reqrsp_cmd(cmd)
+        reqs = [decode_req(reqd, headers_only=headers_only, storage=storage, lazy=True)
+                for reqd in result["Results"]]
+        if "NextOffset" not in result:
+            return StoragePage(reqs, None, False)
+        next_offset = result["NextOffset"]
+        if next_offset <= offset or len(reqs) == 0:
+            next_offset = None
+        return StoragePage(reqs, next_offset, True)
+
+    @messagingFunction
+    def count_storage(self, q, storage):
+        # Number of requests matching a query, unmangled versions included.
+        # Raises MessageError if the backend can't count.
+        cmd = {
+            "Command": "StorageCount",
+            "Query": q,
+            "Storage": storage,
+        }
+        result = self.reqrsp_cmd(cmd)
+        if "Count" not in result:
+            raise MessageError("backend did not return a count")
+        return result["Count"]
+
+    def query_storage_iter(self, q, storage, page_size=200, headers_only=False, max_results=0):
+        # Generator that yields the results of a query one page at a time so that
+        # only one page is held in memory. Like query_storage, unmangled
+        # versions of requests are left out.
+        def get_page(offset, limit):
+            return self.query_storage_page(q, storage, offset=offset, limit=limit,
+                                           headers_only=headers_only)
+        return iter_pages(get_page, page_size=page_size, max_results=max_results)
+
     @messagingFunction
     def req_by_id(self, reqid, storage, headers_only=False):
         results = self._query_storage([[["dbid", "is", reqid]]], storage,
@@ -798,6 +1467,22 @@ class ProxyConnection:
             raise MessageError("request with id {} does not exist".format(reqid))
         return results[0]
 
+    @messagingFunction
+    def reqs_by_ids(self, db_ids, storage, headers_only=False):
+        # Get every request in db_ids with a single query. Results are in no
+        # particular order and unmangled versions are not removed since they
+        # may have been asked for.
+        cmd = {
+            "Command": "StorageQuery",
+            "Query": [[["dbid", "is", db_id] for db_id in db_ids]],
+            "HeadersOnly": headers_only,
+            "MaxResults": 0,
+            "Storage": storage,
+        }
+        result = self.reqrsp_cmd(cmd)
+        return [decode_req(reqd, headers_only=headers_only, storage=storage, lazy=True)
+                for reqd in result["Results"]]
+
     @messagingFunction
     def set_scope(self, filt):
         cmd = {
@@ -844,6 +1529,23 @@ class ProxyConnection:
         }
         self.reqrsp_cmd(cmd)
 
+    # Bulk versions of the tag commands. ids is a list of (db_id, storage) pairs
+
+    @messagingFunction
+    def add_tags_bulk(self, ids, tags):
+        self.reqrsp_cmds({"Command": "AddTag", "ReqId": db_id, "Tag": tag, "Storage": storage}
+                         for db_id, storage in ids for tag in tags)
+
+    @messagingFunction
+    def remove_tags_bulk(self, ids, tags):
+        self.reqrsp_cmds({"Command": "RemoveTag", "ReqId": db_id, "Tag": tag, "Storage": storage}
+                         for db_id, storage in ids for tag in tags)
+
+    @messagingFunction
+    def clear_tags_bulk(self, ids):
+        self.reqrsp_cmds({"Command": "ClearTag", "ReqId": db_id, "Storage": storage}
+                         for db_id, storage in ids)
+
     @messagingFunction
     def all_saved_queries(self, storage):
         cmd = {
@@ -1051,9 +1753,14 @@ class ProxyConnection:
         }
         self.reqrsp_cmd(cmd)
 
+    @streamingFunction
     @messagingFunction
-    def intercept(self, macro):
-        # Run an intercepting macro until closed
+    def intercept(self, macro, workers=4, queue_size=64, ordered_ws=True):
+        # Run an intercepting macro until closed. Messages are mangled by a
+        # fixed number of workers, each with a bounded queue. When the queues
+        # are full the connection stops being read so the backend waits. With
+        # ordered_ws, websocket messages on the same connection always go to
+        # the same worker so they are answered in the order they arrived.
 
         # Start intercepting
         self.is_interactive = True
@@ -1063,98 +1770,39 @@ class ProxyConnection:
             "InterceptResponses": macro.intercept_responses,
             "InterceptWS": macro.intercept_ws,
         }
+        if macro.intercept_query:
+            cmd["Query"] = macro.intercept_query
         try:
             self.reqrsp_cmd(cmd)
         except Exception as e:
             self.is_interactive = False
             raise e
 
-        def run_macro():
-            iditer = count()
-            threads = {}
-            while True:
-                try:
-                    msg = self.read_message()
-                except MessageError as e:
-                    return
-                except SocketClosed:
-                    return
+        self.int_workers = InterceptWorkers(self, macro, workers=workers,
+                                            queue_size=queue_size, ordered_ws=ordered_ws)
 
-                def mangle_and_respond(msg):
-                    retCmd = None
-                    if msg["Type"] == "httprequest":
-                        req = decode_req(msg["Request"])
-                        newReq = macro.mangle_request(req)
-
-                        if newReq is None:
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": True,
-                            }
-                        else:
-                            newReq.unmangled = None
-                            newReq.response = None
-                            newReq.ws_messages = []
-
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": False,
-                                "Request": encode_req(newReq),
-                            }
-                    elif msg["Type"] == "httpresponse":
-                        req = decode_req(msg["Request"])
-                        rsp = decode_rsp(msg["Response"])
-                        newRsp = macro.mangle_response(req, rsp)
-
-                        if newRsp is None:
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": True,
-                            }
-                        else:
-                            newRsp.unmangled = None
-
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": False,
-                                "Response": encode_rsp(newRsp),
-                            }
-                    elif msg["Type"] == "wstoserver" or msg["Type"] == "wstoclient":
-                        req = decode_req(msg["Request"])
-                        rsp = decode_rsp(msg["Response"])
-                        wsm = decode_ws(msg["WSMessage"])
-                        newWsm = macro.mangle_websocket(req, rsp, wsm)
-
-                        if newWsm is None:
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": True,
-                            }
-                        else:
-                            newWsm.unmangled = None
-
-                            retCmd = {
-                                "Id": msg["Id"],
-                                "Dropped": False,
-                                "WSMessage": encode_ws(newWsm),
-                            }
-                    else:
-                        raise Exception("Unknown message type: " + msg["Type"])
-                    if retCmd is not None:
-                        try:
-                            self.submit_command(retCmd)
-                        except SocketClosed:
-                            return
-
-                tid = next(iditer)
-                mangle_thread = ProxyThread(target=mangle_and_respond,
-                                            args=(msg,))
-                threads[tid] = mangle_thread
-                mangle_thread.start()
+        def run_macro():
+            try:
+                while True:
+                    try:
+                        msg = self.read_message()
+                    except MessageError as e:
+                        return
+                    except SocketClosed:
+                        return
+                    self.int_workers.put(msg)
+            finally:
+                self.int_workers.stop()
 
         self.int_thread = ProxyThread(target=run_macro)
         self.int_thread.start()
 
+    def intercept_stats(self):
+        if self.int_workers is None:
+            return None
+        return self.int_workers.stats()
+
+    @streamingFunction
     @messagingFunction
     def watch_storage(self, storage_id=-1, headers_only=True):
         # Generator that generates request, response, and wsmessages as they
@@ -1170,21 +1818,33 @@ class ProxyConnection:
             self.is_interactive = False
             raise e
 
-        while True:
-            msg = self.read_message()
-            if msg["Request"]:
-                msg["Request"] = decode_req(msg["Request"],
-                                            storage=msg["StorageId"],
-                                            headers_only=headers_only)
-            if msg["Response"]:
-                msg["Response"] = decode_rsp(msg["Response"],
-                                             storage=msg["StorageId"],
-                                             headers_only=headers_only)
-            if msg["WSMessage"]:
-                msg["WSMessage"] = decode_ws(msg["WSMessage"],
-                                             storage=msg["StorageId"],
-                                             headers_only=headers_only)
-            yield msg
+        cache = None
+        if self.parent_client is not None and storage_id == -1:
+            # the client caches requests while it hears about every change
+            cache = self.parent_client.req_cache
+            cache.watch_started()
+        try:
+            while True:
+                msg = self.read_message()
+                if msg["Request"]:
+                    msg["Request"] = decode_req(msg["Request"],
+                                                storage=msg["StorageId"],
+                                                headers_only=headers_only,
+                                                lazy=True)
+                if msg["Response"]:
+                    msg["Response"] = decode_rsp(msg["Response"],
+                                                 storage=msg["StorageId"],
+                                                 headers_only=headers_only,
+                                                 lazy=True)
+                if msg["WSMessage"]:
+                    msg["WSMessage"] = decode_ws(msg["WSMessage"],
+                                                 storage=msg["StorageId"])
+                if self.parent_client is not None:
+                    self.parent_client._storage_event(msg)
+                yield msg
+        finally:
+            if cache is not None:
+                cache.watch_stopped()
 
     @messagingFunction
     def set_plugin_value(self, key, value, storage_id):
@@ -1207,6 +1867,785 @@ class ProxyConnection:
         return result["Value"]
 
 
+InterceptStats = namedtuple("InterceptStats", ["handled", "skipped", "errors", "queue_depth",
+                                               "max_queue_depth", "mean_latency",
+                                               "max_latency", "mean_mangle", "max_mangle"])
+
+
+def _mangle_intercepted(macro, msg):
+    # Run the macro on an intercepted message and return the reply to send
+    if msg["Type"] == "httprequest":
+        req = decode_req(msg["Request"])
+        newReq = macro.mangle_request(req)
+
+        if newReq is None:
+            return {
+                "Id": msg["Id"],
+                "Dropped": True,
+            }
+        newReq.unmangled = None
+        newReq.response = None
+        newReq.ws_messages = []
+        return {
+            "Id": msg["Id"],
+            "Dropped": False,
+            "Request": encode_req(newReq),
+        }
+    elif msg["Type"] == "httpresponse":
+        req = decode_req(msg["Request"])
+        rsp = decode_rsp(msg["Response"])
+        newRsp = macro.mangle_response(req, rsp)
+
+        if newRsp is None:
+            return {
+                "Id": msg["Id"],
+                "Dropped": True,
+            }
+        newRsp.unmangled = None
+        return {
+            "Id": msg["Id"],
+            "Dropped": False,
+            "Response": encode_rsp(newRsp),
+        }
+    elif msg["Type"] == "wstoserver" or msg["Type"] == "wstoclient":
+        req = decode_req(msg["Request"])
+        rsp = decode_rsp(msg["Response"])
+        wsm = decode_ws(msg["WSMessage"])
+        newWsm = macro.mangle_websocket(req, rsp, wsm)
+
+        if newWsm is None:
+            return {
+                "Id": msg["Id"],
+                "Dropped": True,
+            }
+        newWsm.unmangled = None
+        return {
+            "Id": msg["Id"],
+            "Dropped": False,
+            "WSMessage": encode_ws(newWsm),
+        }
+    raise Exception("Unknown message type: " + msg["Type"])
+
+
+def _unmangled_reply(msg):
+    # Reply that lets an intercepted message through unchanged
+    ret = {"Id": msg["Id"], "Dropped": False}
+    if msg["Type"] == "httprequest":
+        ret["Request"] = msg["Request"]
+    elif msg["Type"] == "httpresponse":
+        ret["Response"] = msg["Response"]
+    else:
+        ret["WSMessage"] = msg["WSMessage"]
+    return ret
+
+
+class InterceptWorkers:
+    # Fixed set of threads that run an intercepting macro. Each worker has its
+    # own bounded queue and put() blocks while the chosen queue is full.
+
+    def __init__(self, conn, macro, workers=4, queue_size=64, ordered_ws=True):
+        self.conn = conn
+        self.macro = macro
+        self.ordered_ws = ordered_ws
+        self.scope = None
+        if macro.intercept_query:
+            # Backends that support the Query field of Intercept only send
+            # matching messages. Older ones send everything, so check here
+            # too and pass anything outside of the query straight back.
+            from guppyproxy.query import CompiledQuery
+            self.scope = CompiledQuery(macro.intercept_query)
+        self.skipped = 0
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.next_worker = count()
+        self.stats_lock = threading.Lock()
+        self.handled = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_mangle = 0.0
+        self.max_mangle = 0.0
+        self.threads = []
+        for q in self.queues:
+            t = ProxyThread(target=self._work, args=(q,))
+            self.threads.append(t)
+            t.start()
+
+    def _ws_key(self, msg):
+        # messages on one websocket share the request that opened it
+        req = msg["Request"]
+        if req.get("DbId"):
+            return req["DbId"]
+        return (req["DestHost"], req["DestPort"], req["Path"])
+
+    def _in_scope(self, msg):
+        req = decode_req(msg["Request"], lazy=True)
+        if msg.get("Response"):
+            req.response = decode_rsp(msg["Response"], lazy=True)
+        # filters that can't be checked here count as matching
+        return self.scope.check(req) is not False
+
+    def put(self, msg):
+        if self.scope is not None and not self._in_scope(msg):
+            with self.conn.write_lock:
+                self.conn.submit_command(_unmangled_reply(msg))
+            with self.stats_lock:
+                self.skipped += 1
+            return
+        if self.ordered_ws and msg["Type"] in ("wstoserver", "wstoclient"):
+            q = self.queues[hash(self._ws_key(msg)) % len(self.queues)]
+        else:
+            # the emptiest queue, round robin between equally empty ones
+            start = next(self.next_worker)
+            n = len(self.queues)
+            q = min((self.queues[(start + i) % n] for i in range(n)), key=lambda q: q.qsize())
+        q.put((msg, time.perf_counter()))
+        depth = sum(q.qsize() for q in self.queues)
+        with self.stats_lock:
+            self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def stop(self):
+        for q in self.queues:
+            q.put(None)
+
+    def _work(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            msg, queued_at = item
+            mangle_start = time.perf_counter()
+            failed = False
+            try:
+                retCmd = _mangle_intercepted(self.macro, msg)
+            except Exception:
+                # don't leave the backend waiting on a message the macro failed on
+                traceback.print_exc()
+                retCmd = _unmangled_reply(msg)
+                failed = True
+            mangle_end = time.perf_counter()
+            try:
+                with self.conn.write_lock:
+                    self.conn.submit_command(retCmd)
+            except SocketClosed:
+                pass  # keep draining the queue so put() never blocks forever
+            latency = time.perf_counter() - queued_at
+            mangle_time = mangle_end - mangle_start
+            with self.stats_lock:
+                self.handled += 1
+                if failed:
+                    self.errors += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_mangle += mangle_time
+                self.max_mangle = max(self.max_mangle, mangle_time)
+
+    def stats(self):
+        # latency is from the message being read to its reply being sent,
+        # mangle is the time spent in the macro
+        depth = sum(q.qsize() for q in self.queues)
+        with self.stats_lock:
+            mean_latency = 0.0
+            mean_mangle = 0.0
+            if self.handled > 0:
+                mean_latency = self.total_latency / self.handled
+                mean_mangle = self.total_mangle / self.handled
+            return InterceptStats(handled=self.handled, skipped=self.skipped, errors=self.errors,
+                                  queue_depth=depth, max_queue_depth=self.max_queue_depth,
+                                  mean_latency=mean_latency, max_latency=self.max_latency,
+                                  mean_mangle=mean_mangle, max_mangle=self.max_mangle)
+
+
+PoolStats = namedtuple("PoolStats", ["size", "idle", "in_use", "checkouts", "waits",
+                                     "mean_wait", "mean_checkout", "max_checkout",
+                                     "created", "discarded"])
+
+
+class ConnectionPool:
+    # A bounded set of warm connections owned by a ProxyClient. Connections are
+    # checked out by purpose and every purpose has its own limit, so a slow
+    # submit can never end up queued in front of an interactive read.
+
+    PURPOSE_INTERACTIVE = "interactive"
+    PURPOSE_BULK = "bulk"
+    PURPOSE_SUBMIT = "submit"
+
+    default_limits = {
+        PURPOSE_INTERACTIVE: 2,
+        PURPOSE_BULK: 4,
+        PURPOSE_SUBMIT: 4,
+    }
+
+    def __init__(self, client, limits=None, wait_timeout=30, health_interval=30):
+        self.client = client
+        self.limits = dict(limits or ConnectionPool.default_limits)
+        self.wait_timeout = wait_timeout
+        self.health_interval = health_interval  # ping idle conns older than this
+        self.cond = threading.Condition()
+        self.idle = {p: [] for p in self.limits}  # purpose -> [(conn, last_used)]
+        self.n_open = {p: 0 for p in self.limits}
+        self.closed = False
+
+        # stats
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+        self.created = 0
+        self.discarded = 0
+
+    def _new_conn(self):
+        conn = self.client.new_conn()
+        with self.cond:
+            self.created += 1
+        return conn
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            conn.ping()
+            return True
+        except (MessageError, SocketClosed, OSError, ValueError):
+            return False
+
+    def _discard(self, conn, purpose):
+        if not conn.closed:
+            conn.close()
+        with self.cond:
+            self.n_open[purpose] -= 1
+            self.discarded += 1
+            self.cond.notify()
+
+    def acquire(self, purpose=PURPOSE_INTERACTIVE):
+        if purpose not in self.limits:
+            raise ProxyException("unknown connection purpose: {}".format(purpose))
+        start = time.perf_counter()
+        wait_start = None
+        conn = None
+        last_used = None
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise ProxyException("connection pool is closed")
+                if len(self.idle[purpose]) > 0:
+                    conn, last_used = self.idle[purpose].pop()
+                    break
+                if self.n_open[purpose] < self.limits[purpose]:
+                    self.n_open[purpose] += 1
+                    break
+                if wait_start is None:
+                    wait_start = time.perf_counter()
+                    self.waits += 1
+                remaining = self.wait_timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    raise ProxyException("timed out waiting for a {} connection".format(purpose))
+                self.cond.wait(remaining)
+            if wait_start is not None:
+                self.wait_time += time.perf_counter() - wait_start
+
+        # connect and health check outside of the lock
+        try:
+            if conn is not None and time.monotonic() - last_used > self.health_interval:
+                if not self._healthy(conn):
+                    conn.close()
+                    with self.cond:
+                        self.discarded += 1
+                    conn = None
+            if conn is None:
+                conn = self._new_conn()
+        except Exception:
+            with self.cond:
+                self.n_open[purpose] -= 1
+                self.cond.notify()
+            raise
+
+        elapsed = time.perf_counter() - start
+        with self.cond:
+            self.checkouts += 1
+            self.checkout_time += elapsed
+            self.max_checkout_time = max(self.max_checkout_time, elapsed)
+        return conn
+
+    def release(self, conn, purpose=PURPOSE_INTERACTIVE, discard=False):
+        if discard or conn.closed or self.closed:
+            self._discard(conn, purpose)
+            return
+        with self.cond:
+            self.idle[purpose].append((conn, time.monotonic()))
+            self.cond.notify()
+
+    @contextmanager
+    def checkout(self, purpose=PURPOSE_INTERACTIVE):
+        conn = self.acquire(purpose)
+        discard = True
+        try:
+            yield conn
+            discard = False
+        except (MessageError, InvalidQuery):
+            # an error reply, the connection itself is still fine
+            discard = False
+            raise
+        finally:
+            self.release(conn, purpose, discard=discard)
+
+    def stats(self):
+        with self.cond:
+            n_idle = sum(len(idle) for idle in self.idle.values())
+            size = sum(self.n_open.values())
+            mean_wait = 0.0
+            if self.waits > 0:
+                mean_wait = self.wait_time / self.waits
+            mean_checkout = 0.0
+            if self.checkouts > 0:
+                mean_checkout = self.checkout_time / self.checkouts
+            return PoolStats(size=size, idle=n_idle, in_use=size - n_idle,
+                             checkouts=self.checkouts, waits=self.waits,
+                             mean_wait=mean_wait, mean_checkout=mean_checkout,
+                             max_checkout=self.max_checkout_time,
+                             created=self.created, discarded=self.discarded)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle = [conn for conns in self.idle.values() for conn, _ in conns]
+            for purpose in self.idle:
+                self.n_open[purpose] -= len(self.idle[purpose])
+                self.idle[purpose] = []
+            self.cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+
+CacheStats = namedtuple("CacheStats", ["entries", "size", "max_size", "hits", "misses",
+                                       "evictions", "invalidations"])
+
+
+def _req_size(req):
+    # rough number of bytes held by a fully loaded request
+    size = 512 + len(req.body)
+    for k, v in req.headers.pairs():
+        size += len(k) + len(v) + 64
+    if req.response is not None:
+        size += 512 + len(req.response.body)
+        for k, v in req.response.headers.pairs():
+            size += len(k) + len(v) + 64
+    if req.unmangled is not None:
+        size += _req_size(req.unmangled)
+    for wsm in req.ws_messages:
+        size += 128 + len(wsm.message)
+    return size
+
+
+def _clone_rsp(rsp):
+    ret = copy.copy(rsp)
+    ret._raw = None
+    ret.headers = Headers(rsp.headers)
+    ret._body = rsp.body
+    ret.unmangled = None
+    if rsp.unmangled is not None:
+        ret.unmangled = _clone_rsp(rsp.unmangled)
+    return ret
+
+
+def _clone_req(req):
+    # A fully decoded copy of a request that can be modified without changing
+    # the original. Bodies are immutable and headers are copied on write so
+    # this is cheap.
+    ret = copy.copy(req)
+    ret._raw = None
+    ret.headers = Headers(req.headers)
+    ret._body = req.body
+    ret.tags = set(req.tags)
+    ret.response = None
+    if req.response is not None:
+        ret.response = _clone_rsp(req.response)
+    ret.unmangled = None
+    if req.unmangled is not None:
+        ret.unmangled = _clone_req(req.unmangled)
+    ret.ws_messages = [copy.copy(wsm) for wsm in req.ws_messages]
+    return ret
+
+
+class RequestCache:
+    # LRU cache of fully loaded requests keyed by (storage_id, db_id) and
+    # limited by the approximate number of bytes the requests hold. Callers
+    # get their own copy of a cached request so they can modify it. Entries
+    # are only dropped when watch_storage says they changed, so requests are
+    # only cached while something is watching every storage.
+
+    def __init__(self, max_size=64 * 1024 * 1024):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.watchers = 0
+        self.entries = OrderedDict()  # key -> (req, size)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, storage_id, db_id):
+        key = (storage_id, db_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return _clone_req(entry[0])
+
+    def put(self, req):
+        req = _clone_req(req)
+        size = _req_size(req)
+        if size > self.max_size:
+            return
+        key = (req.storage_id, req.db_id)
+        with self.lock:
+            if self.watchers == 0:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (req, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, storage_id, db_id):
+        with self.lock:
+            entry = self.entries.pop((storage_id, db_id), None)
+            if entry is not None:
+                self.size -= entry[1]
+                self.invalidations += 1
+
+    def invalidate_storage(self, storage_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == storage_id]:
+                self.size -= self.entries.pop(key)[1]
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def watch_started(self):
+        with self.lock:
+            self.watchers += 1
+
+    def watch_stopped(self):
+        with self.lock:
+            self.watchers -= 1
+            if self.watchers > 0:
+                return
+        # changes aren't seen anymore so nothing cached can be trusted
+        self.clear()
+
+    def stats(self):
+        with self.lock:
+            return CacheStats(entries=len(self.entries), size=self.size,
+                              max_size=self.max_size, hits=self.hits,
+                              misses=self.misses, evictions=self.evictions,
+                              invalidations=self.invalidations)
+
+
+# A change to storage seen by watch_storage. Every subscriber gets its own
+# request, response and message so they can be modified. action is the
+# backend's action name, or EVENTS_RECONNECTED after the bus had to reconnect
+# and may have missed events.
+StorageEvent = namedtuple("StorageEvent", ["action", "storage_id", "request", "response",
+                                           "ws_message", "message_id"])
+EVENTS_RECONNECTED = "Reconnected"
+
+
+def _copy_event(event):
+    # Lazily decoded messages are decoded again from the reply so the copy
+    # costs nothing until it's used
+    req = event.request
+    if req is not None:
+        if req._raw is not None:
+            req = decode_req(req._raw, headers_only=req.headers_only, storage=req.storage_id, lazy=True)
+        else:
+            req = _clone_req(req)
+    rsp = event.response
+    if rsp is not None:
+        if rsp._raw is not None:
+            rsp = decode_rsp(rsp._raw, headers_only=rsp.headers_only, storage=rsp.storage, lazy=True)
+        else:
+            rsp = _clone_rsp(rsp)
+    wsm = event.ws_message
+    if wsm is not None:
+        wsm = copy.copy(wsm)
+    return event._replace(request=req, response=rsp, ws_message=wsm)
+
+
+class EventSubscription:
+    # A subscriber's queue of storage events. When it is full the oldest
+    # event is dropped so a slow subscriber never holds up the others.
+
+    def __init__(self, bus, maxsize=10000):
+        self.bus = bus
+        self.events = deque(maxlen=maxsize)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def _put(self, event):
+        with self.cond:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        # Next event, or None on timeout or once the subscription is closed
+        with self.cond:
+            if len(self.events) == 0 and not self.closed:
+                self.cond.wait(timeout)
+            if len(self.events) == 0:
+                return None
+            return self.events.popleft()
+
+    def drain(self):
+        # Every queued event without waiting
+        with self.cond:
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+    def __iter__(self):
+        while True:
+            event = self.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self):
+        self.bus.unsubscribe(self)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class StorageEventBus:
+    # One watch_storage connection shared by everything in the process that
+    # wants to know about changes to storage. Each event is read once and
+    # every subscription gets its own copy. If the connection is lost it is opened
+    # again and the subscriptions carry on.
+
+    def __init__(self, client, storage_id=-1, headers_only=True, retry_interval=1.0):
+        self.client = client
+        self.storage_id = storage_id
+        self.headers_only = headers_only
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.conn = None
+        self.thread = None
+        self.closed = False
+        self.published = 0
+        self.reconnects = 0
+
+    def subscribe(self, maxsize=10000):
+        sub = EventSubscription(self, maxsize=maxsize)
+        with self.lock:
+            if self.closed:
+                raise ProxyException("event bus is closed")
+            self.subscriptions.append(sub)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+
+    def _publish(self, event):
+        with self.lock:
+            subs = list(self.subscriptions)
+            self.published += 1
+        # copied before any subscriber can start changing the original
+        events = [event] + [_copy_event(event) for _ in subs[1:]]
+        for sub, ev in zip(subs, events):
+            sub._put(ev)
+
+    def _run(self):
+        first = True
+        while not self.closed:
+            try:
+                conn = self.client.new_conn()
+            except (OSError, MessageError, SocketClosed):
+                time.sleep(self.retry_interval)
+                continue
+            with self.lock:
+                self.conn = conn
+                if self.closed:
+                    conn.close()
+                    return
+            if not first:
+                self.reconnects += 1
+                # events may have been missed, so nothing cached can be trusted
+                self.client.req_cache.clear()
+                self._publish(StorageEvent(EVENTS_RECONNECTED, self.storage_id,
+                                           None, None, None, None))
+            first = False
+            try:
+                for msg in conn.watch_storage(storage_id=self.storage_id,
+                                              headers_only=self.headers_only):
+                    self._publish(StorageEvent(msg["Action"], msg["StorageId"],
+                                               msg["Request"] or None,
+                                               msg["Response"] or None,
+                                               msg["WSMessage"] or None,
+                                               msg.get("MessageId")))
+            except (OSError, ValueError, MessageError, SocketClosed):
+                pass
+            finally:
+                conn.close()
+            if not self.closed:
+                time.sleep(self.retry_interval)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            subs = list(self.subscriptions)
+            conn = self.conn
+        if conn is not None:
+            conn.close()
+        for sub in subs:
+            sub.close()
+
+
+LogLine = namedtuple("LogLine", ["timestamp", "stream", "line"])
+LogStats = namedtuple("LogStats", ["lines", "bytes", "dropped", "rotations", "counters"])
+
+
+class BackendLog:
+    # Output of a backend started by the client. Both pipes are read by
+    # background threads so the backend never blocks writing to a full pipe.
+    # The last max_lines lines are kept in memory and can optionally be
+    # appended to a log file which is rotated when it gets too big. Lines
+    # matching the patterns are counted.
+
+    MAX_LINE = 64 * 1024  # longer lines are split
+
+    default_patterns = {
+        "connections": r"(?i)new connection|accepted connection|connection from",
+        "tls_errors": r"(?i)tls:|handshake error|handshake fail|certificate",
+        "errors": r"(?i)\berror\b|panic:",
+    }
+
+    def __init__(self, max_lines=5000, log_path=None, max_file_size=10 * 1024 * 1024,
+                 backups=3, patterns=None):
+        self.lines = deque(maxlen=max_lines)
+        self.lock = threading.Lock()
+        self.log_path = log_path
+        self.max_file_size = max_file_size
+        self.backups = backups
+        self.logfile = None
+        self.threads = []
+        self.total_lines = 0
+        self.total_bytes = 0
+        self.dropped = 0
+        self.rotations = 0
+        if patterns is None:
+            patterns = BackendLog.default_patterns
+        self.patterns = [(name, re.compile(p)) for name, p in patterns.items()]
+        self.counters = {name: 0 for name in patterns}
+
+    def attach(self, stream, name):
+        # Start draining a pipe in the background until the backend closes it
+        t = threading.Thread(target=self._drain, args=(stream, name), daemon=True)
+        self.threads.append(t)
+        t.start()
+
+    def _drain(self, stream, name):
+        try:
+            while True:
+                ln = stream.readline(BackendLog.MAX_LINE)
+                if len(ln) == 0:
+                    return
+                self.add_line(name, ln)
+        except (OSError, ValueError):
+            # pipe closed under us
+            pass
+
+    def add_line(self, stream, ln):
+        if isinstance(ln, bytes):
+            nbytes = len(ln)
+            ln = ln.decode(errors="replace")
+        else:
+            nbytes = len(ln.encode())
+        ln = ln.rstrip("\r\n")
+        entry = LogLine(time.time(), stream, ln)
+        with self.lock:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(entry)
+            self.total_lines += 1
+            self.total_bytes += nbytes
+            for pname, regexp in self.patterns:
+                if regexp.search(ln):
+                    self.counters[pname] += 1
+            if self.log_path is not None:
+                self._write_file(entry)
+
+    def _write_file(self, entry):
+        try:
+            if self.logfile is None:
+                self.logfile = open(self.log_path, "a")
+            self.logfile.write("{} [{}] {}\n".format(
+                datetime.datetime.fromtimestamp(entry.timestamp).isoformat(),
+                entry.stream, entry.line))
+            self.logfile.flush()
+            if self.logfile.tell() >= self.max_file_size:
+                self._rotate()
+        except OSError as e:
+            # stop writing the file but keep the in-memory log going
+            print("Could not write backend log to {}: {}".format(self.log_path, e))
+            self.log_path = None
+            self.logfile = None
+
+    def _rotate(self):
+        # puppy.log -> puppy.log.1 -> puppy.log.2 ... dropping the oldest
+        self.logfile.close()
+        self.logfile = None
+        for i in range(self.backups - 1, 0, -1):
+            src = "{}.{}".format(self.log_path, i)
+            if os.path.exists(src):
+                os.replace(src, "{}.{}".format(self.log_path, i + 1))
+        if self.backups > 0:
+            os.replace(self.log_path, self.log_path + ".1")
+        else:
+            os.remove(self.log_path)
+        self.rotations += 1
+
+    def tail(self, n=None):
+        with self.lock:
+            if n is None or n >= len(self.lines):
+                return list(self.lines)
+            return list(islice(self.lines, len(self.lines) - n, None))
+
+    def stats(self):
+        with self.lock:
+            return LogStats(self.total_lines, self.total_bytes, self.dropped,
+                            self.rotations, dict(self.counters))
+
+    def close(self):
+        with self.lock:
+            if self.logfile is not None:
+                self.logfile.close()
+                self.logfile = None
+            self.log_path = None
+
+
 ActiveStorage = namedtuple("ActiveStorage", ["type", "storage_id", "prefix"])
 
 
@@ -1215,16 +2654,30 @@ def _serialize_storage(stype, prefix):
 
 
 class ProxyClient:
-    def __init__(self, binary=None, debug=False, conn_addr=None):
+    def __init__(self, binary=None, debug=False, conn_addr=None, pipelined=True,
+                 pool_limits=None, binary_framing=True, cache_size=64 * 1024 * 1024,
+                 log_path=None):
         self.binloc = binary
         self.proxy_proc = None
+        self.log_path = log_path
+        self.backend_log = None  # output of the backend if we started it
         self.ltype = None
         self.laddr = None
         self.debug = debug
         self.conn_addr = conn_addr
+        self.pipelined = pipelined
+        self.pool_limits = pool_limits
+        self.binary_framing = binary_framing
+        self.framing = None  # what the backend agreed to, None until a connection asks
 
         self.conns = set()
         self.msg_conn = None  # conn for single req/rsp messages
+        self.pool = None  # conns checked out for interactive reads, bulk queries and submits
+        self.req_cache = RequestCache(max_size=cache_size)  # fully loaded requests by id
+        self.paging = None  # whether the backend pages query results, None until a query shows it
+        self.counting = None  # whether the backend answers StorageCount, None until it's asked
+        self.events = None  # StorageEventBus, created by subscribe_events
+        self.events_lock = threading.Lock()
 
         self.context = RequestContext(self)
 
@@ -1303,30 +2756,87 @@ class ProxyClient:
         if debug:
             args += ["--dbg"]
         self.proxy_proc = Popen(args, stdout=PIPE, stderr=PIPE)
+        self.backend_log = BackendLog(log_path=self.log_path)
+        self.backend_log.attach(self.proxy_proc.stderr, "stderr")
 
         # Wait for it to start and make connection
         listenstr = self.proxy_proc.stdout.readline().rstrip()
+        self.backend_log.attach(self.proxy_proc.stdout, "stdout")
         self.msg_connect(listenstr.decode())
 
     def msg_connect(self, addr):
         self.ltype, self.laddr = addr.split(":", 1)
         self.msg_conn = self.new_conn()
+        if self.pipelined:
+            self.msg_conn.start_pipelining()
+        self.pool = ConnectionPool(self, limits=self.pool_limits)
         self._get_storage()
 
     def close(self):
+        if self.events is not None:
+            self.events.close()
+        if self.pool is not None:
+            self.pool.close()
         conns = list(self.conns)
         for conn in conns:
             conn.close()
         if self.proxy_proc is not None:
             self.proxy_proc.terminate()
+        if self.backend_log is not None:
+            self.backend_log.close()
 
     def new_conn(self):
         conn = ProxyConnection(kind=self.ltype, addr=self.laddr)
         conn.parent_client = self
         conn.debug = self.debug
         self.conns.add(conn)
+        if self.binary_framing and self.framing != FRAMING_JSON:
+            # Once the backend has turned binary framing down it isn't asked
+            # again. The framing is per connection, so one that accepted it
+            # still has to be asked on every new connection.
+            self.framing = conn.negotiate_framing()
         return conn
 
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def write_stats(self):
+        # totals for the connections that are currently open
+        stats = [conn.write_stats() for conn in list(self.conns)]
+        return _write_stats(sum(st.bytes_sent for st in stats),
+                            sum(st.send_calls for st in stats),
+                            sum(st.send_secs for st in stats))
+
+    def cache_stats(self):
+        return self.req_cache.stats()
+
+    def subscribe_events(self, maxsize=10000):
+        # Subscribe to changes to every storage. All subscriptions share one
+        # watch connection, see StorageEventBus
+        with self.events_lock:
+            if self.events is None:
+                self.events = StorageEventBus(self)
+        return self.events.subscribe(maxsize=maxsize)
+
+    def _storage_event(self, msg):
+        # called by watch_storage for every message so cached copies of
+        # requests that changed are dropped
+        if msg["Action"] == "NewRequest":
+            return
+        if msg["Request"]:
+            self.req_cache.invalidate(msg["StorageId"], msg["Request"].db_id)
+        if msg.get("MessageId"):
+            self.req_cache.invalidate(msg["StorageId"], msg["MessageId"])
+
+    def _invalidate_reqid(self, reqid):
+        # tag commands take ids with or without a storage prefix, so drop
+        # the id from every storage
+        db_id = reqid
+        if db_id and db_id[0].isalpha():
+            db_id = db_id[1:]
+        for storage_id in self.storage_by_id:
+            self.req_cache.invalidate(storage_id, db_id)
+
     # functions involving storage
 
     def _add_storage(self, storage, prefix):
@@ -1394,15 +2904,9 @@ class ProxyClient:
                                   max_results=max_results)
 
     def in_context_requests_iter(self, headers_only=False, max_results=0):
-        results = self.query_storage(self.context.query,
-                                     headers_only=headers_only,
-                                     max_results=max_results)
-        ret = results
-        if max_results > 0 and len(results) > max_results:
-            ret = results[:max_results]
-        for reqh in ret:
-            req = self.req_by_id(reqh.db_id, storage_id=reqh.storage_id)
-            yield req
+        return self.query_storage_iter(self.context.query,
+                                       headers_only=headers_only,
+                                       max_results=max_results)
 
     def get_reqid(self, req):
         prefix = ""
@@ -1436,6 +2940,7 @@ class ProxyClient:
         self.msg_conn.close_storage(s.storage_id)
         del self.storage_by_id[s.storage_id]
         del self.storage_by_prefix[s.prefix]
+        self.req_cache.invalidate_storage(s.storage_id)
 
     def set_proxy_storage(self, storage_id):
         s = self.storage_by_id[storage_id]
@@ -1463,36 +2968,104 @@ class ProxyClient:
             storage = self._stg_or_def(storage)
         if inmem:
             storage = self.inmem_storage
-        self.msg_conn.submit(req, storage=storage)
+        with self.pool.checkout(ConnectionPool.PURPOSE_SUBMIT) as conn:
+            conn.submit(req, storage=storage)
 
     def query_storage(self, q, max_results=0, headers_only=False, storage=None, conn=None):
-        results = []
-        conn = conn or self.msg_conn
+        # Returns the matching requests newest first. When querying every storage
+        # the storages are queried at the same time on separate connections and
+        # the results are merged by time. max_results applies to the total, but
+        # every storage may still return up to max_results, use
+        # query_storage_iter to hold fewer requests at once.
+        if storage is not None:
+            storage_ids = [storage]
+        else:
+            storage_ids = [s.storage_id for s in self.storage_iter()]
+        if not storage_ids:
+            return []
+
+        def query_one(storage_id, c):
+            results = c.query_storage(q, max_results=max_results,
+                                      headers_only=headers_only,
+                                      storage=storage_id)
+            results.sort(key=_req_time_key, reverse=True)
+            return results
+
+        def query_pooled(storage_id):
+            with self.pool.checkout(ConnectionPool.PURPOSE_BULK) as c:
+                return query_one(storage_id, c)
+
+        if conn is not None:
+            per_storage = [query_one(sid, conn) for sid in storage_ids]
+        elif len(storage_ids) == 1:
+            per_storage = [query_one(storage_ids[0], self.msg_conn)]
+        else:
+            with ThreadPoolExecutor(max_workers=len(storage_ids)) as executor:
+                per_storage = list(executor.map(query_pooled, storage_ids))
+        return list(merge_by_time(per_storage, max_results=max_results))
+
+    def query_storage_iter(self, q, page_size=200, max_results=0, headers_only=False, storage=None):
+        # Yields the results of a query newest first. Every storage is read a
+        # page at a time and the pages are merged by time, so only about a page
+        # per storage is held at once. A connection is only checked out while a
+        # page is loading so a caller can stop part way through or take its
+        # time between pages.
         if storage is None:
-            for s in self.storage_iter():
-                results += conn.query_storage(q, max_results=max_results,
-                                              headers_only=headers_only,
-                                              storage=s.storage_id)
+            storage_ids = [s.storage_id for s in self.storage_iter()]
         else:
-            results += conn.query_storage(q, max_results=max_results,
-                                          headers_only=headers_only,
-                                          storage=storage)
-
-        def kfunc(req):
-            if req.time_start is None:
-                return datetime.datetime.utcfromtimestamp(0)
-            return req.time_start
-
-        results.sort(key=kfunc)
-        results = [r for r in reversed(results)]
-        return results
+            storage_ids = [storage]
+
+        def storage_results(storage_id):
+            def get_page(offset, limit):
+                with self.pool.checkout(ConnectionPool.PURPOSE_BULK) as conn:
+                    page = conn.query_storage_page(q, storage_id, offset=offset, limit=limit,
+                                                   headers_only=headers_only)
+                self.paging = page.paged
+                return page
+            # started when the merge first needs it, by then an earlier
+            # storage may have shown whether the backend pages
+            yield from iter_pages(get_page, page_size=page_size, max_results=max_results,
+                                  paged=self.paging)
+
+        return merge_by_time([storage_results(sid) for sid in storage_ids], max_results=max_results)
+
+    def query_storage_page(self, q, storage, offset=0, limit=0, headers_only=False):
+        with self.pool.checkout(ConnectionPool.PURPOSE_INTERACTIVE) as conn:
+            page = conn.query_storage_page(q, storage, offset=offset, limit=limit,
+                                           headers_only=headers_only)
+        self.paging = page.paged
+        return page
+
+    def count_storage(self, q, storage=None):
+        # Number of requests matching a query in one storage or in all of them.
+        # Raises MessageError if the backend can't count, which it is only
+        # asked once.
+        if self.counting is False:
+            raise MessageError("backend can't count requests")
+        if storage is None:
+            storage_ids = [s.storage_id for s in self.storage_iter()]
+        else:
+            storage_ids = [storage]
+        with self.pool.checkout(ConnectionPool.PURPOSE_INTERACTIVE) as conn:
+            try:
+                n = sum(conn.count_storage(q, sid) for sid in storage_ids)
+            except MessageError:
+                if self.counting is None:
+                    # the query may be what it couldn't count, try the simplest one
+                    try:
+                        conn.count_storage([], storage_ids[0])
+                        self.counting = True
+                    except MessageError:
+                        self.counting = False
+                raise
+        self.counting = True
+        return n
 
     def query_storage_async(self, slot, *args, **kwargs):
         def perform_query():
             try:
-                with self.new_conn() as c:
-                    r = self.query_storage(*args, conn=c, **kwargs)
-                    slot.emit(r)
+                r = self.query_storage(*args, **kwargs)
+                slot.emit(r)
             except Exception:
                 pass
         ProxyThread(target=perform_query).start()
@@ -1503,14 +3076,63 @@ class ProxyClient:
             storage_id = storage.storage_id
         else:
             db_id = reqid
-        retreq = self.msg_conn.req_by_id(db_id, headers_only=headers_only,
-                                         storage=storage_id)
+
+        # a cached full request also answers a headers only lookup but only
+        # full requests are cached
+        retreq = self.req_cache.get(storage_id, db_id)
+        if retreq is None:
+            with self.pool.checkout(ConnectionPool.PURPOSE_INTERACTIVE) as conn:
+                retreq = conn.req_by_id(db_id, headers_only=headers_only,
+                                        storage=storage_id)
+            if not headers_only:
+                self.req_cache.put(retreq)
 
         if reqid[0] == 's':  # `u` is handled by parse_reqid
             retreq.response = retreq.response.unmangled
 
         return retreq
 
+    def reqs_by_ids(self, reqids, headers_only=False, chunk_size=200):
+        # Get many requests by id at once. See reqs_by_ids_iter
+        return list(self.reqs_by_ids_iter(reqids, headers_only=headers_only,
+                                          chunk_size=chunk_size))
+
+    def reqs_by_ids_iter(self, reqids, headers_only=False, chunk_size=200):
+        # Yields the requests with the given ids in the order they were given.
+        # The ids are fetched chunk_size at a time with one query per storage
+        # per chunk so the first requests arrive before the rest are loaded.
+        # Ids that don't exist are skipped. A connection is only checked out
+        # while a chunk is loading.
+        reqids = list(reqids)
+        for i in range(0, len(reqids), chunk_size):
+            chunk = reqids[i:i + chunk_size]
+            found = {}  # reqid -> request
+            by_storage = {}  # storage_id -> {db_id: reqid}
+            for reqid in chunk:
+                if reqid[0] in ('u', 's'):
+                    # needs the mangled version first, load it on its own
+                    try:
+                        found[reqid] = self.req_by_id(reqid, headers_only=headers_only)
+                    except MessageError:
+                        pass
+                    continue
+                storage, db_id = self.parse_reqid(reqid)
+                if not headers_only:
+                    cached = self.req_cache.get(storage.storage_id, db_id)
+                    if cached is not None:
+                        found[reqid] = cached
+                        continue
+                by_storage.setdefault(storage.storage_id, {})[db_id] = reqid
+            if by_storage:
+                with self.pool.checkout(ConnectionPool.PURPOSE_BULK) as conn:
+                    for storage_id, ids in by_storage.items():
+                        for req in conn.reqs_by_ids(list(ids), storage_id, headers_only=headers_only):
+                            if req.db_id in ids:
+                                found[ids[req.db_id]] = req
+            for reqid in chunk:
+                if reqid in found:
+                    yield found[reqid]
+
     def check_request(self, query, req=None, reqid=""):
         if req is not None:
             return self.msg_conn.check_request(query, req=req)
@@ -1522,14 +3144,46 @@ class ProxyClient:
 
     # for these and submit, might need storage stored on the request itself
     def add_tag(self, reqid, tag, storage=None):
+        self._invalidate_reqid(reqid)
         self.msg_conn.add_tag(reqid, tag, storage=self._stg_or_def(storage))
 
     def remove_tag(self, reqid, tag, storage=None):
+        self._invalidate_reqid(reqid)
         self.msg_conn.remove_tag(reqid, tag, storage=self._stg_or_def(storage))
 
     def clear_tag(self, reqid, storage=None):
+        self._invalidate_reqid(reqid)
         self.msg_conn.clear_tag(reqid, storage=self._stg_or_def(storage))
 
+    def _tag_ids(self, reqids, storage):
+        # (db_id, storage_id) for each id. Without a storage the ids are parsed
+        # like any other request id, with a storage they are its db ids
+        ids = []
+        for reqid in reqids:
+            if storage is None:
+                s, db_id = self.parse_reqid(reqid)
+                ids.append((db_id, s.storage_id))
+            else:
+                ids.append((reqid, storage))
+            self._invalidate_reqid(reqid)
+        return ids
+
+    def add_tags_bulk(self, reqids, tags, storage=None):
+        with self.pool.checkout(ConnectionPool.PURPOSE_BULK) as conn:
+            conn.add_tags_bulk(self._tag_ids(reqids, storage), tags)
+
+    def remove_tags_bulk(self, reqids, tags, storage=None):
+        with self.pool.checkout(ConnectionPool.PURPOSE_BULK) as conn:
+            conn.remove_tags_bulk(self._tag_ids(reqids, storage), tags)
+
+    def set_tags(self, reqids, tags, storage=None):
+        # Replace the tags of every request in reqids with tags
+        ids = self._tag_ids(reqids, storage)
+        with self.pool.checkout(ConnectionPool.PURPOSE_BULK) as conn:
+            # the clears have to finish before any tag is added
+            conn.clear_tags_bulk(ids)
+            conn.add_tags_bulk(ids, tags)
+
     def all_saved_queries(self, storage=None):
         self.msg_conn.all_saved_queries(storage=None)
 
@@ -1549,16 +3203,35 @@ class ProxyClient:
         return self.msg_conn.get_plugin_value(key, self._stg_or_def(storage))
 
 
-def decode_req(result, headers_only=False, storage=0):
-    if "StartTime" in result and result["StartTime"] > 0:
-        time_start = time_from_nsecs(result["StartTime"])
-    else:
-        time_start = None
+def _req_time_key(req):
+    return req.time_start_ns or 0
 
-    if "EndTime" in result and result["EndTime"] > 0:
-        time_end = time_from_nsecs(result["EndTime"])
-    else:
-        time_end = None
+
+def merge_by_time(result_lists, max_results=0):
+    # Lazily merge lists of requests that are each sorted newest first into one
+    # stream sorted newest first, stopping after max_results requests
+    merged = heapq.merge(*result_lists, key=_req_time_key, reverse=True)
+    if max_results > 0:
+        return islice(merged, max_results)
+    return merged
+
+
+def _decode_body(body):
+    # bodies arrive as raw bytes with binary framing and as base64 otherwise
+    if isinstance(body, bytes):
+        return body
+    return base64.b64decode(body)
+
+
+def decode_req(result, headers_only=False, storage=0, lazy=False):
+    # With lazy=True, the headers, body, unmangled version, response and
+    # websocket messages are decoded from `result` when they are first used
+    time_start_ns = result.get("StartTime")
+    if not time_start_ns or time_start_ns < 0:
+        time_start_ns = None
+    time_end_ns = result.get("EndTime")
+    if not time_end_ns or time_end_ns < 0:
+        time_end_ns = None
 
     if "DbId" in result:
         db_id = result["DbId"]
@@ -1570,41 +3243,83 @@ def decode_req(result, headers_only=False, storage=0):
     else:
         tags = ""
 
+    if lazy:
+        ret = HTTPRequest(
+            method=result["Method"],
+            path=result["Path"],
+            proto_major=result["ProtoMajor"],
+            proto_minor=result["ProtoMinor"],
+            dest_host=result["DestHost"],
+            dest_port=result["DestPort"],
+            use_tls=result["UseTLS"],
+            tags=tags,
+            headers_only=True,
+            db_id=db_id,
+            storage_id=storage)
+        ret.time_start_ns = time_start_ns
+        ret.time_end_ns = time_end_ns
+        ret._raw = result
+        ret.headers_only = headers_only
+        ret.headers = _UNLOADED
+        if not headers_only:
+            ret._body = _UNLOADED
+        ret.response = _UNLOADED
+        ret.unmangled = _UNLOADED
+        if result.get("WSMessages"):
+            ret.ws_messages = _UNLOADED
+        return ret
+
     ret = HTTPRequest(
         method=result["Method"],
         path=result["Path"],
         proto_major=result["ProtoMajor"],
         proto_minor=result["ProtoMinor"],
-        headers=copy.deepcopy(result["Headers"]),
-        body=base64.b64decode(result["Body"]),
+        headers=result["Headers"],
+        body=_decode_body(result["Body"]),
         dest_host=result["DestHost"],
         dest_port=result["DestPort"],
         use_tls=result["UseTLS"],
-        time_start=time_start,
-        time_end=time_end,
         tags=tags,
         headers_only=headers_only,
         db_id=db_id,
         storage_id=storage)
+    ret.time_start_ns = time_start_ns
+    ret.time_end_ns = time_end_ns
 
     if "Unmangled" in result:
         ret.unmangled = decode_req(result["Unmangled"], headers_only=headers_only, storage=storage)
     if "Response" in result:
         ret.response = decode_rsp(result["Response"], headers_only=headers_only, storage=storage)
-    if "WSMessages" in result:
-        for wsm in result["WSMessages"]:
-            ret.ws_messages.append(decode_ws(wsm, storage=storage))
+    if result.get("WSMessages"):
+        ret.ws_messages = [decode_ws(wsm, storage=storage) for wsm in result["WSMessages"]]
     return ret
 
 
-def decode_rsp(result, headers_only=False, storage=0):
+def decode_rsp(result, headers_only=False, storage=0, lazy=False):
+    if lazy:
+        ret = HTTPResponse(
+            status_code=result["StatusCode"],
+            reason=result["Reason"],
+            proto_major=result["ProtoMajor"],
+            proto_minor=result["ProtoMinor"],
+            headers_only=True,
+            storage_id=storage,
+        )
+        ret._raw = result
+        ret.headers_only = headers_only
+        ret.headers = _UNLOADED
+        if not headers_only:
+            ret._body = _UNLOADED
+        ret.unmangled = _UNLOADED
+        return ret
+
     ret = HTTPResponse(
         status_code=result["StatusCode"],
         reason=result["Reason"],
         proto_major=result["ProtoMajor"],
         proto_minor=result["ProtoMinor"],
-        headers=copy.deepcopy(result["Headers"]),
-        body=base64.b64decode(result["Body"]),
+        headers=result["Headers"],
+        body=_decode_body(result["Body"]),
         headers_only=headers_only,
         storage_id=storage,
     )
@@ -1615,22 +3330,18 @@ def decode_rsp(result, headers_only=False, storage=0):
 
 
 def decode_ws(result, storage=0):
-    timestamp = None
     db_id = ""
-
-    if "Timestamp" in result:
-        timestamp = time_from_nsecs(result["Timestamp"])
     if "DbId" in result:
         db_id = result["DbId"]
 
     ret = WSMessage(
         is_binary=result["IsBinary"],
-        message=base64.b64decode(result["Message"]),
+        message=_decode_body(result["Message"]),
         to_server=result["ToServer"],
-        timestamp=timestamp,
         db_id=db_id,
         storage_id=storage,
     )
+    ret.timestamp_ns = result.get("Timestamp") or 0
 
     if "Unmangled" in result:
         ret.unmangled = decode_ws(result["Unmangled"], storage=storage)
@@ -1644,17 +3355,17 @@ def encode_req(req, int_rsp=False):
         "DestPort": req.dest_port,
         "UseTLS": req.use_tls,
         "Method": req.method,
-        "Path": req.url.geturl(),
+        "Path": req.path_str(),
         "ProtoMajor": req.proto_major,
         "ProtoMinor": req.proto_major,
         "Headers": req.headers.dict(),
-        "Tags": list(req.tags),
-        "Body": base64.b64encode(copy.copy(req.body)).decode(),
+        "Tags": req.sorted_tags(),
+        "Body": req.body,
     }
 
     if not int_rsp:
-        msg["StartTime"] = time_to_nsecs(req.time_start)
-        msg["EndTime"] = time_to_nsecs(req.time_end)
+        msg["StartTime"] = req.time_start_ns
+        msg["EndTime"] = req.time_end_ns
         if req.unmangled is not None:
             msg["Unmangled"] = encode_req(req.unmangled)
         if req.response is not None:
@@ -1672,7 +3383,7 @@ def encode_rsp(rsp, int_rsp=False):
         "StatusCode": rsp.status_code,
         "Reason": rsp.reason,
         "Headers": rsp.headers.dict(),
-        "Body": base64.b64encode(copy.copy(rsp.body)).decode(),
+        "Body": rsp.body,
     }
 
     if not int_rsp:
@@ -1683,14 +3394,14 @@ def encode_rsp(rsp, int_rsp=False):
 
 def encode_ws(ws, int_rsp=False):
     msg = {
-        "Message": base64.b64encode(ws.message).decode(),
+        "Message": ws.message,
         "IsBinary": ws.is_binary,
         "toServer": ws.to_server,
     }
     if not int_rsp:
         if ws.unmangled is not None:
             msg["Unmangled"] = encode_ws(ws.unmangled)
-        msg["Timestamp"] = time_to_nsecs(ws.timestamp)
+        msg["Timestamp"] = ws.timestamp_ns
         msg["DbId"] = ws.db_id
     return msg
 
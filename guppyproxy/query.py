@@ -0,0 +1,250 @@
+import re
+
+from guppyproxy.proxy import get_full_url
+
+# Evaluates storage queries on the client so requests can be checked against
+# the current filter without asking the backend. A query is a list of phrases
+# that must all match and a phrase is a list of filters where any one has to
+# match, for example:
+#   [[["inv", "path", "containsregexp", r"\.js$"]], [["host", "is", "a.com"], ["host", "is", "b.com"]]]
+# Filters on fields that can't be evaluated locally (or on bodies that weren't
+# loaded) are left for the backend to check.
+
+
+class CannotEvaluate(Exception):
+    pass
+
+
+_field_names = {
+    "method": "method", "verb": "method", "vb": "method",
+    "host": "host", "domain": "host", "hs": "host", "dm": "host",
+    "path": "path", "pt": "path",
+    "url": "url",
+    "statuscode": "statuscode", "sc": "statuscode",
+    "tag": "tag",
+    "id": "id", "dbid": "id",
+    "reqbody": "reqbody", "reqbd": "reqbody", "qbd": "reqbody", "qdata": "reqbody", "qdt": "reqbody",
+    "rspbody": "rspbody", "rspbd": "rspbody", "sbd": "rspbody", "sdata": "rspbody", "sdt": "rspbody",
+    "body": "body", "bd": "body", "data": "body", "dt": "body",
+    "reqheader": "reqheader", "reqhd": "reqheader", "qhd": "reqheader",
+    "rspheader": "rspheader", "rsphd": "rspheader", "shd": "rspheader",
+    "header": "header", "hd": "header",
+}
+
+_comparer_names = {
+    "is": "is",
+    "contains": "contains", "ct": "contains",
+    "containsregexp": "containsregexp", "containsr": "containsregexp", "ctr": "containsregexp",
+    "leneq": "leneq",
+    "lengt": "lengt",
+    "lenlt": "lenlt",
+}
+
+
+def _bytelen(v):
+    # lengths are compared in bytes like the backend does
+    if isinstance(v, bytes):
+        return len(v)
+    return len(v.encode())
+
+
+def _compile_cmp(name, val, binary=False):
+    # returns a function that takes a str (or bytes if binary is set) and
+    # returns whether it matches
+    cmp = _comparer_names.get(name)
+    if cmp is None:
+        raise CannotEvaluate("unknown comparer: {}".format(name))
+    if cmp in ("leneq", "lengt", "lenlt"):
+        try:
+            n = int(val)
+        except ValueError:
+            raise CannotEvaluate("invalid length: {}".format(val))
+        if cmp == "leneq":
+            return lambda v: _bytelen(v) == n
+        if cmp == "lengt":
+            return lambda v: _bytelen(v) > n
+        return lambda v: _bytelen(v) < n
+    if binary:
+        val = val.encode()
+    if cmp == "is":
+        return lambda v: v == val
+    if cmp == "contains":
+        return lambda v: val in v
+    try:
+        regexp = re.compile(val)
+    except re.error:
+        raise CannotEvaluate("regexp not supported: {}".format(val))
+    return lambda v: regexp.search(v) is not None
+
+
+def _req_body(req):
+    if req.headers_only:
+        raise CannotEvaluate("request body not loaded")
+    return [req.body]
+
+
+def _rsp_body(req):
+    if req.response is None:
+        return []
+    if req.response.headers_only:
+        raise CannotEvaluate("response body not loaded")
+    return [req.response.body]
+
+
+def _req_headers(req):
+    return req.headers.pairs()
+
+
+def _rsp_headers(req):
+    if req.response is None:
+        return []
+    return req.response.headers.pairs()
+
+
+def _all_headers(req):
+    return list(_req_headers(req)) + list(_rsp_headers(req))
+
+
+# functions returning the values of a field that are compared
+_str_fields = {
+    "method": lambda req: [req.method],
+    "host": lambda req: [req.dest_host],
+    "path": lambda req: [req.url.path],
+    "url": lambda req: [get_full_url(req)],
+    "statuscode": lambda req: [] if req.response is None else [str(req.response.status_code)],
+    "tag": lambda req: req.sorted_tags(),
+    "id": lambda req: [req.db_id],
+}
+
+_body_fields = {
+    "reqbody": _req_body,
+    "rspbody": _rsp_body,
+    "body": lambda req: _req_body(req) + _rsp_body(req),
+}
+
+_kv_fields = {
+    "reqheader": _req_headers,
+    "rspheader": _rsp_headers,
+    "header": _all_headers,
+}
+
+
+def compile_filter(args):
+    # Returns a predicate for a single filter such as ["path", "contains", "/api"]
+    # or raises CannotEvaluate. The predicate may also raise CannotEvaluate if
+    # it needs data the request doesn't have loaded.
+    args = list(args)
+    inv = False
+    if len(args) > 0 and args[0] == "inv":
+        inv = True
+        args = args[1:]
+    if len(args) < 3:
+        raise CannotEvaluate("not enough arguments: {}".format(args))
+    field = _field_names.get(args[0])
+    if field in _str_fields or field in _body_fields:
+        if len(args) != 3:
+            raise CannotEvaluate("wrong number of arguments: {}".format(args))
+        if field in _str_fields:
+            getvals = _str_fields[field]
+            cmp = _compile_cmp(args[1], args[2])
+        else:
+            getvals = _body_fields[field]
+            cmp = _compile_cmp(args[1], args[2], binary=True)
+
+        def check(req):
+            return any(cmp(v) for v in getvals(req))
+    elif field in _kv_fields:
+        getpairs = _kv_fields[field]
+        if len(args) == 3:
+            # a single comparison matches either the key or the value
+            cmp = _compile_cmp(args[1], args[2])
+
+            def check(req):
+                return any(cmp(k) or cmp(v) for k, v in getpairs(req))
+        elif len(args) == 5:
+            kcmp = _compile_cmp(args[1], args[2])
+            vcmp = _compile_cmp(args[3], args[4])
+
+            def check(req):
+                return any(kcmp(k) and vcmp(v) for k, v in getpairs(req))
+        else:
+            raise CannotEvaluate("wrong number of arguments: {}".format(args))
+    else:
+        raise CannotEvaluate("field not supported: {}".format(args[0]))
+
+    if inv:
+        return lambda req: not check(req)
+    return check
+
+
+class CompiledQuery:
+    # A query compiled into predicates. check() returns True or False when the
+    # request could be checked completely and otherwise the part of the query
+    # that is left for the backend to check.
+
+    def __init__(self, query):
+        self.query = query
+        self.phrases = []  # [[(args, predicate or None)]]
+        self.local = True  # every filter can be evaluated locally
+        for phrase in query:
+            filters = []
+            for args in phrase:
+                try:
+                    pred = compile_filter(args)
+                except CannotEvaluate:
+                    pred = None
+                    self.local = False
+                filters.append((args, pred))
+            self.phrases.append(filters)
+
+    def _check_phrase(self, filters, req):
+        remaining = []
+        for args, pred in filters:
+            if pred is not None:
+                try:
+                    if pred(req):
+                        return True
+                    continue
+                except CannotEvaluate:
+                    pass
+            remaining.append(args)
+        if len(remaining) == 0:
+            return False
+        return remaining
+
+    def check(self, req):
+        remaining = []
+        for filters in self.phrases:
+            result = self._check_phrase(filters, req)
+            if result is False:
+                return False
+            if result is not True:
+                remaining.append(result)
+        if len(remaining) == 0:
+            return True
+        return remaining
+
+
+class QueryMatcher:
+    # Checks requests against a query locally, only asking the backend about
+    # the filters that can't be evaluated on the client
+
+    def __init__(self, client, query):
+        self.client = client
+        self.compiled = CompiledQuery(query)
+        self.local_checks = 0
+        self.remote_checks = 0
+
+    @property
+    def query(self):
+        return self.compiled.query
+
+    def matches(self, req):
+        result = self.compiled.check(req)
+        if result is True or result is False:
+            self.local_checks += 1
+            return result
+        self.remote_checks += 1
+        if req.db_id != "":
+            return self.client.check_request(result, reqid=self.client.get_reqid(req))
+        return self.client.check_request(result, req=req)
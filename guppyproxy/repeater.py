@@ -123,7 +123,7 @@ class RepeaterWidget(QWidget):
             return
         req.dest_host = host
         req.dest_port = port
-        req.dest_usetls = usetls
+        req.use_tls = usetls
         try:
             self.client.submit(req, save=True)
             self.req = req
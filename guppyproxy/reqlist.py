@@ -1,13 +1,20 @@
 import threading
 import shlex
 
+from array import array
+from collections import deque, namedtuple, OrderedDict
+
 from guppyproxy.util import max_len_str, query_to_str, display_error_box, display_info_box, display_req_context, display_multi_req_context, hostport, method_color, sc_color, DisableUpdates, host_color
-from guppyproxy.proxy import HTTPRequest, RequestContext, InvalidQuery, SocketClosed, time_to_nsecs, ProxyThread
+from guppyproxy.proxy import (HTTPRequest, RequestContext, InvalidQuery, MessageError, SocketClosed,
+                              ProxyException, ProxyThread, EVENTS_RECONNECTED)
+from guppyproxy.query import QueryMatcher
+from guppyproxy.rowstore import RowStore, format_hostport, numpy
 from guppyproxy.reqview import ReqViewWidget
-from guppyproxy.reqtree import ReqTreeView
+from guppyproxy.reqtree import ReqTreeView, PathTrie, build_tree
 from PyQt5.QtWidgets import QWidget, QTableWidget, QTableWidgetItem, QGridLayout, QHeaderView, QAbstractItemView, QVBoxLayout, QHBoxLayout, QComboBox, QTabWidget, QPushButton, QLineEdit, QStackedLayout, QToolButton, QCheckBox, QLabel, QTableView, QMenu
-from PyQt5.QtCore import pyqtSlot, pyqtSignal, QObject, QVariant, Qt, QAbstractTableModel, QModelIndex, QItemSelection, QSortFilterProxyModel
-from itertools import groupby, count
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QObject, QVariant, Qt, QAbstractTableModel, QModelIndex, QItemSelection, QSortFilterProxyModel, QTimer
+from itertools import groupby
+from urllib.parse import urlparse
 
 def get_field_entry():
     dropdown = QComboBox()
@@ -78,9 +85,7 @@ class StringCmpWidget(QWidget):
 
 
 def dt_sort_key(r):
-    if r.time_start:
-        return time_to_nsecs(r.time_start)
-    return 0
+    return r.time_start_ns or 0
 
 
 class StringKVWidget(QWidget):
@@ -428,9 +433,19 @@ class FilterEditor(QWidget):
             self.entry.set_entry(0)
         
 
-class ReqListModel(QAbstractTableModel):
-    requestsLoading = pyqtSignal()
-    requestsLoaded = pyqtSignal()
+class _ReqRow:
+    # A request in the paged list with the strings shown for it, which are
+    # filled in as the view asks for them
+    __slots__ = ("req", "reqid", "cells")
+
+    def __init__(self, req, reqid):
+        self.req = req
+        self.reqid = reqid
+        self.cells = None
+
+
+class ReqTableModel(QAbstractTableModel):
+    # The columns of the history table, shared by its models
     
     HD_ID = 0
     HD_VERB = 1
@@ -443,6 +458,9 @@ class ReqListModel(QAbstractTableModel):
     HD_TAGS = 8
     HD_MNGL = 9
 
+    MAX_PATH_LEN = 60
+    MAX_TAG_LEN = 40
+
     def __init__(self, client, *args, **kwargs):
         QAbstractTableModel.__init__(self, *args, **kwargs)
         self.client = client
@@ -470,183 +488,903 @@ class ReqListModel(QAbstractTableModel):
             self.HD_TAGS: "Tags",
             self.HD_MNGL: "Mngl",
         }
-        self.reqs = []
-        self.sort_enabled = False
         self.header_count = len(self.header_order)
-        self.reqs_loaded = 0
+        self.color_cache = {}  # (column, host/status code/method) -> QColor
+        self.hides_unmangled = True  # originals of mangled requests are taken out of the list
             
     def headerData(self, section, orientation, role):
         if role == Qt.DisplayRole and orientation == Qt.Horizontal:
             hd = self.header_order[section]
             return self.table_headers[hd]
         return QVariant()
-            
-    def rowCount(self, parent):
-        return self.reqs_loaded
     
     def columnCount(self, parent):
+        if parent is not None and parent.isValid():
+            return 0
         return self.header_count
-    
-    def _gen_req_row(self, req):
-        MAX_PATH_LEN = 60
-        MAX_TAG_LEN = 40
+
+    def _cached_color(self, hd, value):
+        ckey = (hd, value)
+        color = self.color_cache.get(ckey)
+        if color is None:
+            if hd == self.HD_HOST:
+                color = host_color(value)
+            elif hd == self.HD_SCODE:
+                color = sc_color(str(value))
+            else:
+                color = method_color(value)
+            self.color_cache[ckey] = color
+        return color
+
+
+def _split_reqid(client, reqid):
+    # (storage or None, db id), split the same way as ProxyClient.parse_reqid
+    prefix = ""
+    db_id = reqid
+    if reqid[0].isalpha():
+        prefix = reqid[0]
+        db_id = reqid[1:]
+    return client.storage_by_prefix.get(prefix), db_id
+
+
+class _TreeDeltas:
+    # Stands in for the PathTrie of a paged list while the trie is being
+    # loaded and keeps the changes that would have gone into it, so they can
+    # be applied to the loaded trie once it's done.
+
+    def __init__(self, client):
+        self.client = client
+        self.deltas = OrderedDict()  # reqid -> [first version seen, latest version or None]
+
+    def add_request(self, req, sign=1):
         reqid = self.client.get_reqid(req)
-        method = req.method
-        host = hostport(req)
-        path = max_len_str(req.url.path, MAX_PATH_LEN)
-        reqlen = str(req.content_length)
-        tags = max_len_str(', '.join(sorted(req.tags)), MAX_TAG_LEN)
-        
-        if req.response:
-            scode = str(req.response.status_code) + ' ' + req.response.reason
-            rsplen = str(req.response.content_length)
-        else:
-            scode = "--"
-            rsplen = "--"
+        delta = self.deltas.get(reqid)
+        if delta is None:
+            delta = self.deltas[reqid] = [req, None]
+        delta[1] = req if sign > 0 else None
+
+    def replay(self, tree, loaded_ids):
+        # Requests the load saw are assumed to be in the trie as they were
+        # when they were first seen here and are swapped for their latest
+        # version. The rest only came in after the load got past them.
+        for reqid, (first, latest) in self.deltas.items():
+            if first is latest:
+                if reqid not in loaded_ids:
+                    tree.add_request(latest)
+                continue
+            if reqid in loaded_ids:
+                tree.add_request(first, -1)
+            if latest is not None:
+                tree.add_request(latest)
+
+
+def _mangle_str(req_mangled, rsp_mangled):
+    if req_mangled and rsp_mangled:
+        return "q/s"
+    elif req_mangled:
+        return "q"
+    elif rsp_mangled:
+        return "s"
+    return "N/A"
+
+
+class ReqListModel(ReqTableModel):
+    # The requests in the list are kept in a RowStore and rows in display
+    # order are kept as store rows so a row can be inserted or found with a
+    # binary search. Rows are sorted by a key ending with the row's storage
+    # id, db id and store row so no two rows have the same key.
+    requestsLoading = pyqtSignal()
+    requestsLoaded = pyqtSignal()
+
+    def __init__(self, client, keep_requests=False, *args, **kwargs):
+        ReqTableModel.__init__(self, client, *args, **kwargs)
+        # keep_requests keeps every request as an object rather than loading
+        # the ones in storage again when they're selected
+        self.keep_requests = keep_requests
+        self.store = RowStore(keep_requests)
+        self.order = array("i")  # store rows in display order
+        self.sort_column = None  # None sorts by start time
+        self.sort_reverse = True
+        self.reqs_loaded = 0
+        self.tree = None  # a PathTrie kept up to date with the requests in the list
+            
+    def rowCount(self, parent):
+        if parent is not None and parent.isValid():
+            return 0
+        return self.reqs_loaded
+
+    def _reqid(self, i):
+        db_id = self.store.db_id_str(i)
+        if db_id == "":
+            return ""
+        storage = self.client.storage_by_id.get(self.store.storage_id[i])
+        if storage is None:
+            return db_id
+        return storage.prefix + db_id
+
+    def _format_cell(self, i, hd):
+        store = self.store
+        if hd == self.HD_ID:
+            return self._reqid(i)
+        if hd == self.HD_VERB:
+            return store.methods[store.method[i]]
+        if hd == self.HD_HOST:
+            return store.hostport(i)
+        if hd == self.HD_PATH:
+            return max_len_str(urlparse(store.paths[store.path[i]]).path, self.MAX_PATH_LEN)
+        if hd == self.HD_SCODE:
+            if store.status[i] >= 0:
+                return str(store.status[i]) + ' ' + store.reasons[store.reason[i]]
+            return "--"
+        if hd == self.HD_REQLEN:
+            return str(store.req_len[i])
+        if hd == self.HD_RSPLEN:
+            if store.status[i] >= 0:
+                return str(store.rsp_len[i])
+            return "--"
+        if hd == self.HD_TIME:
+            duration = store.duration(i)
+            if duration is not None:
+                return "%.2f" % (duration / 1000000000)
+            return "--"
+        if hd == self.HD_TAGS:
+            return max_len_str(', '.join(store.tags_of(i)), self.MAX_TAG_LEN)
+        flags = store.flags[i]
+        return _mangle_str(flags & RowStore.FLAG_REQ_MANGLED, flags & RowStore.FLAG_RSP_MANGLED)
+
+    def _color(self, i, column):
+        store = self.store
+        hd = self.header_order[column]
+        if hd == self.HD_HOST:
+            return self._cached_color(hd, store.hostport(i))
+        if hd == self.HD_SCODE:
+            if store.status[i] < 0:
+                return None
+            return self._cached_color(hd, store.status[i])
+        if hd == self.HD_VERB:
+            return self._cached_color(hd, store.methods[store.method[i]])
+        return None
 
-        if req.time_start and req.time_end:
-            time_delt = req.time_end - req.time_start
-            reqtime = ("%.2f" % time_delt.total_seconds())
-        else:
-            reqtime = "--"
-        if req.unmangled and req.response and req.response.unmangled:
-            manglestr = "q/s"
-        elif req.unmangled:
-            manglestr = "q"
-        elif req.response and req.response.unmangled:
-            manglestr = "s"
-        else:
-            manglestr = "N/A"
-        return (req, reqid, method, host, path, scode, reqlen, rsplen, reqtime, tags, manglestr)
-        
-    
     def data(self, index, role):
         if role == Qt.BackgroundColorRole:
-           req = self.reqs[index.row()][0]
-           if index.column() == 2:
-               return host_color(hostport(req))
-           elif index.column() == 4:
-               if req.response:
-                   return sc_color(str(req.response.status_code))
-           elif index.column() == 1:
-               return method_color(req.method)
-           return QVariant()
+            color = self._color(self.order[index.row()], index.column())
+            if color is None:
+                return QVariant()
+            return color
         elif role == Qt.DisplayRole:
-           rowdata = self.reqs[index.row()]
-           return rowdata[index.column()+1]
+            return self._format_cell(self.order[index.row()], self.header_order[index.column()])
         return QVariant()
-    
+
     def canFetchMore(self, parent):
         if parent.isValid():
             return False
-        return (self.reqs_loaded < len(self.reqs))
+        return (self.reqs_loaded < len(self.order))
     
     def fetchMore(self, parent):
         if parent.isValid():
             return
-        if self.reqs_loaded == len(self.reqs):
+        if self.reqs_loaded == len(self.order):
             return
         n_to_fetch = 50
-        if self.reqs_loaded + n_to_fetch > len(self.reqs):
-            n_to_fetch = len(self.reqs) - self.reqs_loaded
-        self.beginInsertRows(QModelIndex(), self.reqs_loaded, self.reqs_loaded + n_to_fetch)
+        if self.reqs_loaded + n_to_fetch > len(self.order):
+            n_to_fetch = len(self.order) - self.reqs_loaded
+        self.beginInsertRows(QModelIndex(), self.reqs_loaded, self.reqs_loaded + n_to_fetch - 1)
         self.reqs_loaded += n_to_fetch
         self.endInsertRows()
 
-    def _sort_reqs(self):
-        def skey(rowdata):
-            return dt_sort_key(rowdata[0])
-        if self.sort_enabled:
-            self.reqs = sorted(self.reqs, key=skey, reverse=True)
-        
-    def _req_ind(self, req=None, reqid=None):
+    def _sort_key(self, i):
+        store = self.store
+        col = self.sort_column
+        if col is None:
+            primary = store.time_start[i]
+        elif col == self.HD_ID:
+            primary = 0
+        elif col == self.HD_VERB:
+            primary = store.methods[store.method[i]]
+        elif col == self.HD_HOST:
+            primary = store.hostport(i)
+        elif col == self.HD_PATH:
+            primary = store.paths[store.path[i]]
+        elif col == self.HD_SCODE:
+            primary = store.status[i]
+        elif col == self.HD_REQLEN:
+            primary = store.req_len[i]
+        elif col == self.HD_RSPLEN:
+            primary = store.rsp_len[i]
+        elif col == self.HD_TIME:
+            primary = store.duration(i)
+            if primary is None:
+                primary = -1
+        elif col == self.HD_TAGS:
+            primary = ', '.join(store.tags_of(i))
+        else:
+            flags = store.flags[i]
+            primary = _mangle_str(flags & RowStore.FLAG_REQ_MANGLED, flags & RowStore.FLAG_RSP_MANGLED)
+        return (primary, store.storage_id[i], store.db_id[i], i)
+
+    def _sort_values(self, rows):
+        # a numpy array that sorts like the first part of _sort_key
+        store = self.store
+        col = self.sort_column
+        idx = numpy.frombuffer(rows, dtype="int32")
+        if col is None:
+            return store.view("time_start")[idx]
+        if col == self.HD_ID:
+            return numpy.zeros(len(idx), dtype="int64")
+        if col == self.HD_SCODE:
+            return store.view("status")[idx]
+        if col == self.HD_REQLEN:
+            return store.view("req_len")[idx]
+        if col == self.HD_RSPLEN:
+            return store.view("rsp_len")[idx]
+        if col == self.HD_TIME:
+            start = store.view("time_start")[idx]
+            end = store.view("time_end")[idx]
+            return numpy.where((start != 0) & (end != 0), end - start, -1)
+        # string columns are sorted by the rank of their strings
+        if col == self.HD_VERB:
+            codes = store.view("method")[idx]
+            fmt = store.methods.__getitem__
+        elif col == self.HD_HOST:
+            codes = ((store.view("host")[idx].astype("int64") << 17)
+                     | (store.view("port")[idx].astype("int64") << 1)
+                     | (store.view("flags")[idx] & RowStore.FLAG_TLS))
+            fmt = lambda c: format_hostport(store.hosts[c >> 17], (c >> 1) & 0xffff, c & 1)
+        elif col == self.HD_PATH:
+            codes = store.view("path")[idx]
+            fmt = store.paths.__getitem__
+        elif col == self.HD_TAGS:
+            codes = store.view("tags")[idx]
+            fmt = lambda c: ', '.join(store.tag_sets[c])
+        else:
+            codes = store.view("flags")[idx] & (RowStore.FLAG_REQ_MANGLED | RowStore.FLAG_RSP_MANGLED)
+            fmt = lambda c: _mangle_str(c & RowStore.FLAG_REQ_MANGLED, c & RowStore.FLAG_RSP_MANGLED)
+        return store.ranks(codes, fmt)
+
+    def _sorted(self, rows):
+        # rows in display order, sorted a column at a time when numpy is around
+        if numpy is None or len(rows) < 2:
+            return array("i", sorted(rows, key=self._sort_key, reverse=self.sort_reverse))
+        return self.store.sort_rows(rows, self._sort_values(rows), self.sort_reverse)
+
+    def _bisect(self, key, lo=0):
+        # index of the first row that sorts at or after key
+        order = self.order
+        hi = len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._before(self._sort_key(order[mid]), key):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _before(self, a, b):
+        if self.sort_reverse:
+            return a > b
+        return a < b
+
+    def _find_row(self, req=None, reqid=None):
+        # the store row of a request or -1
         if not reqid:
-            reqid = self.client.get_reqid(req)
-        for ind, rowdata in zip(count(), self.reqs):
-            req = rowdata[0]
-            if self.client.get_reqid(req) == reqid:
-                return ind
+            return self.store.find_request(req)
+        storage, db_id = _split_reqid(self.client, reqid)
+        if storage is None:
+            return -1
+        return self.store.find(storage.storage_id, db_id)
+
+    def _row_ind(self, i):
+        if i < 0:
+            return -1
+        ind = self._bisect(self._sort_key(i))
+        if ind < len(self.order) and self.order[ind] == i:
+            return ind
         return -1
-    
+
+    def _req_ind(self, req=None, reqid=None):
+        return self._row_ind(self._find_row(req, reqid))
+
     def _emit_all_data(self):
         self.dataChanged.emit(self.createIndex(0, 0), self.createIndex(self.rowCount(None), self.columnCount(None)))
-        
-    def _set_requests(self, reqs):
-        self.reqs = [self._gen_req_row(req) for req in reqs]
-        self.reqs_loaded = 0
-    
-    def set_requests(self, reqs):
+
+    def _tree_row(self, i, sign=1):
+        if self.tree is not None:
+            self.tree.add_store_row(self.store, i, sign)
+
+    def set_store(self, store, tree_root=None):
+        # show the requests in a store that was filled somewhere else,
+        # tree_root is the root of a PathTrie that was built from it
         self.beginResetModel()
-        self._set_requests(reqs)
-        self._sort_reqs()
+        self.store = store
+        self.order = self._sorted(store.live_rows())
+        self.reqs_loaded = 0
         self._emit_all_data()
         self.endResetModel()
-    
+        if self.tree is not None:
+            if tree_root is None:
+                tree_root = build_tree(store)
+            self.tree.set_root(tree_root)
+
+    def set_requests(self, reqs):
+        store = RowStore(self.keep_requests)
+        store.extend(reqs)
+        self.set_store(store)
+
     def clear(self):
         self.beginResetModel()
-        self.reqs = []
+        self.store = RowStore(self.keep_requests)
+        self.order = array("i")
         self.reqs_loaded = 0
         self._emit_all_data()
         self.endResetModel()
+        if self.tree is not None:
+            self.tree.clear()
+
+    def _insert_run(self, pos, rows):
+        # rows past the loaded ones are added without telling the view, it
+        # will get them from fetchMore
+        visible = pos < self.reqs_loaded or self.reqs_loaded == len(self.order)
+        if visible:
+            self.beginInsertRows(QModelIndex(), pos, pos + len(rows) - 1)
+        self.order[pos:pos] = array("i", rows)
+        if visible:
+            self.reqs_loaded += len(rows)
+            self.endInsertRows()
+
+    def _insert_rows(self, rows):
+        # Insert store rows at their sorted positions with one beginInsertRows
+        # per run of rows that end up next to each other
+        if len(rows) == 0:
+            return
+        if len(rows) > len(self.order):
+            # cheaper to sort everything again
+            self.beginResetModel()
+            self.order = self._sorted(self.order + array("i", rows))
+            self.reqs_loaded = 0
+            self.endResetModel()
+            return
+        new = sorted((self._sort_key(i), i) for i in rows)
+        if self.sort_reverse:
+            new.reverse()
+        i = 0
+        lo = 0
+        while i < len(new):
+            pos = self._bisect(new[i][0], lo)
+            j = i + 1
+            if pos == len(self.order):
+                j = len(new)
+            else:
+                nxt = self._sort_key(self.order[pos])
+                while j < len(new) and self._before(new[j][0], nxt):
+                    j += 1
+            self._insert_run(pos, [row for _, row in new[i:j]])
+            lo = pos + j - i
+            i = j
+
+    def _remove_inds(self, inds, delete=True):
+        # remove rows with one beginRemoveRows per run of adjacent rows,
+        # delete also takes them out of the store
+        inds = sorted(set(ind for ind in inds if ind >= 0))
+        runs = [[ind for _, ind in grp] for _, grp in groupby(enumerate(inds), lambda p: p[1] - p[0])]
+        for run in reversed(runs):
+            start, end = run[0], run[-1]
+            if delete:
+                for i in self.order[start:end + 1]:
+                    self._tree_row(i, -1)
+                    self.store.delete(i)
+            if start < self.reqs_loaded:
+                vis_end = min(end, self.reqs_loaded - 1)
+                self.beginRemoveRows(QModelIndex(), start, vis_end)
+                del self.order[start:end + 1]
+                self.reqs_loaded -= vis_end - start + 1
+                self.endRemoveRows()
+            else:
+                del self.order[start:end + 1]
 
-    def add_request_head(self, req):
-        self.beginInsertRows(QModelIndex(), 0, 0)
-        self.reqs = [self._gen_req_row(req)] + self.reqs
-        self.reqs_loaded += 1
-        self.endInsertRows()
-    
     def add_request(self, req):
-        self.beginResetModel()
-        self.reqs.append(self._gen_req_row(req))
-        self.reqs_loaded = 0
-        self._sort_reqs()
-        self._emit_all_data()
-        self.endResetModel()
-        
+        self.add_requests([req])
+
     def add_requests(self, reqs):
-        self.beginResetModel()
+        # requests that are already in the list are updated instead
+        new = []
+        existing = []
         for req in reqs:
-            self.reqs.append(self._gen_req_row(req))
-        self.reqs_loaded = 0
-        self._sort_reqs()
-        self._emit_all_data()
-        self.endResetModel()
-    
+            if self._find_row(req) >= 0:
+                existing.append(req)
+            else:
+                i = self.store.append(req)
+                self._tree_row(i)
+                new.append(i)
+        self._insert_rows(new)
+        if existing:
+            self.update_requests(existing)
+
     def update_request(self, req):
-        ind = self._req_ind(req)
-        if ind < 0:
-            return
-        self.reqs[ind] = self._gen_req_row(req)
-        self.dataChanged.emit(self.createIndex(ind, 0), self.createIndex(ind, self.rowCount(None)))
+        self.update_requests([req])
+
+    def update_requests(self, reqs):
+        # Update the rows of many requests. Rows that stay in place get a
+        # single dataChanged, rows whose sort key changed are moved.
+        found = OrderedDict()  # store row -> (index, newest version of the request)
+        for req in reqs:
+            i = self._find_row(req)
+            ind = self._row_ind(i)
+            if ind >= 0:
+                found[i] = (ind, req)
+        changed = []
+        moved = []
+        # rows are only changed once every index was found
+        for i, (ind, req) in found.items():
+            key = self._sort_key(i)
+            self._tree_row(i, -1)
+            self.store.set(i, req)
+            self._tree_row(i)
+            if self._sort_key(i) == key:
+                if ind < self.reqs_loaded:
+                    changed.append(ind)
+            else:
+                moved.append((ind, i))
+        if changed:
+            self.dataChanged.emit(self.createIndex(min(changed), 0),
+                                  self.createIndex(max(changed), self.columnCount(None) - 1))
+        if moved:
+            self._remove_inds([ind for ind, _ in moved], delete=False)
+            self._insert_rows([i for _, i in moved])
+
+    def delete_requests(self, reqids):
+        self._remove_inds([self._req_ind(reqid=reqid) for reqid in reqids])
 
     def delete_request(self, req=None, reqid=None):
-        ind = self._req_ind(req, reqid)
-        if ind < 0:
-            return
-        self.beginRemoveRows(QModelIndex(), ind, ind)
-        self.reqs_loaded -= 1
-        self.reqs = self.reqs[:ind] + self.reqs[(ind+1):]
-        self.endRemoveRows()
-        
+        self._remove_inds([self._req_ind(req, reqid)])
+
     def has_request(self, req=None, reqid=None):
         if self._req_ind(req, reqid) < 0:
             return False
         return True
-    
+
     def get_requests(self):
-        return [row[0] for row in self.reqs]
-    
-    def disable_sort(self):
-        self.sort_enabled = False
+        return [self.store.request(i) for i in self.order]
+
+    def get_reqids(self):
+        return [self._reqid(i) for i in self.order]
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        # Sort by a column using the rows that are already loaded. A column
+        # outside the table goes back to newest first.
+        if column < 0 or column >= len(self.header_order):
+            self.sort_column = None
+            self.sort_reverse = True
+        else:
+            self.sort_column = self.header_order[column]
+            self.sort_reverse = (order == Qt.DescendingOrder)
+        self.layoutAboutToBeChanged.emit()
+        old = self.persistentIndexList()
+        old_rows = [self.order[idx.row()] for idx in old]
+        self.order = self._sorted(self.order)
+        new = []
+        for idx, i in zip(old, old_rows):
+            ind = self._row_ind(i)
+            if ind < 0 or ind >= self.reqs_loaded:
+                new.append(QModelIndex())
+            else:
+                new.append(self.index(ind, idx.column()))
+        self.changePersistentIndexList(old, new)
+        self.layoutChanged.emit()
 
-    def enable_sort(self):
-        self.sort_enabled = True
-        self._sort_reqs()
-        
     def req_by_ind(self, ind):
-        return self.reqs[ind][0]
+        # built from the store unless it was kept
+        return self.store.request(self.order[ind])
 
     
+class PagedReqListModel(ReqTableModel):
+    # A query that can match millions of requests. Only the number of matches
+    # in each storage is known up front and rows are fetched a page at a time
+    # as the view scrolls to them, keeping the most recently used pages.
+    # Storages are shown one after another, each newest first. Requests that
+    # arrive after the counts were taken are kept at the top of their storage
+    # so the offsets of the pages below them can be worked out.
+
+    pageLoaded = pyqtSignal(int, object, int, object)  # generation, page key, head length, requests
+    countsChecked = pyqtSignal(object)  # [(storage id, count)] or None if they couldn't be counted
+    refreshNeeded = pyqtSignal()
+
+    def __init__(self, client, query, counts, page_size=200, max_pages=50, max_head=5000,
+                 max_loading=2, recount_ms=500, *args, **kwargs):
+        ReqTableModel.__init__(self, client, *args, **kwargs)
+        self.query = query
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.max_head = max_head
+        self.max_loading = max_loading
+        self.hides_unmangled = False  # the originals are rows in storage too
+        self.segments = [[sid, n, []] for sid, n in counts]  # [storage id, count, new rows newest first]
+        self.pages = OrderedDict()  # (storage id, page) -> rows, most recently used last
+        self.row_by_id = {}  # reqid -> _ReqRow for every row in memory
+        self.loading = set()
+        self.wanted = deque()  # pages waiting to be fetched, most recently wanted last
+        self.generation = 0
+        self.last_key = None
+        self.direction = 1
+        # a PathTrie of every match or a _TreeDeltas while it loads, both
+        # filled in by the table widget
+        self.tree = None
+        self.cleared = False
+        self.pageLoaded.connect(self._page_loaded)
+        self.countsChecked.connect(self._counts_checked)
+        # deletes of rows that aren't loaded are checked against the counts
+        # once a burst of them is over
+        self.recount_timer = QTimer(self)
+        self.recount_timer.setSingleShot(True)
+        self.recount_timer.setInterval(recount_ms)
+        self.recount_timer.timeout.connect(self._start_recount)
+
+    def rowCount(self, parent):
+        if parent is not None and parent.isValid():
+            return 0
+        return sum(len(seg[2]) + seg[1] for seg in self.segments)
+
+    def canFetchMore(self, parent):
+        return False
+
+    def fetchMore(self, parent):
+        pass
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        # rows come from storage newest first
+        pass
+
+    def _gen_req_row(self, req):
+        return _ReqRow(req, self.client.get_reqid(req))
+
+    def _format_cell(self, row, hd):
+        req = row.req
+        if hd == self.HD_ID:
+            return row.reqid
+        if hd == self.HD_VERB:
+            return req.method
+        if hd == self.HD_HOST:
+            return hostport(req)
+        if hd == self.HD_PATH:
+            return max_len_str(req.url.path, self.MAX_PATH_LEN)
+        if hd == self.HD_SCODE:
+            if req.response:
+                return str(req.response.status_code) + ' ' + req.response.reason
+            return "--"
+        if hd == self.HD_REQLEN:
+            return str(req.content_length)
+        if hd == self.HD_RSPLEN:
+            if req.response:
+                return str(req.response.content_length)
+            return "--"
+        if hd == self.HD_TIME:
+            if req.time_start_ns and req.time_end_ns:
+                return "%.2f" % ((req.time_end_ns - req.time_start_ns) / 1000000000)
+            return "--"
+        if hd == self.HD_TAGS:
+            return max_len_str(', '.join(req.sorted_tags()), self.MAX_TAG_LEN)
+        return _mangle_str(req.unmangled, req.response and req.response.unmangled)
+
+    def _cell(self, row, column):
+        # cells are formatted the first time the view asks for them
+        if row.cells is None:
+            row.cells = [None] * self.header_count
+        val = row.cells[column]
+        if val is None:
+            val = self._format_cell(row, self.header_order[column])
+            row.cells[column] = val
+        return val
+
+    def _color(self, row, column):
+        hd = self.header_order[column]
+        if hd == self.HD_HOST:
+            return self._cached_color(hd, self._cell(row, column))
+        if hd == self.HD_SCODE:
+            if not row.req.response:
+                return None
+            return self._cached_color(hd, row.req.response.status_code)
+        if hd == self.HD_VERB:
+            return self._cached_color(hd, row.req.method)
+        return None
+
+    def _segment(self, storage_id):
+        for seg in self.segments:
+            if seg[0] == storage_id:
+                return seg
+        return None
+
+    def _segment_start(self, segment):
+        start = 0
+        for seg in self.segments:
+            if seg is segment:
+                return start
+            start += len(seg[2]) + seg[1]
+        return -1
+
+    def _locate(self, row):
+        # (segment, index in the new rows or None, page key, index in page)
+        if row < 0:
+            return None, None, None, 0
+        for seg in self.segments:
+            size = len(seg[2]) + seg[1]
+            if row < size:
+                if row < len(seg[2]):
+                    return seg, row, None, 0
+                snap = row - len(seg[2])
+                return seg, None, (seg[0], snap // self.page_size), snap % self.page_size
+            row -= size
+        return None, None, None, 0
+
+    def _row(self, ind, fetch=True):
+        seg, head_ind, key, page_ind = self._locate(ind)
+        if seg is None:
+            return None
+        if head_ind is not None:
+            return seg[2][head_ind]
+        if fetch and key != self.last_key:
+            self._scrolled_to(seg, key)
+        rows = self.pages.get(key)
+        if rows is None:
+            if fetch:
+                self._want(key)
+            return None
+        self.pages.move_to_end(key)
+        if page_ind >= len(rows):
+            return None
+        return rows[page_ind]
+
+    def _scrolled_to(self, seg, key):
+        # prefetch the next page in the direction the view is scrolling
+        if self.last_key is not None and self.last_key[0] == key[0]:
+            self.direction = 1 if key[1] > self.last_key[1] else -1
+        self.last_key = key
+        nxt = key[1] + self.direction
+        if 0 <= nxt and nxt * self.page_size < seg[1]:
+            self._want((key[0], nxt))
+
+    def _want(self, key):
+        if key in self.pages or key in self.loading:
+            return
+        try:
+            self.wanted.remove(key)
+        except ValueError:
+            pass
+        self.wanted.append(key)
+        while len(self.wanted) > self.max_pages:
+            # scrolled past long ago
+            self.wanted.popleft()
+        self._start_loads()
+
+    def _start_loads(self):
+        while len(self.wanted) > 0 and len(self.loading) < self.max_loading:
+            key = self.wanted.pop()
+            seg = self._segment(key[0])
+            if seg is None:
+                continue
+            self.loading.add(key)
+            offset = key[1] * self.page_size + len(seg[2])
+            ProxyThread(target=self._fetch_page,
+                        args=(self.generation, key, offset, len(seg[2]))).start()
+
+    def _fetch_page(self, generation, key, offset, head_len):
+        try:
+            page = self.client.query_storage_page(self.query, key[0], offset=offset,
+                                                  limit=self.page_size, headers_only=True)
+            reqs = page.requests
+        except (MessageError, SocketClosed, ProxyException):
+            reqs = None
+        self.pageLoaded.emit(generation, key, head_len, reqs)
+
+    @pyqtSlot(int, object, int, object)
+    def _page_loaded(self, generation, key, head_len, reqs):
+        if generation != self.generation:
+            return
+        self.loading.discard(key)
+        seg = self._segment(key[0])
+        if seg is not None and reqs is not None:
+            if len(seg[2]) != head_len:
+                # requests came in while it loaded so the offset was off
+                self._want(key)
+            else:
+                rows = [self._gen_req_row(req) for req in reqs]
+                self.pages[key] = rows
+                for row in rows:
+                    self.row_by_id[row.reqid] = row
+                while len(self.pages) > self.max_pages:
+                    _, old_rows = self.pages.popitem(last=False)
+                    for row in old_rows:
+                        if self.row_by_id.get(row.reqid) is row:
+                            del self.row_by_id[row.reqid]
+                if len(rows) > 0:
+                    first = self._segment_start(seg) + len(seg[2]) + key[1] * self.page_size
+                    self.dataChanged.emit(self.createIndex(first, 0),
+                                          self.createIndex(first + len(rows) - 1, self.header_count - 1))
+        self._start_loads()
+
+    def data(self, index, role):
+        if role == Qt.BackgroundColorRole:
+            row = self._row(index.row())
+            if row is None:
+                return QVariant()
+            color = self._color(row, index.column())
+            if color is None:
+                return QVariant()
+            return color
+        elif role == Qt.DisplayRole:
+            row = self._row(index.row())
+            if row is None:
+                return "..." if index.column() == 0 else ""
+            return self._cell(row, index.column())
+        return QVariant()
+
+    def _emit_all_data(self):
+        n = self.rowCount(None)
+        if n > 0:
+            self.dataChanged.emit(self.createIndex(0, 0), self.createIndex(n - 1, self.header_count - 1))
+
+    def _rebase(self):
+        # Fold the new rows into the counts. The rows stay where they are but
+        # every page is fetched again from the new offsets.
+        self.generation += 1
+        for seg in self.segments:
+            seg[1] += len(seg[2])
+            seg[2] = []
+        self.pages.clear()
+        self.row_by_id.clear()
+        self.loading.clear()
+        self.wanted.clear()
+        self.last_key = None
+        self._emit_all_data()
+
+    def add_request(self, req):
+        self.add_requests([req])
+
+    def add_requests(self, reqs):
+        # reqs are oldest first and go on top of their storage
+        new = OrderedDict()
+        existing = []
+        for req in reqs:
+            reqid = self.client.get_reqid(req)
+            if reqid in self.row_by_id:
+                existing.append(req)
+            elif self._segment(req.storage_id) is not None:
+                new.setdefault(req.storage_id, []).append(self._gen_req_row(req))
+                if self.tree is not None:
+                    self.tree.add_request(req)
+        if existing:
+            self.update_requests(existing)
+        for storage_id, rows in new.items():
+            seg = self._segment(storage_id)
+            start = self._segment_start(seg)
+            self.beginInsertRows(QModelIndex(), start, start + len(rows) - 1)
+            seg[2][0:0] = reversed(rows)
+            for row in rows:
+                self.row_by_id[row.reqid] = row
+            self.endInsertRows()
+        if sum(len(seg[2]) for seg in self.segments) > self.max_head:
+            self._rebase()
+
+    def update_requests(self, reqs):
+        changed = False
+        for req in reqs:
+            row = self.row_by_id.get(self.client.get_reqid(req))
+            if row is not None:
+                if self.tree is not None:
+                    self.tree.add_request(row.req, -1)
+                    self.tree.add_request(req)
+                row.req = req
+                row.cells = None
+                changed = True
+        if changed:
+            self._emit_all_data()
+
+    def _find(self, row):
+        # (absolute row, segment, page key or None, index)
+        start = 0
+        for seg in self.segments:
+            for i, r in enumerate(seg[2]):
+                if r is row:
+                    return start + i, seg, None, i
+            for key, rows in self.pages.items():
+                if key[0] != seg[0]:
+                    continue
+                for i, r in enumerate(rows):
+                    if r is row:
+                        return start + len(seg[2]) + key[1] * self.page_size + i, seg, key, i
+            start += len(seg[2]) + seg[1]
+        return -1, None, None, 0
+
+    def delete_requests(self, reqids):
+        for reqid in reqids:
+            row = self.row_by_id.get(reqid)
+            if row is None:
+                # It may have been one of the rows that aren't loaded and
+                # there's no telling where. If it was, the counts will be off.
+                storage, _ = _split_reqid(self.client, reqid)
+                if storage is not None and self._segment(storage.storage_id) is not None:
+                    self.recount_timer.start()
+                continue
+            ind, seg, key, i = self._find(row)
+            if ind < 0:
+                continue
+            if self.tree is not None:
+                self.tree.add_request(row.req, -1)
+            self.beginRemoveRows(QModelIndex(), ind, ind)
+            del self.row_by_id[reqid]
+            if key is None:
+                del seg[2][i]
+            else:
+                seg[1] -= 1
+                self.generation += 1  # pages being fetched used the old offsets
+                self.loading.clear()
+                # rows after it moved up, so the pages from here on are off by one
+                for k in [k for k in self.pages if k[0] == key[0] and k[1] >= key[1]]:
+                    for r in self.pages.pop(k):
+                        if self.row_by_id.get(r.reqid) is r:
+                            del self.row_by_id[r.reqid]
+            self.endRemoveRows()
+
+    def delete_request(self, req=None, reqid=None):
+        if not reqid:
+            reqid = self.client.get_reqid(req)
+        self.delete_requests([reqid])
+
+    @pyqtSlot()
+    def _start_recount(self):
+        ProxyThread(target=self._recount, args=([seg[0] for seg in self.segments],)).start()
+
+    def _recount(self, storage_ids):
+        try:
+            counts = [(sid, self.client.count_storage(self.query, storage=sid)) for sid in storage_ids]
+        except (MessageError, SocketClosed, ProxyException):
+            counts = None
+        self.countsChecked.emit(counts)
+
+    @pyqtSlot(object)
+    def _counts_checked(self, counts):
+        # only start over if a deleted request was one of the matches
+        if self.cleared:
+            return
+        if counts is not None and counts == [(seg[0], seg[1] + len(seg[2])) for seg in self.segments]:
+            return
+        self.refreshNeeded.emit()
+
+    def has_request(self, req=None, reqid=None):
+        if not reqid:
+            reqid = self.client.get_reqid(req)
+        return reqid in self.row_by_id
+
+    def get_requests(self):
+        # only the requests that are loaded
+        reqs = []
+        for seg in self.segments:
+            reqs += [row.req for row in seg[2]]
+            for page in sorted(k[1] for k in self.pages if k[0] == seg[0]):
+                reqs += [row.req for row in self.pages[(seg[0], page)]]
+        return reqs
+
+    def req_by_ind(self, ind):
+        row = self._row(ind, fetch=False)
+        if row is None:
+            return None
+        return row.req
+
+    def clear(self):
+        self.beginResetModel()
+        self.cleared = True
+        self.recount_timer.stop()
+        self.generation += 1
+        self.segments = []
+        self.pages.clear()
+        self.row_by_id.clear()
+        self.loading.clear()
+        self.wanted.clear()
+        self.last_key = None
+        self.endResetModel()
+
+    def set_requests(self, reqs):
+        raise NotImplementedError("a paged list is loaded from storage")
+
+
 class ReqBrowser(QWidget):
     # Widget containing request viewer, tabs to view list of reqs, filters, and (evevntually) site map
     # automatically updated with requests as they're saved
@@ -667,7 +1405,8 @@ class ReqBrowser(QWidget):
             self.updater = None
 
         # reqtable/search
-        self.listWidg = ReqTableWidget(client, repeater_widget=repeater_widget, macro_widget=macro_widget)
+        self.listWidg = ReqTableWidget(client, repeater_widget=repeater_widget, macro_widget=macro_widget,
+                                       keep_requests=not reload_reqs)
         if self.updater:
             self.updater.add_reqlist_widget(self.listWidg)
         self.listWidg.requestsSelected.connect(self.update_viewer)
@@ -690,19 +1429,18 @@ class ReqBrowser(QWidget):
             self.filterWidg.filtersEdited.connect(self.set_client_context)
         self.filterWidg.reset_to_scope()
 
-        # Tree widget
+        # Tree widget, kept up to date by the list
         self.treeWidg = ReqTreeView()
+        self.listWidg.set_tree(self.treeWidg.tree)
 
         # add tabs
         self.listTabs = QTabWidget()
         lwidg = QWidget()
         lwidg.setLayout(self.listLayout)
         self.listTabs.addTab(lwidg, "List")
-        self.tree_ind = self.listTabs.count()
         self.listTabs.addTab(self.treeWidg, "Tree")
         if filter_tab:
             self.listTabs.addTab(self.filterWidg, "Filters")
-        self.listTabs.currentChanged.connect(self._tab_changed)
 
         # reqview
         self.reqview = ReqViewWidget(info_tab=True, param_tab=True, tag_tab=True)
@@ -738,7 +1476,7 @@ class ReqBrowser(QWidget):
         if len(reqs) > 0:
             if self.reload_reqs:
                 reqh = reqs[0]
-                req = self.client.req_by_id(reqh.db_id)
+                req = self.client.load_by_reqheaders(reqh)
             else:
                 req = reqs[0]
             self.reqview.set_request(req)
@@ -749,86 +1487,183 @@ class ReqBrowser(QWidget):
 
     @pyqtSlot(HTTPRequest)
     def add_request_item(self, req):
-        self.listWidg.add_request_item(req)
-        self.treeWidg.add_request_item(req)
+        self.listWidg.add_request(req)
 
     @pyqtSlot(list)
     def set_requests(self, reqs):
         self.listWidg.set_requests(reqs)
-        self.treeWidg.set_requests(reqs)
-
-    @pyqtSlot(int)
-    def _tab_changed(self, i):
-        if i == self.tree_ind:
-            self.treeWidg.set_requests(self.listWidg.get_requests())
 
     @pyqtSlot(set)
     def _tags_updated(self, tags):
         req = self.reqview.req
         req.tags = tags
         if req.db_id:
-            reqid = self.client.get_reqid(req)
-            self.client.clear_tag(reqid)
-            for tag in tags:
-                self.client.add_tag(reqid, tag)
+            self.client.set_tags([self.client.get_reqid(req)], tags)
         
     def set_filter_is_text(self, is_text):
         self.filterWidg.set_is_text(is_text)
                 
 
-class ReqListUpdater(QObject):
+UpdaterStats = namedtuple("UpdaterStats", ["received", "delivered", "merged", "dropped",
+                                           "batches", "max_batch", "reloads"])
 
-    newRequest = pyqtSignal(HTTPRequest)
-    requestUpdated = pyqtSignal(HTTPRequest)
-    requestDeleted = pyqtSignal(str)
 
-    def __init__(self, client):
+class ReqListUpdater(QObject):
+    # Passes changes to storage on to the request lists in batches. Events come
+    # from the client's shared event bus and are collected for frame_ms. Events
+    # for the same request are merged, so a burst of traffic turns into at most
+    # one delete, one update and one insert per frame. If the bus had to
+    # reconnect, events may have been missed and the lists are loaded again.
+
+    requestsAdded = pyqtSignal(list)
+    requestsUpdated = pyqtSignal(list)
+    requestsDeleted = pyqtSignal(list)
+    reloadNeeded = pyqtSignal()
+
+    def __init__(self, client, frame_ms=50):
         QObject.__init__(self)
         self.mtx = threading.Lock()
         self.client = client
         self.reqlist_widgets = []
-        self.t = ProxyThread(target=self.run_updater)
-        self.t.start()
+        self.live_widgets = 0
+        self.pending = OrderedDict()  # reqid -> [action, request]
+
+        # stats
+        self.received = 0
+        self.delivered = 0
+        self.merged = 0  # folded into another event for the same request
+        self.dropped = 0  # cancelled out, e.g. added and deleted in one frame
+        self.batches = 0
+        self.max_batch = 0
+        self.reloads = 0
+
+        self.sub = self.client.subscribe_events()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self._flush)
+        self.timer.start(frame_ms)
 
     def add_reqlist_widget(self, widget):
         self.mtx.acquire()
         try:
-            self.newRequest.connect(widget.add_request)
-            self.requestUpdated.connect(widget.update_request)
-            self.requestDeleted.connect(widget.delete_request)
+            self.requestsAdded.connect(widget.add_requests_batch)
+            self.requestsUpdated.connect(widget.update_requests_batch)
+            self.requestsDeleted.connect(widget.delete_requests_batch)
+            self.reloadNeeded.connect(widget.reload_requests)
             self.reqlist_widgets.append(widget)
+            self.live_widgets += 1
         finally:
             self.mtx.release()
+        widget.destroyed.connect(self._reqlist_widget_destroyed)
 
-    def run_updater(self):
-        conn = self.client.new_conn()
-        try:
-            try:
-                for msg in conn.watch_storage():
-                    self.mtx.acquire()
-                    try:
-                        if msg["Action"] == "NewRequest":
-                            self.newRequest.emit(msg["Request"])
-                        elif msg["Action"] == "RequestUpdated":
-                            self.requestUpdated.emit(msg["Request"])
-                        elif msg["Action"] == "RequestDeleted":
-                            self.requestDeleted.emit(msg["MessageId"])
-                    finally:
-                        self.mtx.release()
-            except SocketClosed:
+    @pyqtSlot()
+    def _reqlist_widget_destroyed(self):
+        # stop listening to the bus once every list is gone. The signal
+        # doesn't carry the Python object of the widget, so only count them.
+        with self.mtx:
+            self.live_widgets -= 1
+            remaining = self.live_widgets
+            if remaining == 0:
+                self.reqlist_widgets = []
+        if remaining == 0:
+            self.stop()
+
+    def _queue_event(self, action, reqid, req):
+        with self.mtx:
+            self.received += 1
+            prev = self.pending.get(reqid)
+            if prev is None:
+                self.pending[reqid] = [action, req]
                 return
-        finally:
-            conn.close()
+            if action == "RequestDeleted":
+                if prev[0] == "NewRequest":
+                    # never shown so there is nothing to delete
+                    del self.pending[reqid]
+                    self.dropped += 2
+                    return
+                prev[0] = action
+                prev[1] = None
+            elif prev[0] == "RequestDeleted":
+                # the id came back, replace the row that is still there
+                prev[0] = "RequestUpdated"
+                prev[1] = req
+            else:
+                # a new request stays new but uses the latest version
+                prev[1] = req
+            self.merged += 1
+
+    def _queue_storage_event(self, event):
+        if event.action in ("NewRequest", "RequestUpdated"):
+            self._queue_event(event.action, self.client.get_reqid(event.request), event.request)
+        elif event.action == "RequestDeleted":
+            prefix = ""
+            if event.storage_id in self.client.storage_by_id:
+                prefix = self.client.storage_by_id[event.storage_id].prefix
+            self._queue_event(event.action, prefix + event.message_id, None)
+
+    @pyqtSlot()
+    def _flush(self):
+        reload = False
+        for event in self.sub.drain():
+            if event.action == EVENTS_RECONNECTED:
+                # the reload covers everything queued before it
+                reload = True
+                with self.mtx:
+                    self.dropped += len(self.pending)
+                    self.pending = OrderedDict()
+            else:
+                self._queue_storage_event(event)
+        if reload:
+            self.reloads += 1
+            self.reloadNeeded.emit()
+        with self.mtx:
+            if len(self.pending) == 0:
+                return
+            events = self.pending
+            self.pending = OrderedDict()
+            self.delivered += len(events)
+            self.batches += 1
+            self.max_batch = max(self.max_batch, len(events))
+        added = []
+        updated = []
+        deleted = []
+        for reqid, (action, req) in events.items():
+            if action == "NewRequest":
+                added.append(req)
+            elif action == "RequestUpdated":
+                updated.append(req)
+            else:
+                deleted.append(reqid)
+        if deleted:
+            self.requestsDeleted.emit(deleted)
+        if updated:
+            self.requestsUpdated.emit(updated)
+        if added:
+            self.requestsAdded.emit(added)
+
+    def stats(self):
+        with self.mtx:
+            return UpdaterStats(received=self.received, delivered=self.delivered,
+                                merged=self.merged, dropped=self.dropped,
+                                batches=self.batches, max_batch=self.max_batch,
+                                reloads=self.reloads)
 
     def stop(self):
-        self.conn.close()
+        self.timer.stop()
+        self.sub.close()
 
 
 class ReqTableWidget(QWidget):
     requestsChanged = pyqtSignal(list)
     requestsSelected = pyqtSignal(list)
+    filterLoaded = pyqtSignal(int, object, object)  # filter generation, RowStore, tree root or None
+    pagedFilterLoaded = pyqtSignal(int, list, list)  # filter generation, query, [(storage id, count)]
+    treeLoaded = pyqtSignal(int, object, object)  # filter generation, tree root or None, ids in the tree
+    filterFailed = pyqtSignal(int)  # filter generation
 
-    def __init__(self, client, repeater_widget=None, macro_widget=None, *args, **kwargs):
+    # queries matching at least this many requests are paged in from storage
+    PAGED_ROWS = 50000
+
+    def __init__(self, client, repeater_widget=None, macro_widget=None, keep_requests=False, *args, **kwargs):
         QWidget.__init__(self, *args, **kwargs)
         self.allow_save = False
 
@@ -836,12 +1671,16 @@ class ReqTableWidget(QWidget):
         self.repeater_widget = repeater_widget
         self.macro_widget = macro_widget
         self.query = []
+        self.query_matcher = QueryMatcher(self.client, self.query)
+        self.filter_gen = 0
         self.req_view_widget = None
+        self.tree = None
 
         self.setLayout(QStackedLayout())
         self.layout().setContentsMargins(0, 0, 0, 0)
         
-        self.tableModel = ReqListModel(self.client)
+        self.listModel = ReqListModel(self.client, keep_requests=keep_requests)
+        self.tableModel = self.listModel
         self.tableView = QTableView()
         self.tableView.setModel(self.tableModel)
 
@@ -851,11 +1690,20 @@ class ReqTableWidget(QWidget):
         self.tableView.setSelectionBehavior(QAbstractItemView.SelectRows)
         #self.tableView.setSelectionMode(QAbstractItemView.SingleSelection)
         self.tableView.horizontalHeader().setStretchLastSection(True)
+        # sorting is done by the model, clicking a header sorts by that column
+        self.tableView.horizontalHeader().setSectionsClickable(True)
+        self.tableView.horizontalHeader().setSortIndicatorShown(True)
+        self.tableView.horizontalHeader().setSortIndicator(-1, Qt.DescendingOrder)
+        self.tableView.horizontalHeader().sortIndicatorChanged.connect(self.tableModel.sort)
         
         self.tableView.selectionModel().selectionChanged.connect(self.on_select_change)
         self.tableModel.dataChanged.connect(self._paint_view)
         self.tableModel.rowsInserted.connect(self._on_rows_inserted)
         self.requestsChanged.connect(self.set_requests)
+        self.filterLoaded.connect(self._filter_loaded)
+        self.pagedFilterLoaded.connect(self._paged_filter_loaded)
+        self.treeLoaded.connect(self._tree_loaded)
+        self.filterFailed.connect(self._filter_failed)
         self.requestsSelected.connect(self._updated_selected_request)
         
         self.selected_reqs = []
@@ -863,19 +1711,46 @@ class ReqTableWidget(QWidget):
         self.layout().addWidget(self.tableView)
         self.layout().addWidget(QLabel("<b>Loading requests from data file...</b>"))
         
+    def set_tree(self, tree):
+        # keep a PathTrie up to date with the requests in the list
+        self.tree = tree
+        self.listModel.tree = tree
+        tree.set_root(build_tree(self.listModel.store))
+
     @pyqtSlot(HTTPRequest)
     def add_request(self, req):
         with DisableUpdates(self.tableView):
-            if req.db_id != "":
-                reqid = self.client.get_reqid(req)
-                if self.client.check_request(self.query, reqid=reqid):
-                    self.tableModel.add_request_head(req)
+            if self.query_matcher.matches(req):
+                self.tableModel.add_request(req)
+            if req.db_id != "" and self.tableModel.hides_unmangled:
                 if req.unmangled and req.unmangled.db_id != "" and self.tableModel.has_request(req.unmangled):
                     self.tableModel.delete_request(req.unmangled)
-            else:
-                if self.client.check_request(self.query, req=req):
-                    self.tableModel.add_request_head(req)
                     
+    @pyqtSlot(list)
+    def add_requests_batch(self, reqs):
+        # requests from the updater, oldest first
+        to_add = [req for req in reqs if self.query_matcher.matches(req)]
+        unmangled = [self.client.get_reqid(req.unmangled) for req in reqs
+                     if req.db_id != "" and req.unmangled and req.unmangled.db_id != ""]
+        with DisableUpdates(self.tableView):
+            self.tableModel.add_requests(to_add)
+            if unmangled and self.tableModel.hides_unmangled:
+                self.tableModel.delete_requests(unmangled)
+
+    @pyqtSlot(list)
+    def update_requests_batch(self, reqs):
+        unmangled = [self.client.get_reqid(req.unmangled) for req in reqs
+                     if req.db_id != "" and req.unmangled and req.unmangled.db_id != ""]
+        with DisableUpdates(self.tableView):
+            self.tableModel.update_requests(reqs)
+            if unmangled and self.tableModel.hides_unmangled:
+                self.tableModel.delete_requests(unmangled)
+
+    @pyqtSlot(list)
+    def delete_requests_batch(self, reqids):
+        with DisableUpdates(self.tableView):
+            self.tableModel.delete_requests(reqids)
+
     @pyqtSlot()
     def clear(self):
         self.tableModel.clear()
@@ -885,30 +1760,20 @@ class ReqTableWidget(QWidget):
 
     @pyqtSlot(list)
     def set_requests(self, reqs, check_filter=False):
-        to_add = []
         if not check_filter:
             to_add = reqs
         else:
-            for req in reqs:
-                if req.db_id != "":
-                    reqid = self.client.get_reqid(req)
-                    if self.client.check_request(self.query, reqid=reqid):
-                        to_add.append(req)
-                else:
-                    if self.client.check_request(self.query, req=req):
-                        to_add.append(req)
+            to_add = [req for req in reqs if self.query_matcher.matches(req)]
         with DisableUpdates(self.tableView):
-            self.clear()
-            self.tableModel.disable_sort()
-            self.tableModel.add_requests(to_add)
-            self.tableModel.enable_sort()
+            self._set_model(self.listModel)
+            self.tableModel.set_requests(to_add)
             self.set_is_not_loading()
 
     @pyqtSlot(HTTPRequest)
     def update_request(self, req):
         with DisableUpdates(self.tableView):
             self.tableModel.update_request(req)
-            if req.db_id != "":
+            if req.db_id != "" and self.tableModel.hides_unmangled:
                 if req.unmangled and req.unmangled.db_id != "":
                     self.tableModel.delete_request(reqid=self.client.get_reqid(req.unmangled))
 
@@ -920,8 +1785,142 @@ class ReqTableWidget(QWidget):
     @pyqtSlot(list)
     def set_filter(self, query):
         self.query = query
+        self.query_matcher = QueryMatcher(self.client, self.query)
         self.set_is_loading()
-        self.client.query_storage_async(self.requestsChanged, self.query, headers_only=True)
+        self.filter_gen += 1
+        ProxyThread(target=self._load_filter, args=(self.filter_gen, query)).start()
+
+    def _paged_counts(self, query):
+        # [(storage id, count)] if the query should be paged in from storage,
+        # otherwise None. The backend has to be able to count and page, the
+        # client remembers when it can't so it isn't asked every time.
+        if self.client.counting is False or self.client.paging is False:
+            return None
+        storage_ids = sorted(s.storage_id for s in self.client.storage_iter())
+        if self.client.proxy_storage in storage_ids:
+            storage_ids.remove(self.client.proxy_storage)
+            storage_ids.insert(0, self.client.proxy_storage)
+        try:
+            counts = [(sid, self.client.count_storage(query, storage=sid)) for sid in storage_ids]
+        except MessageError:
+            return None
+        if sum(n for _, n in counts) < self.PAGED_ROWS:
+            return None
+        sid = next(sid for sid, n in counts if n > 0)
+        try:
+            page = self.client.query_storage_page(query, sid, offset=1, limit=1, headers_only=True)
+        except MessageError:
+            return None
+        if not page.paged:
+            return None
+        return counts
+
+    def _load_filter(self, gen, query):
+        try:
+            counts = self._paged_counts(query)
+            if counts is not None:
+                self.pagedFilterLoaded.emit(gen, query, counts)
+                return
+            reqs = self.client.query_storage(query, headers_only=True)
+        except (MessageError, SocketClosed, ProxyException):
+            self.filterFailed.emit(gen)
+            return
+        # the rows are built here so only the store is handed to the view
+        store = RowStore(self.listModel.keep_requests)
+        store.extend(reqs)
+        tree_root = None
+        if self.tree is not None:
+            tree_root = build_tree(store)
+        self.filterLoaded.emit(gen, store, tree_root)
+
+    @pyqtSlot(int, object, object)
+    def _filter_loaded(self, gen, store, tree_root):
+        if gen == self.filter_gen:
+            with DisableUpdates(self.tableView):
+                self._set_model(self.listModel)
+                self.listModel.set_store(store, tree_root)
+                self.set_is_not_loading()
+
+    @pyqtSlot(int)
+    def _filter_failed(self, gen):
+        # the list that was showing stays, it just isn't loading anymore
+        if gen == self.filter_gen:
+            self.set_is_not_loading()
+
+    def _load_tree(self, gen, query):
+        # the tree of a paged list is built from every match, a page at a time
+        tree = PathTrie()
+        ids = set()
+        try:
+            for req in self.client.query_storage_iter(query, page_size=1000, headers_only=True):
+                if gen != self.filter_gen:
+                    return
+                tree.add_request(req)
+                ids.add(self.client.get_reqid(req))
+        except (MessageError, SocketClosed, ProxyException):
+            self.treeLoaded.emit(gen, None, None)
+            return
+        self.treeLoaded.emit(gen, tree.root, ids)
+
+    @pyqtSlot(int, object, object)
+    def _tree_loaded(self, gen, tree_root, ids):
+        # the changes to the list while it was loading are applied to the
+        # loaded trie before it's shown. If it couldn't be loaded the tree only
+        # has the changes from now on
+        if gen != self.filter_gen or self.tableModel is self.listModel:
+            return
+        deltas = self.tableModel.tree
+        self.tableModel.tree = self.tree
+        if tree_root is None:
+            deltas.replay(self.tree, ())
+            return
+        tree = PathTrie()
+        tree.set_root(tree_root)
+        deltas.replay(tree, ids)
+        self.tree.set_root(tree.root)
+
+    @pyqtSlot(int, list, list)
+    def _paged_filter_loaded(self, gen, query, counts):
+        if gen != self.filter_gen:
+            return
+        model = PagedReqListModel(self.client, query, counts)
+        model.refreshNeeded.connect(self.reload_requests)
+        with DisableUpdates(self.tableView):
+            self._set_model(model)
+            self.set_is_not_loading()
+        if self.tree is not None:
+            model.tree = _TreeDeltas(self.client)
+            self.tree.clear()
+            ProxyThread(target=self._load_tree, args=(gen, query)).start()
+
+    @pyqtSlot()
+    def reload_requests(self):
+        # load the requests matching the filter from storage again
+        self.set_filter(self.query)
+
+    def _set_model(self, model):
+        if model is self.tableModel:
+            return
+        old = self.tableModel
+        old.dataChanged.disconnect(self._paint_view)
+        old.rowsInserted.disconnect(self._on_rows_inserted)
+        old.clear()
+        paged = model is not self.listModel
+        # sizing rows to their contents would read every row and sizing
+        # columns looks at the 1000 rows around the visible ones by default
+        if paged:
+            self.tableView.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+            self.tableView.horizontalHeader().setResizeContentsPrecision(0)
+        else:
+            self.tableView.verticalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+            self.tableView.horizontalHeader().setResizeContentsPrecision(1000)
+        self.tableView.horizontalHeader().setSortIndicatorShown(not paged)
+        self.tableModel = model
+        self.tableView.setModel(model)
+        model.dataChanged.connect(self._paint_view)
+        model.rowsInserted.connect(self._on_rows_inserted)
+        self.tableView.selectionModel().selectionChanged.connect(self.on_select_change)
+        self.selected_reqs = []
 
     @pyqtSlot(list)
     def _updated_selected_request(self, reqs):
@@ -945,7 +1944,9 @@ class ReqTableWidget(QWidget):
         for rowidx in self.tableView.selectionModel().selectedRows():
             row = rowidx.row()
             if row not in added:
-                reqs.append(self.tableModel.req_by_ind(row))
+                req = self.tableModel.req_by_ind(row)
+                if req is not None:
+                    reqs.append(req)
                 added.add(row)
         self.requestsSelected.emit(reqs)
 
@@ -961,20 +1962,21 @@ class ReqTableWidget(QWidget):
             return None
 
     def get_selected_requests(self):
-        ret = []
-        for hreq in self.selected_reqs:
-            ret.append(self.client.load_by_reqheaders(hreq))
-        return ret
+        return self.client.reqs_by_ids([self.client.get_reqid(hreq) for hreq in self.selected_reqs])
 
     def get_all_requests(self):
-        return [self.client.req_by_id(self.client.get_reqid(req)) for req in self.tableModel.get_requests()]
+        if self.tableModel is not self.listModel:
+            # a paged list only holds some of them
+            return list(self.client.query_storage_iter(self.query))
+        return self.client.reqs_by_ids(self.tableModel.get_reqids())
 
     def contextMenuEvent(self, event):
         if len(self.selected_reqs) > 1:
-            reqs = self.get_selected_requests()
-            display_multi_req_context(self, self.client, reqs, event,
+            # full requests are only loaded by the actions that need them
+            display_multi_req_context(self, self.client, self.selected_reqs, event,
                                       macro_widget=self.macro_widget,
-                                      save_option=self.allow_save)
+                                      save_option=self.allow_save,
+                                      tags_updated=self.tableModel.update_requests)
         elif len(self.selected_reqs) == 1:
             req = self.get_selected_request()
             display_req_context(self, self.client, req, event,
@@ -998,7 +2000,8 @@ class ReqTableWidget(QWidget):
             
     @pyqtSlot(QModelIndex, QModelIndex)
     def _paint_view(self, indA, indB):
-        self.tableView.repaint()
+        # schedule a paint rather than painting on every change
+        self.tableView.viewport().update()
         
     @pyqtSlot()
     def delete_selected(self):
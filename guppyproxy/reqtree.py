@@ -1,41 +1,285 @@
+from bisect import bisect_left, insort
+from urllib.parse import urlparse
+
+from guppyproxy.util import max_len_str
 from guppyproxy.proxy import HTTPRequest
-from PyQt5.QtWidgets import QWidget, QTreeView, QVBoxLayout
-from PyQt5.QtGui import QStandardItem, QStandardItemModel
-from PyQt5.QtCore import pyqtSlot, Qt
+from PyQt5.QtWidgets import QWidget, QTreeView, QVBoxLayout, QHeaderView
+from PyQt5.QtCore import pyqtSlot, Qt, QAbstractItemModel, QModelIndex, QVariant, QTimer
+
+# The site map is a trie with a node for each host and each path segment
+# under it. Every node counts the requests at or below it so the numbers can
+# be kept current by walking a single path when a request is added or
+# removed. Requests without a response or with a 404 are left out like they
+# always were.
+
+
+def _path_parts(host, path):
+    if path.startswith("/"):
+        # the common case, cheaper than parsing the whole URL
+        path = path.split("?", 1)[0].split("#", 1)[0]
+    else:
+        path = urlparse(path).path
+    return [host] + ["/" + p for p in path.split("/")[1:]]
+
+
+class PathNode:
+    __slots__ = ("name", "parent", "children", "rows", "count", "statuses",
+                 "nbytes", "latency", "timed")
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.children = {}  # name -> PathNode
+        self.rows = None  # sorted child names once the view has asked for them
+        self.count = 0
+        self.statuses = {}  # status code -> count
+        self.nbytes = 0  # request and response bodies
+        self.latency = 0  # total ns of the requests that have both times
+        self.timed = 0
+
+
+class PathTrie:
+
+    def __init__(self):
+        self.root = PathNode("", None)
+
+    def set_root(self, root):
+        self.root = root
+
+    def clear(self):
+        self.set_root(PathNode("", None))
+
+    def add(self, host, path, status, nbytes, latency, sign=1):
+        # a sign of -1 takes a request that was added before away again
+        if status < 0 or status == 404:
+            return
+        node = self.root
+        for name in _path_parts(host, path):
+            child = node.children.get(name)
+            created = child is None
+            if created:
+                if sign < 0:
+                    return
+                child = PathNode(name, node)
+            child.count += sign
+            if child.count <= 0:
+                # nothing is left below it either
+                self._remove_child(node, child)
+                return
+            n = child.statuses.get(status, 0) + sign
+            if n > 0:
+                child.statuses[status] = n
+            else:
+                child.statuses.pop(status, None)
+            child.nbytes += sign * nbytes
+            if latency is not None:
+                child.latency += sign * latency
+                child.timed += sign
+            if created:
+                self._insert_child(node, child)
+            else:
+                self._changed(child)
+            node = child
+
+    def add_request(self, req, sign=1):
+        rsp = req.response
+        if rsp is None:
+            return
+        latency = None
+        if req.time_start_ns and req.time_end_ns:
+            latency = req.time_end_ns - req.time_start_ns
+        self.add(req.dest_host, req.path_str(), rsp.status_code,
+                 max(req.content_length, 0) + max(rsp.content_length, 0), latency, sign)
+
+    def add_store_row(self, store, i, sign=1):
+        if store.status[i] < 0:
+            return
+        self.add(store.hosts[store.host[i]], store.paths[store.path[i]], store.status[i],
+                 max(store.req_len[i], 0) + max(store.rsp_len[i], 0), store.duration(i), sign)
+
+    def _insert_child(self, parent, child):
+        parent.children[child.name] = child
+        if parent.rows is not None:
+            insort(parent.rows, child.name)
+
+    def _remove_child(self, parent, child):
+        del parent.children[child.name]
+        if parent.rows is not None:
+            del parent.rows[bisect_left(parent.rows, child.name)]
+
+    def _changed(self, node):
+        pass
 
 
-def _include_req(req):
-    if not req.response:
-        return False
-    if req.response.status_code == 404:
-        return False
-    return True
+def build_tree(store):
+    # the root of a trie of the rows in a RowStore, can be built off the GUI thread
+    tree = PathTrie()
+    for i in store.live_rows():
+        tree.add_store_row(store, i)
+    return tree.root
 
 
-class PathNodeItem(QStandardItem):
+class _ModelTrie(PathTrie):
+    # tells the model about the nodes the view has seen as they change
 
-    def __init__(self, text, *args, **kwargs):
-        QStandardItem.__init__(self, *args, **kwargs)
-        self.text = text
-        self.children = {}
+    def __init__(self, model):
+        PathTrie.__init__(self)
+        self.model = model
 
-    def add_child(self, text):
-        if text not in self.children:
-            newitem = PathNodeItem(text, text)
-            newitem.setFlags(newitem.flags() ^ Qt.ItemIsEditable)
-            self.children[text] = newitem
-            self.appendRow(newitem)
+    def set_root(self, root):
+        self.model.beginResetModel()
+        self.root = root
+        self.model.changed.clear()
+        self.model.endResetModel()
 
-    def get_child(self, text):
-        return self.children[text]
+    def _insert_child(self, parent, child):
+        if parent.rows is None and not parent.children:
+            # a node without children has nothing left to fetch
+            parent.rows = []
+        if parent.rows is None or not self.model._shown(parent):
+            PathTrie._insert_child(self, parent, child)
+            return
+        pos = bisect_left(parent.rows, child.name)
+        self.model.beginInsertRows(self.model._index(parent), pos, pos)
+        parent.children[child.name] = child
+        parent.rows.insert(pos, child.name)
+        self.model.endInsertRows()
 
-    def add_child_path(self, texts):
-        if not texts:
+    def _remove_child(self, parent, child):
+        if parent.rows is None or not self.model._shown(parent):
+            PathTrie._remove_child(self, parent, child)
             return
-        childtext = texts[0]
-        self.add_child(childtext)
-        child = self.get_child(childtext)
-        child.add_child_path(texts[1:])
+        pos = bisect_left(parent.rows, child.name)
+        self.model.beginRemoveRows(self.model._index(parent), pos, pos)
+        del parent.children[child.name]
+        del parent.rows[pos]
+        self.model.endRemoveRows()
+
+    def _changed(self, node):
+        self.model.changed.add(node)
+        if not self.model.flush_timer.isActive():
+            self.model.flush_timer.start()
+
+
+class ReqTreeModel(QAbstractItemModel):
+    # The trie as a tree model. The children of a node are only given to the
+    # view when it's expanded, nodes it hasn't seen change without signals.
+
+    HD_PATH = 0
+    HD_COUNT = 1
+    HD_STATUS = 2
+    HD_BYTES = 3
+    HD_TIME = 4
+
+    MAX_STATUS_LEN = 40
+
+    def __init__(self, *args, **kwargs):
+        QAbstractItemModel.__init__(self, *args, **kwargs)
+        self.table_headers = ["Path", "Requests", "Status", "Bytes", "Mean Time"]
+        self.changed = set()  # nodes with new counts since the last dataChanged
+        self.flush_timer = QTimer()
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(0)
+        self.flush_timer.timeout.connect(self._flush_changed)
+        self.trie = _ModelTrie(self)
+
+    def _node(self, index):
+        if index is not None and index.isValid():
+            return index.internalPointer()
+        return self.trie.root
+
+    def _visible(self, node):
+        # whether the view knows about the node
+        while node is not self.trie.root:
+            parent = node.parent
+            if parent is None or parent.rows is None or parent.children.get(node.name) is not node:
+                return False
+            node = parent
+        return True
+
+    def _shown(self, node):
+        # whether the view knows about the node's children
+        return node.rows is not None and self._visible(node)
+
+    def _index(self, node, column=0):
+        if node is self.trie.root:
+            return QModelIndex()
+        return self.createIndex(bisect_left(node.parent.rows, node.name), column, node)
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self._node(parent)
+        if node.rows is None or row < 0 or row >= len(node.rows) or column >= len(self.table_headers):
+            return QModelIndex()
+        return self.createIndex(row, column, node.children[node.rows[row]])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        parent = index.internalPointer().parent
+        if parent is None or parent is self.trie.root:
+            return QModelIndex()
+        return self._index(parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return 0
+        node = self._node(parent)
+        if node.rows is None:
+            return 0
+        return len(node.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return len(self.table_headers)
+
+    def hasChildren(self, parent=QModelIndex()):
+        if parent.column() > 0:
+            return False
+        return len(self._node(parent).children) > 0
+
+    def canFetchMore(self, parent):
+        node = self._node(parent)
+        return node.rows is None and len(node.children) > 0
+
+    def fetchMore(self, parent):
+        node = self._node(parent)
+        if node.rows is not None or not node.children:
+            return
+        names = sorted(node.children)
+        self.beginInsertRows(parent, 0, len(names) - 1)
+        node.rows = names
+        self.endInsertRows()
+
+    def headerData(self, section, orientation, role):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.table_headers[section]
+        return QVariant()
+
+    def data(self, index, role):
+        if not index.isValid() or role != Qt.DisplayRole:
+            return QVariant()
+        node = index.internalPointer()
+        column = index.column()
+        if column == self.HD_PATH:
+            return node.name
+        if column == self.HD_COUNT:
+            return str(node.count)
+        if column == self.HD_STATUS:
+            return max_len_str(', '.join(str(sc) for sc in sorted(node.statuses)), self.MAX_STATUS_LEN)
+        if column == self.HD_BYTES:
+            return str(node.nbytes)
+        if node.timed > 0:
+            return "%.2f" % (node.latency / node.timed / 1000000000)
+        return "--"
+
+    @pyqtSlot()
+    def _flush_changed(self):
+        # one dataChanged for each node the view knows about
+        changed = self.changed
+        self.changed = set()
+        last = len(self.table_headers) - 1
+        for node in changed:
+            if self._visible(node):
+                self.dataChanged.emit(self._index(node, self.HD_COUNT), self._index(node, last))
 
 
 class ReqTreeView(QWidget):
@@ -46,37 +290,29 @@ class ReqTreeView(QWidget):
         self.layout().setSpacing(0)
         self.layout().setContentsMargins(0, 0, 0, 0)
 
-        self.nodes = {}
+        self.tree_model = ReqTreeModel()
         self.tree_view = QTreeView()
-        self.tree_view.header().close()
-        self.root = QStandardItemModel()
-        self.tree_view.setModel(self.root)
+        self.tree_view.setUniformRowHeights(True)
+        self.tree_view.setModel(self.tree_model)
+        self.tree_view.header().setStretchLastSection(False)
+        self.tree_view.header().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.tree_view.header().setSectionResizeMode(ReqTreeModel.HD_PATH, QHeaderView.Stretch)
         self.layout().addWidget(self.tree_view)
 
+    @property
+    def tree(self):
+        return self.tree_model.trie
+
     @pyqtSlot(HTTPRequest)
     def add_request_item(self, req):
-        path_parts = req.url.geturl(False).split("/")
-        path_parts = path_parts[1:]
-        path_parts = ["/" + p for p in path_parts]
-        path_parts = [req.dest_host] + path_parts
-        if path_parts[0] not in self.nodes:
-            item = PathNodeItem(path_parts[0], path_parts[0])
-            item.setFlags(item.flags() ^ Qt.ItemIsEditable)
-            self.nodes[path_parts[0]] = item
-            self.root.appendRow(item)
-        else:
-            item = self.nodes[path_parts[0]]
-        item.add_child_path(path_parts[1:])
+        self.tree.add_request(req)
 
     @pyqtSlot(list)
     def set_requests(self, reqs):
-        self.clear()
+        tree = PathTrie()
         for req in reqs:
-            if _include_req(req):
-                self.add_request_item(req)
-        self.tree_view.expandAll()
+            tree.add_request(req)
+        self.tree.set_root(tree.root)
 
     def clear(self):
-        self.nodes = {}
-        self.root = QStandardItemModel()
-        self.tree_view.setModel(self.root)
+        self.tree.clear()
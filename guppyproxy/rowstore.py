@@ -0,0 +1,383 @@
+import operator
+
+from array import array
+from bisect import bisect_left
+
+from guppyproxy.proxy import HTTPRequest, HTTPResponse
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The metadata the history list shows for each request, kept in typed arrays
+# with one entry per row instead of one object per request. Strings that
+# repeat across requests (methods, hosts, tags, reasons) are stored once in a
+# table and the rows hold their index, paths are packed into one buffer since
+# most of them are only seen once. Only requests that can't be
+# loaded again from storage are kept as objects, everything else is rebuilt
+# as a headers-only request when it's needed. With numpy installed, sorting
+# and filtering on the numeric columns work on the whole column at once.
+
+
+class InternTable:
+    # Keeps one copy of each value and gives it a small integer id
+
+    def __init__(self):
+        self.values = []
+        self.ids = {}
+
+    def intern(self, value):
+        i = self.ids.get(value)
+        if i is None:
+            i = len(self.values)
+            self.values.append(value)
+            self.ids[value] = i
+        return i
+
+    def __getitem__(self, i):
+        return self.values[i]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class PackedStrings:
+    # Strings stored back to back as UTF-8 in a single buffer, for strings
+    # that rarely repeat where a str object and a dict entry each would take
+    # several times the space of the string itself
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array("q", [0])
+
+    def add(self, value):
+        self.data += value.encode("utf-8", "surrogatepass")
+        self.offsets.append(len(self.data))
+        return len(self.offsets) - 2
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf-8", "surrogatepass")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def format_hostport(host, port, use_tls):
+    # the same as util.hostport
+    if use_tls and port == 443:
+        return host
+    if (not use_tls) and port == 80:
+        return host
+    return "%s:%d" % (host, port)
+
+
+_ops = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+_numpy_types = {"h": "int16", "H": "uint16", "i": "int32", "q": "int64", "B": "uint8"}
+
+# db ids are combined with their storage id into a single key for the index
+_ID_BITS = 40
+
+
+class RowStore:
+    FLAG_TLS = 1
+    FLAG_REQ_MANGLED = 2
+    FLAG_RSP_MANGLED = 4
+    FLAG_DELETED = 8
+
+    # (name, array type code). Times are ns since the epoch or 0, a status of
+    # -1 means there's no response and a db id of -1 that it isn't a number.
+    columns = (
+        ("storage_id", "i"),
+        ("db_id", "q"),
+        ("time_start", "q"),
+        ("time_end", "q"),
+        ("status", "h"),
+        ("req_len", "q"),
+        ("rsp_len", "q"),
+        ("port", "H"),
+        ("flags", "B"),
+        ("method", "i"),
+        ("host", "i"),
+        ("path", "i"),
+        ("tags", "i"),
+        ("reason", "i"),
+    )
+
+    def __init__(self, keep_requests=False):
+        for name, code in self.columns:
+            setattr(self, name, array(code))
+        self.arrays = tuple(getattr(self, name) for name, _ in self.columns)
+        self.methods = InternTable()
+        self.hosts = InternTable()
+        self.paths = PackedStrings()
+        self.tag_sets = InternTable()  # sorted tuples of tags
+        self.reasons = InternTable()
+        self.keep_requests = keep_requests
+        self.requests = {}  # row -> request for the rows kept as objects
+        self.str_ids = {}  # row -> db id for ids that aren't numbers
+        self.deleted = 0
+
+        # rows with a numeric id sorted by (storage id, db id). Rows that were
+        # appended since the index was last used are sorted in when it's needed.
+        self.id_keys = array("q")
+        self.id_rows = array("i")
+        self.id_sorted = 0
+        self.str_index = {}  # (storage id, db id) -> row
+
+    def __len__(self):
+        return len(self.flags)
+
+    def _values(self, req, i=None):
+        # i is the row the values replace
+        rsp = req.response
+        flags = 0
+        if req.use_tls:
+            flags |= self.FLAG_TLS
+        if req.unmangled:
+            flags |= self.FLAG_REQ_MANGLED
+        if rsp is not None and rsp.unmangled:
+            flags |= self.FLAG_RSP_MANGLED
+        db_id = req.db_id
+        path = req.path_str()
+        if i is not None and self.paths[self.path[i]] == path:
+            path = self.path[i]
+        else:
+            path = self.paths.add(path)
+        if rsp is not None:
+            status = rsp.status_code
+            rsp_len = rsp.content_length
+            reason = self.reasons.intern(rsp.reason)
+        else:
+            status = -1
+            rsp_len = -1
+            reason = -1
+        return (req.storage_id,
+                int(db_id) if db_id.isdigit() else -1,
+                req.time_start_ns or 0,
+                req.time_end_ns or 0,
+                status,
+                req.content_length,
+                rsp_len,
+                req.dest_port,
+                flags,
+                self.methods.intern(req.method),
+                self.hosts.intern(req.dest_host),
+                path,
+                self.tag_sets.intern(tuple(req.sorted_tags())),
+                reason)
+
+    def _keep(self, i, req):
+        if self.keep_requests or req.db_id == "":
+            self.requests[i] = req
+        else:
+            self.requests.pop(i, None)
+
+    def append(self, req):
+        i = len(self)
+        for col, val in zip(self.arrays, self._values(req)):
+            col.append(val)
+        self._keep(i, req)
+        db_id = self.db_id[i]
+        if db_id >= 0:
+            self.id_keys.append((req.storage_id << _ID_BITS) | db_id)
+            self.id_rows.append(i)
+        elif req.db_id != "":
+            self.str_ids[i] = req.db_id
+            self.str_index[(req.storage_id, req.db_id)] = i
+        return i
+
+    def extend(self, reqs):
+        for req in reqs:
+            self.append(req)
+
+    def set(self, i, req):
+        # replace the values of a row with a newer version of its request
+        for col, val in zip(self.arrays, self._values(req, i)):
+            col[i] = val
+        self._keep(i, req)
+
+    def delete(self, i):
+        if self.flags[i] & self.FLAG_DELETED:
+            return
+        self.flags[i] |= self.FLAG_DELETED
+        self.deleted += 1
+        self.requests.pop(i, None)
+        db_id = self.db_id[i]
+        if db_id >= 0:
+            self._sort_index()
+            key = (self.storage_id[i] << _ID_BITS) | db_id
+            pos = bisect_left(self.id_keys, key)
+            if pos < len(self.id_keys) and self.id_keys[pos] == key:
+                del self.id_keys[pos]
+                del self.id_rows[pos]
+                self.id_sorted -= 1
+        elif i in self.str_ids:
+            del self.str_index[(self.storage_id[i], self.str_ids.pop(i))]
+
+    def is_deleted(self, i):
+        return bool(self.flags[i] & self.FLAG_DELETED)
+
+    def live_rows(self):
+        if self.deleted == 0:
+            return array("i", range(len(self)))
+        flags = self.flags
+        deleted = self.FLAG_DELETED
+        return array("i", (i for i in range(len(self)) if not flags[i] & deleted))
+
+    def _sort_index(self):
+        n = len(self.id_keys)
+        if self.id_sorted == n:
+            return
+        if n - self.id_sorted <= 64:
+            # a few new rows, move each into place
+            for _ in range(n - self.id_sorted):
+                key = self.id_keys.pop()
+                row = self.id_rows.pop()
+                pos = bisect_left(self.id_keys, key, 0, self.id_sorted)
+                self.id_keys.insert(pos, key)
+                self.id_rows.insert(pos, row)
+                self.id_sorted += 1
+            return
+        if numpy is not None:
+            keys = numpy.frombuffer(self.id_keys, dtype="int64")
+            perm = numpy.argsort(keys, kind="stable")
+            id_keys = array("q")
+            id_keys.frombytes(keys[perm].tobytes())
+            id_rows = array("i")
+            id_rows.frombytes(numpy.frombuffer(self.id_rows, dtype="int32")[perm].tobytes())
+            del keys
+            self.id_keys = id_keys
+            self.id_rows = id_rows
+        else:
+            pairs = sorted(zip(self.id_keys, self.id_rows))
+            self.id_keys = array("q", (key for key, _ in pairs))
+            self.id_rows = array("i", (row for _, row in pairs))
+        self.id_sorted = n
+
+    def find(self, storage_id, db_id):
+        # the row of a stored request or -1
+        if db_id.isdigit():
+            self._sort_index()
+            key = (storage_id << _ID_BITS) | int(db_id)
+            pos = bisect_left(self.id_keys, key)
+            if pos < len(self.id_keys) and self.id_keys[pos] == key:
+                return self.id_rows[pos]
+            return -1
+        return self.str_index.get((storage_id, db_id), -1)
+
+    def find_request(self, req):
+        # the row of a request that was kept as an object
+        if req.db_id != "":
+            return self.find(req.storage_id, req.db_id)
+        for i, r in self.requests.items():
+            if r is req:
+                return i
+        return -1
+
+    # values of a row
+
+    def db_id_str(self, i):
+        db_id = self.db_id[i]
+        if db_id >= 0:
+            return str(db_id)
+        return self.str_ids.get(i, "")
+
+    def hostport(self, i):
+        return format_hostport(self.hosts[self.host[i]], self.port[i],
+                               self.flags[i] & self.FLAG_TLS)
+
+    def tags_of(self, i):
+        return self.tag_sets[self.tags[i]]
+
+    def duration(self, i):
+        start = self.time_start[i]
+        end = self.time_end[i]
+        if start and end:
+            return end - start
+        return None
+
+    def request(self, i):
+        req = self.requests.get(i)
+        if req is None:
+            req = self.build_request(i)
+        return req
+
+    def build_request(self, i):
+        # A headers-only request with what the list knows about it. The
+        # lengths are carried in Content-Length since the bodies aren't loaded
+        # and mangled messages get an empty stand-in for their original.
+        flags = self.flags[i]
+        req = HTTPRequest(method=self.methods[self.method[i]],
+                          path=self.paths[self.path[i]],
+                          headers={"Content-Length": [str(self.req_len[i])]},
+                          dest_host=self.hosts[self.host[i]],
+                          dest_port=self.port[i],
+                          use_tls=bool(flags & self.FLAG_TLS),
+                          db_id=self.db_id_str(i),
+                          tags=self.tags_of(i),
+                          headers_only=True,
+                          storage_id=self.storage_id[i])
+        req.time_start_ns = self.time_start[i] or None
+        req.time_end_ns = self.time_end[i] or None
+        if flags & self.FLAG_REQ_MANGLED:
+            req.unmangled = HTTPRequest(headers_only=True)
+        if self.status[i] >= 0:
+            rsp = HTTPResponse(status_code=self.status[i],
+                               reason=self.reasons[self.reason[i]],
+                               headers={"Content-Length": [str(self.rsp_len[i])]},
+                               headers_only=True)
+            if flags & self.FLAG_RSP_MANGLED:
+                rsp.unmangled = HTTPResponse(headers_only=True)
+            req.response = rsp
+        return req
+
+    # whole column operations
+
+    def view(self, name):
+        # a numpy array sharing memory with a column. Rows can't be added
+        # while one is alive.
+        col = getattr(self, name)
+        return numpy.frombuffer(col, dtype=_numpy_types[col.typecode])
+
+    def where(self, name, op, value, rows=None):
+        # the rows (by default every row that wasn't deleted) where a numeric
+        # column compares true to value, for example where("status", ">=", 500)
+        cmp = _ops[op]
+        if rows is None:
+            rows = self.live_rows()
+        if numpy is None or len(rows) == 0:
+            col = getattr(self, name)
+            return array("i", (i for i in rows if cmp(col[i], value)))
+        idx = numpy.frombuffer(rows, dtype="int32")
+        result = array("i")
+        result.frombytes(idx[cmp(self.view(name)[idx], value)].tobytes())
+        return result
+
+    def ranks(self, codes, fmt):
+        # Replaces codes with the position of fmt(code) among the formatted
+        # values, so sorting by the ranks sorts by the strings they stand for
+        uniq, inverse = numpy.unique(codes, return_inverse=True)
+        strs = [fmt(int(code)) for code in uniq]
+        rank = {s: r for r, s in enumerate(sorted(set(strs)))}
+        return numpy.array([rank[s] for s in strs], dtype="int64")[inverse]
+
+    def sort_rows(self, rows, primary, reverse=False):
+        # Sorts rows by primary, a numpy array of values for each row, then by
+        # storage id, db id and row so no two rows compare equal
+        idx = numpy.frombuffer(rows, dtype="int32")
+        perm = numpy.lexsort((idx, self.view("db_id")[idx],
+                              self.view("storage_id")[idx], primary))
+        if reverse:
+            perm = perm[::-1]
+        result = array("i")
+        result.frombytes(idx[perm].tobytes())
+        return result
@@ -1,8 +1,9 @@
 from guppyproxy.util import list_remove, display_error_box, set_default_dialog_dir, default_dialog_dir, save_dialog, open_dialog
 from guppyproxy.proxy import MessageError
 from guppyproxy.config import ProxyConfig
-from PyQt5.QtWidgets import QWidget, QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, QFormLayout, QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit, QSizePolicy, QToolButton, QCheckBox, QLabel
+from PyQt5.QtWidgets import QWidget, QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView, QFormLayout, QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit, QSizePolicy, QToolButton, QCheckBox, QLabel, QPlainTextEdit
 from PyQt5.QtCore import pyqtSlot, pyqtSignal
+import datetime
 import os
 import copy
 
@@ -275,6 +276,56 @@ class ProxyInfoWidget(QWidget):
         self.proxyInfoUpdated.emit(entry)
 
 
+class BackendLogWidget(QWidget):
+    # Shows the tail of the backend's output when asked to
+
+    def __init__(self, client, *args, **kwargs):
+        QWidget.__init__(self, *args, **kwargs)
+        self.client = client
+        self.setLayout(QVBoxLayout())
+        self.layout().setContentsMargins(0, 0, 0, 0)
+
+        buttons = QHBoxLayout()
+        buttons.setContentsMargins(0, 0, 0, 0)
+        self.refreshbutton = QPushButton("Show Log")
+        self.refreshbutton.clicked.connect(self.refresh)
+        self.statslabel = QLabel()
+        buttons.addWidget(self.refreshbutton)
+        buttons.addWidget(self.statslabel)
+        buttons.addStretch()
+
+        self.logtext = QPlainTextEdit()
+        self.logtext.setReadOnly(True)
+        self.logtext.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.logtext.setMaximumBlockCount(5000)
+        self.logtext.hide()
+
+        self.layout().addLayout(buttons)
+        self.layout().addWidget(self.logtext)
+
+        if self.client.backend_log is None:
+            self.refreshbutton.setEnabled(False)
+            self.statslabel.setText("Not available when attached to a running backend")
+
+    @pyqtSlot()
+    def refresh(self, n=500):
+        log = self.client.backend_log
+        if log is None:
+            return
+        lines = []
+        for entry in log.tail(n):
+            ts = datetime.datetime.fromtimestamp(entry.timestamp).strftime("%H:%M:%S")
+            lines.append("%s [%s] %s" % (ts, entry.stream, entry.line))
+        self.logtext.setPlainText("\n".join(lines))
+        self.logtext.verticalScrollBar().setValue(self.logtext.verticalScrollBar().maximum())
+        self.logtext.show()
+        self.refreshbutton.setText("Refresh")
+
+        stats = log.stats()
+        counters = ", ".join("%s: %d" % (k.replace("_", " "), v) for k, v in sorted(stats.counters.items()))
+        self.statslabel.setText("%d lines, %s" % (stats.lines, counters))
+
+
 class SettingsWidget(QWidget):
     datafileLoaded = pyqtSignal()
 
@@ -298,6 +349,10 @@ class SettingsWidget(QWidget):
         self.proxywidg.proxyInfoUpdated.connect(self._set_proxy_settings)
         self.layout().addRow(QLabel("Proxy Settings"), self.proxywidg)
 
+        # Backend output
+        self.logwidg = BackendLogWidget(self.client)
+        self.layout().addRow(QLabel("Backend log"), self.logwidg)
+
         self.load_config()
 
     def load_config(self):
@@ -6,7 +6,7 @@ import random
 from guppyproxy.proxy import get_full_url, Headers
 from pygments.formatters import HtmlFormatter
 from pygments.styles import get_style_by_name
-from PyQt5.QtWidgets import QMessageBox, QMenu, QApplication, QFileDialog
+from PyQt5.QtWidgets import QMessageBox, QMenu, QApplication, QFileDialog, QInputDialog
 from PyQt5.QtGui import QColor
 
 
@@ -248,7 +248,18 @@ def display_req_context(parent, client, req, event, repeater_widget=None, req_vi
         with open(saveloc, 'w') as f:
             f.write(create_macro_template([req]))
 
-def display_multi_req_context(parent, client, reqs, event, macro_widget=None, save_option=False):
+def _load_full_reqs(client, reqs):
+    # requests from the history list may only have their headers loaded
+    ids = [client.get_reqid(req) for req in reqs if req.headers_only and req.db_id != ""]
+    if len(ids) == 0:
+        return reqs
+    full = {client.get_reqid(req): req for req in client.reqs_by_ids(ids)}
+    return [full.get(client.get_reqid(req), req) for req in reqs]
+
+
+def display_multi_req_context(parent, client, reqs, event, macro_widget=None, save_option=False,
+                              tags_updated=None):
+    # tags_updated is called with the requests whose tags were changed
     from guppyproxy.macros import create_macro_template
 
     menu = QMenu(parent)
@@ -257,19 +268,45 @@ def display_multi_req_context(parent, client, reqs, event, macro_widget=None, sa
     if save_option:
         saveAction = menu.addAction("Save requests to history")
     saveMacroAction = menu.addAction("Create active macro with selected requests")
+    stored = [req for req in reqs if req.db_id != ""]
+    if stored:
+        addTagAction = menu.addAction("Add tag to selected requests")
+        removeTagAction = menu.addAction("Remove tag from selected requests")
     action = menu.exec_(parent.mapToGlobal(event.pos()))
     if macro_widget and action == macroAction:
         if macro_widget:
             macro_widget.add_requests(reqs)
     if save_option and action == saveAction:
-        for req in reqs:
+        for req in _load_full_reqs(client, reqs):
             client.save_new(req)
     if action == saveMacroAction:
         saveloc = save_dialog(parent, default_name="macro.py")
         if saveloc == None:
             return
         with open(saveloc, 'w') as f:
-            f.write(create_macro_template(reqs))
+            f.write(create_macro_template(_load_full_reqs(client, reqs)))
+    if stored and action in (addTagAction, removeTagAction):
+        adding = (action == addTagAction)
+        tag, ok = QInputDialog.getText(parent, "Add tag" if adding else "Remove tag", "Tag:")
+        tag = tag.strip()
+        if not ok or not tag:
+            return
+        reqids = [client.get_reqid(req) for req in stored]
+        try:
+            if adding:
+                client.add_tags_bulk(reqids, [tag])
+            else:
+                client.remove_tags_bulk(reqids, [tag])
+        except Exception as e:
+            display_error_box("Error updating tags: %s" % e)
+            return
+        for req in stored:
+            if adding:
+                req.tags.add(tag)
+            else:
+                req.tags.discard(tag)
+        if tags_updated is not None:
+            tags_updated(stored)
 
 def method_color(method):
     if method.lower() == 'get':
@@ -0,0 +1,122 @@
+# A stand-in for the puppy backend used by the tests. It holds one storage of
+# requests as wire messages and answers StorageQuery and checkrequest by
+# replaying results pinned for each filter, it doesn't evaluate queries itself.
+# A filter without pinned results is refused.
+
+import json
+import os
+import socket
+import tempfile
+import threading
+
+from guppyproxy.proxy import SockBuffer, SocketClosed
+
+
+def _ok(**kwargs):
+    ret = {"Success": True}
+    ret.update(kwargs)
+    return ret
+
+
+def _key(args):
+    return json.dumps(args)
+
+
+class ReplayBackend:
+
+    def __init__(self, reqs, results, storage_id=1):
+        # reqs: wire messages, newest first
+        # results: [(filter args, [db ids of the matching requests])]
+        self.reqs = reqs
+        self.results = dict((_key(args), set(ids)) for args, ids in results)
+        self.storage_id = storage_id
+        self.handlers = {
+            "Ping": lambda cmd: _ok(Ping="Pong"),
+            "ListStorage": lambda cmd: _ok(Storages=[
+                {"Id": storage_id, "Description": "sqlite|"}]),
+            "StorageQuery": self._query,
+            "checkrequest": self._check,
+        }
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "standin.sock")
+        self.lsock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.lsock.bind(self.path)
+        self.lsock.listen(64)
+        self.conns = []
+        t = threading.Thread(target=self._accept_loop, daemon=True)
+        t.start()
+
+    @property
+    def addr(self):
+        return "unix:" + self.path
+
+    def _matching(self, query):
+        ids = set(reqd["DbId"] for reqd in self.reqs)
+        for phrase in query:
+            phrase_ids = set()
+            for args in phrase:
+                phrase_ids |= self.results[_key(args)]
+            ids &= phrase_ids
+        return ids
+
+    def _query(self, cmd):
+        try:
+            ids = self._matching(cmd["Query"])
+        except KeyError as e:
+            return {"Success": False, "Reason": "no results pinned for %s" % e}
+        results = [reqd for reqd in self.reqs if reqd["DbId"] in ids]
+        offset = cmd.get("Offset", 0)
+        if cmd.get("MaxResults"):
+            results = results[offset:offset + cmd["MaxResults"]]
+        else:
+            results = results[offset:]
+        return _ok(Results=results, NextOffset=offset + len(results))
+
+    def _check(self, cmd):
+        if "DbId" not in cmd:
+            return {"Success": False, "Reason": "only stored requests can be checked"}
+        try:
+            return _ok(Result=cmd["DbId"] in self._matching(cmd["Query"]))
+        except KeyError as e:
+            return {"Success": False, "Reason": "no results pinned for %s" % e}
+
+    def _accept_loop(self):
+        while True:
+            try:
+                s, _ = self.lsock.accept()
+            except OSError:
+                return
+            self.conns.append(s)
+            t = threading.Thread(target=self._serve, args=(s,), daemon=True)
+            t.start()
+
+    def _serve(self, s):
+        sbuf = SockBuffer(s)
+        while True:
+            try:
+                cmd = json.loads(sbuf.readline_bytes())
+            except SocketClosed:
+                return
+            name = cmd.get("Command")
+            handler = self.handlers.get(name)
+            if handler is None:
+                reply = {"Success": False, "Reason": "unknown command: %s" % name}
+            else:
+                reply = handler(cmd)
+            try:
+                s.sendall(json.dumps(reply).encode() + b"\n")
+            except OSError:
+                return
+
+    def close(self):
+        self.lsock.close()
+        for s in self.conns:
+            try:
+                s.close()
+            except OSError:
+                pass
+        try:
+            os.unlink(self.path)
+            os.rmdir(self.tmpdir)
+        except OSError:
+            pass
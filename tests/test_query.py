@@ -0,0 +1,228 @@
+# Checks that filters evaluated on the client by guppyproxy.query give the
+# results the backend gives. The results of each filter over the corpus are
+# pinned below from the filter reference in the README, with lengths in bytes
+# like the backend's Go strings. The stand-in in tests/standin.py replays them
+# for StorageQuery and checkrequest.
+#
+# usage: python -m unittest discover tests
+
+import base64
+import os
+import sys
+import unittest
+
+_tests = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_tests, ".."))
+sys.path.insert(0, _tests)
+
+from guppyproxy.proxy import ProxyClient
+from guppyproxy.query import CompiledQuery, QueryMatcher
+from standin import ReplayBackend
+
+
+def _b64(s):
+    return base64.b64encode(s.encode()).decode()
+
+
+def _req(db_id, method="GET", host="example.com", path="/", port=443, tls=True,
+         headers=None, body="", tags=None, rsp=None):
+    reqd = {
+        "DbId": db_id, "Method": method, "Path": path, "ProtoMajor": 1, "ProtoMinor": 1,
+        "Headers": headers or {}, "Body": _b64(body), "DestHost": host, "DestPort": port,
+        "UseTLS": tls, "StartTime": 1500000000000000000 + int(db_id),
+        "EndTime": 1500000000100000000 + int(db_id), "Tags": tags or [],
+    }
+    if rsp is not None:
+        status, rsp_headers, rsp_body = rsp
+        reqd["Response"] = {
+            "StatusCode": status, "Reason": "", "ProtoMajor": 1, "ProtoMinor": 1,
+            "Headers": rsp_headers, "Body": _b64(rsp_body),
+        }
+    return reqd
+
+
+_corpus = [
+    _req("1", path="/index.html", headers={"Host": ["example.com"], "Accept": ["*/*"]},
+         rsp=(200, {"Content-Type": ["text/html"]}, "<html>hello</html>")),
+    _req("2", method="POST", path="/api/login?next=/home", headers={"Content-Type": ["application/json"]},
+         body='{"user": "admin"}', tags=["auth", "todo"],
+         rsp=(302, {"Location": ["/home"], "Set-Cookie": ["session=abc"]}, "")),
+    _req("3", host="api.example.com", path="/v1/items/42", port=8443,
+         headers={"Authorization": ["Bearer xyz"], "X-Note": ["café"]},
+         rsp=(404, {"Content-Type": ["application/json"]}, '{"error": "not found"}')),
+    _req("4", host="other.org", path="/static/app.js", port=80, tls=False,
+         headers={"Referer": ["http://other.org/"]}, tags=["static"],
+         rsp=(200, {"Content-Type": ["application/javascript"]}, "console.log('über')")),
+    _req("5", method="PUT", host="api.example.com", path="/v1/items/7", body="été",
+         headers={"Content-Type": ["text/plain"], "X-Note": ["cafe"]}),
+    _req("6", method="DELETE", path="/café", port=8080, tls=False, tags=["todo"],
+         rsp=(500, {}, "Internal error")),
+]
+
+# each filter with the ids of the requests it matches
+_results = [
+    # fields and their aliases
+    (["method", "is", "POST"], ["2"]),
+    (["verb", "is", "PUT"], ["5"]),
+    (["vb", "contains", "E"], ["1", "3", "4", "6"]),
+    (["host", "is", "api.example.com"], ["3", "5"]),
+    (["domain", "contains", "example"], ["1", "2", "3", "5", "6"]),
+    (["hs", "ct", "org"], ["4"]),
+    (["dm", "containsregexp", "^api\\."], ["3", "5"]),
+    (["path", "contains", "/v1"], ["3", "5"]),
+    (["pt", "is", "/api/login"], ["2"]),
+    (["path", "ctr", "\\.(js|html)$"], ["1", "4"]),
+    (["url", "contains", "https://api.example.com:8443/"], ["3"]),
+    (["url", "contains", "next=/home"], ["2"]),
+    (["url", "is", "https://example.com/index.html"], ["1"]),
+    (["url", "contains", "http://other.org/"], ["4"]),
+    (["statuscode", "is", "200"], ["1", "4"]),
+    (["sc", "containsr", "^[45]"], ["3", "6"]),
+    (["tag", "is", "todo"], ["2", "6"]),
+    (["tag", "contains", "aut"], ["2"]),
+    (["dbid", "is", "6"], ["6"]),
+    (["reqbody", "contains", "admin"], ["2"]),
+    (["reqbd", "is", ""], ["1", "3", "4", "6"]),
+    (["qbd", "leneq", "0"], ["1", "3", "4", "6"]),
+    (["qdata", "ct", "user"], ["2"]),
+    (["qdt", "containsregexp", "\"user\":"], ["2"]),
+    (["rspbody", "contains", "hello"], ["1"]),
+    (["rspbd", "ctr", "error"], ["3", "6"]),
+    # a request without a response has no response body to match
+    (["sbd", "is", ""], ["2"]),
+    (["sdata", "lengt", "15"], ["1", "3", "4"]),
+    (["sdt", "contains", "ü"], ["4"]),
+    (["body", "contains", "é"], ["5"]),
+    (["bd", "contains", "error"], ["3", "6"]),
+    (["data", "lenlt", "1"], ["1", "2", "3", "4", "6"]),
+    (["dt", "lengt", "0"], ["1", "2", "3", "4", "5", "6"]),
+    # lengths are counted in bytes, not characters
+    (["path", "leneq", "6"], ["6"]),
+    (["path", "leneq", "5"], []),
+    (["reqbody", "leneq", "5"], ["5"]),
+    (["reqbody", "leneq", "3"], []),
+    (["rspbody", "lengt", "20"], ["3"]),
+    (["host", "lenlt", "12"], ["1", "2", "4", "6"]),
+    (["method", "leneq", "6"], ["6"]),
+    # one comparison on headers matches the key or the value
+    (["reqheader", "contains", "json"], ["2"]),
+    (["reqhd", "is", "Accept"], ["1"]),
+    (["qhd", "ct", "Bearer"], ["3"]),
+    (["rspheader", "contains", "Location"], ["2"]),
+    (["rsphd", "contains", "session="], ["2"]),
+    (["shd", "is", "text/html"], ["1"]),
+    (["header", "contains", "javascript"], ["4"]),
+    (["hd", "containsregexp", "^X-"], ["3", "5"]),
+    (["header", "lengt", "20"], ["4"]),
+    (["reqheader", "leneq", "5"], ["3"]),
+    (["reqheader", "leneq", "4"], ["1", "5"]),
+    # two comparisons check the key then the value
+    (["reqheader", "is", "Content-Type", "contains", "json"], ["2"]),
+    (["reqheader", "is", "Content-Type", "is", "application/json"], ["2"]),
+    (["header", "contains", "Type", "contains", "javascript"], ["4"]),
+    (["rspheader", "is", "Location", "is", "/home"], ["2"]),
+    (["rspheader", "is", "Location", "is", "/"], []),
+    (["hd", "ctr", "^X-", "leneq", "5"], ["3"]),
+    # inv
+    (["inv", "method", "is", "GET"], ["2", "5", "6"]),
+    (["inv", "statuscode", "is", "200"], ["2", "3", "5", "6"]),
+    (["inv", "tag", "is", "todo"], ["1", "3", "4", "5"]),
+    (["inv", "rspbody", "contains", "error"], ["1", "2", "4", "5"]),
+    (["inv", "reqheader", "contains", "json"], ["1", "3", "4", "5", "6"]),
+    (["inv", "header", "is", "Content-Type", "contains", "json"], ["1", "4", "5", "6"]),
+    (["inv", "path", "leneq", "6"], ["1", "2", "3", "4", "5"]),
+]
+
+_filters = [args for args, ids in _results]
+
+
+class QueryConformanceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = ReplayBackend(list(reversed(_corpus)), _results)
+        cls.client = ProxyClient(conn_addr=cls.backend.addr, binary_framing=False)
+        cls.client.__enter__()
+        cls.reqs = cls.client.query_storage([])
+        cls.headers = cls.client.query_storage([], headers_only=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+        cls.backend.close()
+
+    def local_ids(self, query):
+        compiled = CompiledQuery(query)
+        self.assertTrue(compiled.local, query)
+        ids = set()
+        for req in self.reqs:
+            result = compiled.check(req)
+            self.assertIn(result, (True, False), query)
+            if result:
+                ids.add(req.db_id)
+        return ids
+
+    def backend_ids(self, query):
+        return set(req.db_id for req in self.client.query_storage(query, headers_only=True))
+
+    def assertConforms(self, query):
+        self.assertEqual(self.local_ids(query), self.backend_ids(query), query)
+
+    def test_corpus_loaded(self):
+        self.assertEqual(len(self.reqs), len(_corpus))
+
+    def test_filters(self):
+        for args, ids in _results:
+            with self.subTest(filter=args):
+                self.assertEqual(self.local_ids([[args]]), set(ids), args)
+
+    def test_phrases(self):
+        # filters in a phrase are ORed and phrases are ANDed, the stand-in
+        # combines the pinned results the same way
+        for i, a in enumerate(_filters):
+            b = _filters[(i * 7 + 3) % len(_filters)]
+            c = _filters[(i * 13 + 5) % len(_filters)]
+            with self.subTest(a=a, b=b, c=c):
+                self.assertConforms([[a, b]])
+                self.assertConforms([[a], [b]])
+                self.assertConforms([[a, b], [c]])
+
+    def test_empty_query(self):
+        self.assertConforms([])
+
+    def test_check_request(self):
+        # checkrequest gives the same answer for each request
+        for args in _filters:
+            query = [[args]]
+            expected = self.local_ids(query)
+            for req in self.reqs:
+                with self.subTest(filter=args, id=req.db_id):
+                    self.assertEqual(self.client.check_request(query, reqid=req.db_id),
+                                     req.db_id in expected)
+
+    def test_matcher_falls_back(self):
+        # body filters on headers-only requests are sent to the backend
+        for args in _filters:
+            query = [[args]]
+            matcher = QueryMatcher(self.client, query)
+            with self.subTest(filter=args):
+                ids = set(req.db_id for req in self.headers if matcher.matches(req))
+                self.assertEqual(ids, self.backend_ids(query))
+        matcher = QueryMatcher(self.client, [[["reqbody", "contains", "admin"]]])
+        for req in self.headers:
+            matcher.matches(req)
+        self.assertEqual(matcher.remote_checks, len(self.headers))
+
+    def test_unsupported_fields(self):
+        compiled = CompiledQuery([[["param", "is", "next"]], [["method", "is", "GET"]]])
+        self.assertFalse(compiled.local)
+        for req in self.reqs:
+            result = compiled.check(req)
+            if req.method == "GET":
+                self.assertEqual(result, [[["param", "is", "next"]]])
+            else:
+                self.assertIs(result, False)
+
+
+if __name__ == "__main__":
+    unittest.main()